@@ -3,10 +3,15 @@
 This DAG deals with cluster creation and then wait for the other DAGs to complete
 before terminating all created objects, including EMR cluster, key pairs,
 and security groups.
+
+With EMR_IDLE_TIMEOUT_MINUTES, the cluster, key pair and security groups are kept after
+the run instead, and the next run reuses them. EMR terminates the cluster once it has been
+idle for that long, and the next run then deletes its key pair and security groups before
+creating new ones.
 """
 from datetime import timedelta
 from airflow import DAG
-from airflow.operators.python_operator import PythonOperator
+from airflow.operators.python_operator import PythonOperator, ShortCircuitOperator
 from airflow.operators.custom_operators import VariableExistenceSensor
 from airflow.models import Variable
 import lib.emrspark_lib as emrs
@@ -20,6 +25,7 @@ from airflow.utils import timezone
 start_date = timezone.utcnow() - timedelta(days=2)
 
 from lib.common import *
+from lib.trading_calendar import is_trading_day
 
 default_args = {
     'owner': 'jaycode',
@@ -43,6 +49,17 @@ dag = DAG('cluster_dag',
 
 
 
+def delete_cluster_resources(ec2, resources):
+    """ Delete the key pair and security groups of a terminated cluster.
+    Args:
+        - resources (dict): {'keypair_name': .., 'master_sg_id': .., 'slave_sg_id': ..}
+    """
+    ec2.delete_key_pair(KeyName=resources['keypair_name'])
+    emrs.delete_security_group(ec2, resources['master_sg_id'])
+    time.sleep(2)
+    emrs.delete_security_group(ec2, resources['slave_sg_id'])
+
+
 def preparation(**kwargs):
     # Without this global setting, this DAG on EC2 server got the following error:
     #     UnboundLocalError: local variable 'VPC_ID' referenced before assignment
@@ -52,9 +69,18 @@ def preparation(**kwargs):
     Variable.delete('master_sg_id')
     Variable.delete('slave_sg_id')
     Variable.delete('short_interests_dag_state')
+    Variable.delete('livy_sessions')
 
     ec2, emr, iam = emrs.get_boto_clients(config['AWS']['REGION_NAME'], config=config)
 
+    # The cluster kept by the last run may have been terminated by EMR since then.
+    kept_cluster = Variable.get('kept_cluster', default_var=None, deserialize_json=True)
+    if kept_cluster is not None and emrs.is_cluster_terminated(emr, kept_cluster['cluster_id']):
+        logging.info("Cluster {} was terminated while idle, deleting its key pair and security groups." \
+                     .format(kept_cluster['cluster_id']))
+        delete_cluster_resources(ec2, kept_cluster)
+        Variable.delete('kept_cluster')
+
     if VPC_ID == '':
         VPC_ID = emrs.get_first_available_vpc(ec2)
 
@@ -86,31 +112,56 @@ def create_cluster(**kwargs):
         SUBNET_ID,
         num_core_nodes=int(config['AWS']['EMR_NUM_CORE_NODES']),
         core_node_instance_type=config['AWS']['EMR_CORE_NODE_INSTANCE_TYPE'],
-        release_label='emr-5.28.1'
+        # 5.30.0 or later for the idle timeout.
+        release_label='emr-5.30.1',
+        idle_timeout_seconds=EMR_IDLE_TIMEOUT_MINUTES * 60 if EMR_IDLE_TIMEOUT_MINUTES > 0 else None
     )
     Variable.set('cluster_id', cluster_id)
 
 
 def terminate_cluster(**kwargs):
+    ec2, emr, iam = emrs.get_boto_clients(config['AWS']['REGION_NAME'], config=config)
+    # The Livy sessions are shared by the tasks of the worker DAGs, so they end here.
+    get_livy_session_pool(emrs.get_cluster_dns(emr, Variable.get('cluster_id'))).close()
     keep_cluster = Variable.get('keep_emr_cluster', default_var=False)
-    if not keep_cluster:
-        ec2, emr, iam = emrs.get_boto_clients(config['AWS']['REGION_NAME'], config=config)
+    if EMR_IDLE_TIMEOUT_MINUTES > 0:
+        logging.info("Keeping cluster {} for the next run, EMR terminates it after {} idle minutes." \
+                     .format(Variable.get('cluster_id'), EMR_IDLE_TIMEOUT_MINUTES))
+    elif not keep_cluster:
         emrs.delete_cluster(emr, Variable.get('cluster_id'))
 
 
 def cleanup(**kwargs):
-    ec2, emr, iam = emrs.get_boto_clients(config['AWS']['REGION_NAME'], config=config)
-    ec2.delete_key_pair(KeyName=Variable.get('keypair_name'))
-    emrs.delete_security_group(ec2, Variable.get('master_sg_id'))
-    time.sleep(2)
-    emrs.delete_security_group(ec2, Variable.get('slave_sg_id'))
+    resources = {
+        'cluster_id': Variable.get('cluster_id'),
+        'keypair_name': Variable.get('keypair_name'),
+        'master_sg_id': Variable.get('master_sg_id'),
+        'slave_sg_id': Variable.get('slave_sg_id')
+    }
+    if EMR_IDLE_TIMEOUT_MINUTES > 0:
+        # The cluster kept for the next run still uses the key pair and security groups.
+        # The next run deletes them if EMR has terminated the cluster by then.
+        Variable.set('kept_cluster', resources, serialize_json=True)
+    else:
+        ec2, emr, iam = emrs.get_boto_clients(config['AWS']['REGION_NAME'], config=config)
+        delete_cluster_resources(ec2, resources)
+        Variable.delete('kept_cluster')
     Variable.delete('cluster_id')
     Variable.delete('keypair_name')
     Variable.delete('master_sg_id')
     Variable.delete('slave_sg_id')
     Variable.delete('short_interests_dag_state')
+    Variable.delete('livy_sessions')
 
 
+# No cluster is needed on weekends and market holidays, the worker DAGs skip them.
+check_trading_day_task = ShortCircuitOperator(
+    task_id='Check_trading_day',
+    python_callable=lambda ds, **kwargs: is_trading_day(ds),
+    provide_context=True,
+    dag=dag
+)
+
 preparation_task = PythonOperator(
     task_id='Preparation',
     python_callable=preparation,
@@ -125,7 +176,7 @@ create_cluster_task = PythonOperator(
 
 check_etl_completion_task = VariableExistenceSensor(
     task_id='Check_etl_completion',
-    poke_interval=120,
+    poke_interval=SENSOR_POKE_SECONDS,
     varnames=['short_interests_dag_state'],
     mode='reschedule',
     dag=dag
@@ -143,6 +194,6 @@ cleanup_task = PythonOperator(
     dag=dag
 )
 
-preparation_task >> create_cluster_task >> \
+check_trading_day_task >> preparation_task >> create_cluster_task >> \
 check_etl_completion_task >> terminate_cluster_task >> \
 cleanup_task
\ No newline at end of file
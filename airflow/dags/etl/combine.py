@@ -1,52 +1,187 @@
 # ----------------
 # Combine short interest tables
 # ----------------
+#
+# The combined table is kept in TABLE_SHORT_ANALYSIS, partitioned by month (`month=YYYY-MM`,
+# CSV files without header), and exported to TABLE_SHORT_ANALYSIS.csv for Quantopian.
+#
+# In `incremental` mode, only the dates added to the raw tables since the last combine are
+# aggregated again, and only their months are rewritten. The dates come from the transaction
+# logs of the raw tables, and the log versions already combined are kept in
+# TABLE_SHORT_ANALYSIS_combine_state.json. When that is not possible (no state yet, a raw table
+# without log, a log that was recreated, ...), or in `full` mode, the whole table is rebuilt.
 
-# Without a schema (even with inferSchema=True), the SUM aggregation fails.
-schema = T.StructType([
-    T.StructField("Date", T.StringType(), True),
-    T.StructField("ShortExemptVolume", T.FloatType(), True),
-    T.StructField("ShortVolume", T.FloatType(), True),
-    T.StructField("SourceURL", T.StringType(), True),
-    T.StructField("Symbol", T.StringType(), True),
-    T.StructField("TotalVolume", T.FloatType(), True),
-])
-
-sdf_shorts = spark.read.format('csv') \
-                  .option('header', True) \
-                  .option('schema', schema) \
-                  .option('mode', 'DROPMALFORMED') \
-                  .load([DB_HOST+TABLE_SHORT_INTERESTS_NASDAQ, DB_HOST+TABLE_SHORT_INTERESTS_NYSE])
-
-rows = sdf_shorts.where((F.col('Symbol') == 'SPY') & (F.col('Date') == '2020-02-21')).collect()
-logger.warn("Rows: {}".format(rows))
-
-sdf_shorts = sdf_shorts.groupBy('Date', 'Symbol') \
-                 .agg(F.sum('ShortExemptVolume').alias('short_exempt_volume'),
-                      F.sum('ShortVolume').alias('short_volume'),
-                      F.sum('TotalVolume').alias('total_volume')
-                     ) \
-                 .withColumnRenamed('Date', 'date') \
-                 .withColumnRenamed('Symbol', 'symbol')
+SOURCE_TABLES = [TABLE_SHORT_INTERESTS_NASDAQ, TABLE_SHORT_INTERESTS_NYSE]
+STATE_PATH = TABLE_SHORT_ANALYSIS + '_combine_state.json'
+# Where replace_months keeps the replaced table or month partitions until the new ones are in.
+REPLACED_PATH = TABLE_SHORT_ANALYSIS + '-replaced'
+REPLACED_MONTHS_PATH = TABLE_SHORT_ANALYSIS + '-replaced-months'
 
-# ----------------
-# Prepare for Quantopian
-# ----------------
 
-# DataFrame[short_exempt_volume: string, short_volume: string, total_volume: string, date: string, open: string, 
-# high: string, low: string, close: string, volume: string, changed: string, changep: string, adjclose: string, 
-# tradeval: string, tradevol: string, symbol: string]
+def read_sources(dates=None):
+    """ Read both raw tables, only the rows of `dates` ('YYYY-MM-DD' strings) if given. """
+    sdf_shorts = None
+    for table in SOURCE_TABLES:
+        sdf = read_short_interests_dates(DB_HOST, table, STORAGE_FORMAT, dates)
+        sdf_shorts = sdf if sdf_shorts is None else sdf_shorts.unionByName(sdf)
+    return sdf_shorts
+
+
+def combine(sdf_shorts):
+    sdf_shorts = sdf_shorts.groupBy('Date', 'Symbol') \
+                     .agg(F.sum('ShortExemptVolume').alias('short_exempt_volume'),
+                          F.sum('ShortVolume').alias('short_volume'),
+                          F.sum('TotalVolume').alias('total_volume')
+                         ) \
+                     .withColumnRenamed('Date', 'date') \
+                     .withColumnRenamed('Symbol', 'symbol')
+
+    # ----------------
+    # Prepare for Quantopian
+    # ----------------
+
+    # DataFrame[short_exempt_volume: string, short_volume: string, total_volume: string, date: string, open: string,
+    # high: string, low: string, close: string, volume: string, changed: string, changep: string, adjclose: string,
+    # tradeval: string, tradevol: string, symbol: string]
+
+    # Correct all Quantopian errors here.
+    # -----------
+    # (see QUANTOPIAN_SYMBOLS in helpers.py)
+    sdf = sdf_shorts.withColumn('symbol', quantopian_symbol(F.col('symbol')))
+    # -----------
+
+    return conform(sdf, SHORT_ANALYSIS_SCHEMA)
+
+
+def get_changed_dates(state):
+    """ Dates added to the raw tables since the versions in `state`.
+
+    Return:
+        tuple (sorted list of dates or None if the whole table must be rebuilt, new state)
+    """
+    dates, sources = get_new_dates(DB_HOST, SOURCE_TABLES, STORAGE_FORMAT, None if state is None else state['sources'])
+    # A change of the combined table's types needs a rebuild too.
+    new_state = {'sources': sources, 'schema': SHORT_ANALYSIS_SCHEMA.simpleString()}
+    if state is None or state.get('schema') != new_state['schema']:
+        dates = None
+    return (dates, new_state)
+
+
+def rename(fs, source, destination):
+    """ Rename `source` to `destination` (paths on DB_HOST), which Hadoop FS only reports by returning False. """
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    if not fs.rename(Path(DB_HOST+source), Path(DB_HOST+destination)):
+        raise IOError("Could not rename {} to {}".format(DB_HOST+source, DB_HOST+destination))
+
+
+def replace_months(staging_path, months=None):
+    """ Move the month partitions of `staging_path` into the combined table.
+
+    With `months`, those partitions of the combined table are replaced, and months with no
+    rows left are dropped. Without, the whole combined table is replaced.
+
+    The replaced data is renamed aside (REPLACED_PATH or REPLACED_MONTHS_PATH) before the
+    staging data is renamed in, and deleted only once every rename succeeded. If the job
+    dies in between, restore_replaced puts it back at the next run.
+    """
+    fs = get_fs(spark, DB_HOST)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    if months is None:
+        if fs.exists(Path(DB_HOST+TABLE_SHORT_ANALYSIS)):
+            rename(fs, TABLE_SHORT_ANALYSIS, REPLACED_PATH)
+        rename(fs, staging_path, TABLE_SHORT_ANALYSIS)
+        fs.delete(Path(DB_HOST+REPLACED_PATH), True)
+        return
+    fs.mkdirs(Path(DB_HOST+REPLACED_MONTHS_PATH))
+    for month in months:
+        partition = '/month={}'.format(month)
+        if fs.exists(Path(DB_HOST+TABLE_SHORT_ANALYSIS+partition)):
+            rename(fs, TABLE_SHORT_ANALYSIS+partition, REPLACED_MONTHS_PATH+partition)
+        if fs.exists(Path(DB_HOST+staging_path+partition)):
+            rename(fs, staging_path+partition, TABLE_SHORT_ANALYSIS+partition)
+    fs.delete(Path(DB_HOST+REPLACED_MONTHS_PATH), True)
+    fs.delete(Path(DB_HOST+staging_path), True)
+
+
+def restore_replaced():
+    """ Put back the data that a failed replace_months renamed aside. """
+    fs = get_fs(spark, DB_HOST)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    if fs.exists(Path(DB_HOST+REPLACED_PATH)):
+        if fs.exists(Path(DB_HOST+TABLE_SHORT_ANALYSIS)):
+            # The new table was renamed in, only the old one was left to delete.
+            fs.delete(Path(DB_HOST+REPLACED_PATH), True)
+        else:
+            logger.warn("Restoring {} from an interrupted rebuild.".format(DB_HOST+TABLE_SHORT_ANALYSIS))
+            rename(fs, REPLACED_PATH, TABLE_SHORT_ANALYSIS)
+    if fs.exists(Path(DB_HOST+REPLACED_MONTHS_PATH)):
+        for f in fs.listStatus(Path(DB_HOST+REPLACED_MONTHS_PATH)):
+            partition = '/' + f.getPath().getName()
+            if not fs.exists(Path(DB_HOST+TABLE_SHORT_ANALYSIS+partition)):
+                logger.warn("Restoring {} from an interrupted combine.".format(DB_HOST+TABLE_SHORT_ANALYSIS+partition))
+                rename(fs, REPLACED_MONTHS_PATH+partition, TABLE_SHORT_ANALYSIS+partition)
+        fs.delete(Path(DB_HOST+REPLACED_MONTHS_PATH), True)
+
+
+def write_months(sdf, path):
+    sdf.withColumn('month', F.date_format('date', 'yyyy-MM')) \
+       .repartition('month') \
+       .sortWithinPartitions('date', 'symbol') \
+       .write.mode('overwrite').partitionBy('month').csv(DB_HOST+path, header=False)
+
+
+def export_csv():
+    """ Concatenate the month partitions, in order, into TABLE_SHORT_ANALYSIS.csv.
+
+    On S3, the file is written with a multipart upload whose parts are uploaded by the
+    executors, and it is made public for Quantopian at the same time.
+    """
+    fs = get_fs(spark, DB_HOST)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    files = []
+    listing = fs.listFiles(Path(DB_HOST+TABLE_SHORT_ANALYSIS), True)
+    while listing.hasNext():
+        f = listing.next()
+        name = f.getPath().getName()
+        if not name.startswith('_') and not name.startswith('.'):
+            files.append((f.getPath().toString(), f.getLen()))
+    files.sort()
+    header = ','.join(SHORT_ANALYSIS_SCHEMA.names)
+    if DB_HOST.startswith('s3'):
+        upload_concatenated(files, DB_HOST+TABLE_SHORT_ANALYSIS+".csv", header, content_type='text/csv',
+                            acl='public-read', part_mb=EXPORT_PART_MB)
+    else:
+        merge_files(spark, DB_HOST, [path for path, size in files], DB_HOST+TABLE_SHORT_ANALYSIS+".csv", header)
+
 
-# Correct all Quantopian errors here.
-# -----------
-sdf = sdf_shorts.withColumn('symbol', F.when(F.col('symbol')=='GECCL', 'GECC_L').otherwise(F.col('symbol')))
-# -----------
+staging_path = TABLE_SHORT_ANALYSIS + '-staging'
+restore_replaced()
+state_content = read_text_file(spark, DB_HOST, STATE_PATH)
+state = None if state_content is None else json.loads(state_content)
+dates, new_state = get_changed_dates(state)
+if COMBINE_MODE == 'full' or not get_fs(spark, DB_HOST).exists(sc._jvm.org.apache.hadoop.fs.Path(DB_HOST+TABLE_SHORT_ANALYSIS)):
+    dates = None
 
-sdf.select(['date', 'symbol', 'short_exempt_volume', 'short_volume', 'total_volume']) \
-   .coalesce(1).write.mode('overwrite').csv(DB_HOST+TABLE_SHORT_ANALYSIS, header=True)
+if dates is None:
+    logger.warn("Rebuilding the combined table.")
+    write_months(combine(read_sources()), staging_path)
+    replace_months(staging_path)
+    export_csv()
+elif len(dates) == 0:
+    logger.warn("No new dates in the raw tables, nothing to combine.")
+else:
+    months = sorted(set(date[:7] for date in dates))
+    logger.warn("Combining {} new dates ({} to {}) into {} months.".format(len(dates), dates[0], dates[-1], len(months)))
+    unchanged = read_typed_csv(DB_HOST+TABLE_SHORT_ANALYSIS, SHORT_ANALYSIS_SCHEMA, header=False) \
+                     .where(F.col('month').isin(months) & ~F.col('date').isin([parse_date(date) for date in dates])) \
+                     .select(SHORT_ANALYSIS_SCHEMA.names)
+    write_months(unchanged.unionByName(combine(read_sources(dates))), staging_path)
+    replace_months(staging_path, months)
+    export_csv()
 
-delete_path(spark, DB_HOST, TABLE_SHORT_ANALYSIS+".csv")
-copyMerge(spark, DB_HOST, DB_HOST+TABLE_SHORT_ANALYSIS, DB_HOST+TABLE_SHORT_ANALYSIS+".csv")
-delete_path(spark, DB_HOST, TABLE_SHORT_ANALYSIS)
+# Written last: if a rename failed, the next run combines the same dates again.
+# The quality check of the combined table checks the same dates.
+new_state['dates'] = dates
+write_text_file(spark, DB_HOST, STATE_PATH, json.dumps(new_state))
 
 logger.warn("done!")
@@ -1,39 +1,66 @@
-# Use SPY for debugging
-# 1. Total volume of Short Interests in TABLE_SHORT_ANALYSIS and in TABLE_SHORT_INTERESTS_NASDAQ + TABLE_SHORT_INTERESTS_NYSE should be the same.
-# 2. Total volume of Short Interests in TABLE_SHORT_INTERESTS_NASDAQ should be the same from the one on Quandl website.
-# 3. Total volume of Short Interests in TABLE_SHORT_INTERESTS_NYSE should be the same from the one on Quandl website.
-
-import numpy as np
-
-anly_sdf = spark.read.csv(DB_HOST+TABLE_SHORT_ANALYSIS+".csv", header=True)
-
-row = anly_sdf.where(F.col("symbol") == 'SPY') \
-              .sort(F.col('date').desc()).first()
-logger.warn("row: {}".format(row))
-logger.warn("Last date of SPY: {}".format(row['date']))
-last_date = row['date']
-if last_date == None:
-    logger.warn("(FAIL) Last date cannot be found. Data were not imported properly.")
+# Check the dates of TABLE_SHORT_ANALYSIS that the last combine wrote, in one pass:
+# 1. For every symbol and date, the volumes should equal the sum of the volumes in
+#    TABLE_SHORT_INTERESTS_NASDAQ and TABLE_SHORT_INTERESTS_NYSE.
+# 2. No missing values, no negative volumes, no short volume above the total volume.
+# 3. The number of rows per date should be close to the previous runs.
+# The metrics are kept in TABLE_SHORT_ANALYSIS_quality.json.
+
+fs = get_fs(spark, DB_HOST)
+Path = sc._jvm.org.apache.hadoop.fs.Path
+if not fs.exists(Path(DB_HOST+TABLE_SHORT_ANALYSIS+".csv")):
+    logger.warn("(FAIL) {} does not exist. Data were not exported.".format(DB_HOST+TABLE_SHORT_ANALYSIS+".csv"))
+
+state_content = read_text_file(spark, DB_HOST, TABLE_SHORT_ANALYSIS + '_combine_state.json')
+dates = None if state_content is None else json.loads(state_content).get('dates')
+
+if dates is not None and len(dates) == 0:
+    logger.warn("The last combine did not change any date, nothing to check.")
 else:
-    short_volume = float(row['short_volume'])
-    logger.warn("Short Volume of SPY in {} for date {}: {}".format(DB_HOST+TABLE_SHORT_ANALYSIS+".csv", last_date, short_volume))
-
-    sdf1 = spark.read.csv(DB_HOST+TABLE_SHORT_INTERESTS_NASDAQ, header=True)
-    sdf1 = sdf1.where((F.col("Symbol") == 'SPY') & (F.col("Date") == last_date))
-    row1 = sdf1.first()
-    # logger.warn("Row1: {}".format(row1))
-    sv1 = float(row1['ShortVolume'])
-    logger.warn("Short Volume of SPY from NASDAQ exchange for date {}: {}".format(last_date, sv1))
-
-    sdf2 = spark.read.csv(DB_HOST+TABLE_SHORT_INTERESTS_NYSE, header=True)
-    sdf2 = sdf2.where((F.col("Symbol") == 'SPY') & (F.col("Date") == last_date))
-    row2 = sdf2.first()
-    # logger.warn("Row2: {}".format(row2))
-    sv2 = float(row2['ShortVolume'])
-    logger.warn("Short Volume of SPY from NYSE exchange for date {}: {}".format(last_date, sv2))
-    source2 = row2['ShortVolume']
-
-    if np.isclose(short_volume, sv1 + sv2):
-        logger.warn("(SUCCESS) The total short volume in {} is equal to the sum of short volumes from the exchanges.".format(DB_HOST+TABLE_SHORT_ANALYSIS+".csv"))
+    if dates is None:
+        logger.warn("The combined table was rebuilt, checking every date.")
     else:
-        logger.warn("(FAIL) The total short volume in {} is not equal to the sum of short volumes from the exchanges. (value is {}, should be {})".format(DB_HOST+TABLE_SHORT_ANALYSIS+".csv", short_volume, sv1 + sv2))
+        logger.warn("Checking {} dates ({} to {})".format(len(dates), dates[0], dates[-1]))
+
+    combined = read_typed_csv(DB_HOST+TABLE_SHORT_ANALYSIS, SHORT_ANALYSIS_SCHEMA, header=False)
+    raw = read_short_interests_dates(DB_HOST, TABLE_SHORT_INTERESTS_NASDAQ, STORAGE_FORMAT, dates) \
+              .unionByName(read_short_interests_dates(DB_HOST, TABLE_SHORT_INTERESTS_NYSE, STORAGE_FORMAT, dates))
+    if dates is not None:
+        combined = combined.where(F.col('month').isin(sorted(set(date[:7] for date in dates))) &
+                                  F.col('date').isin([parse_date(date) for date in dates]))
+    raw = raw.groupBy(F.col('Date').alias('date'), quantopian_symbol(F.col('Symbol')).alias('symbol')) \
+             .agg(F.sum('ShortExemptVolume').alias('raw_short_exempt_volume'),
+                  F.sum('ShortVolume').alias('raw_short_volume'),
+                  F.sum('TotalVolume').alias('raw_total_volume'))
+
+    volumes = ['short_exempt_volume', 'short_volume', 'total_volume']
+    joined = combined.select(SHORT_ANALYSIS_SCHEMA.names).withColumn('in_combined', F.lit(True)) \
+                     .join(raw.withColumn('in_raw', F.lit(True)), ['date', 'symbol'], 'full_outer')
+    any_null = F.lit(False)
+    any_negative = F.lit(False)
+    mismatch = F.lit(False)
+    for col in volumes:
+        any_null = any_null | F.col(col).isNull()
+        any_negative = any_negative | (F.col(col) < 0)
+        mismatch = mismatch | ~F.col(col).eqNullSafe(F.col('raw_'+col))
+    both = F.col('in_combined').isNotNull() & F.col('in_raw').isNotNull()
+
+    row = joined.agg(count_if(F.col('in_combined').isNotNull()).alias('rows'),
+                     F.countDistinct(F.when(F.col('in_combined').isNotNull(), F.col('date'))).alias('dates'),
+                     F.max(F.when(F.col('in_combined').isNotNull(), F.col('date'))).alias('max_date'),
+                     count_if(F.col('in_combined').isNotNull() & any_null).alias('nulls'),
+                     count_if(F.col('in_combined').isNotNull() & any_negative).alias('negatives'),
+                     count_if(F.col('short_volume') > F.col('total_volume')).alias('short_above_total'),
+                     count_if(both & mismatch).alias('mismatches'),
+                     count_if(~both).alias('missing')) \
+                .first()
+    metrics = row.asDict()
+    metrics['max_date'] = None if metrics['max_date'] is None else str(metrics['max_date'])
+    metrics['rows_per_date'] = int(metrics['rows'] / metrics['dates']) if metrics['dates'] > 0 else 0
+    logger.warn("{}: {} rows checked, latest date {}.".format(DB_HOST+TABLE_SHORT_ANALYSIS, metrics['rows'], metrics['max_date']))
+
+    store = QualityMetrics(DB_HOST, TABLE_SHORT_ANALYSIS).load()
+    evaluate_metrics(logger, 'Combined table', metrics, store)
+    store.add(PULL_DATE, metrics, None)
+    store.save()
+
+logger.warn("done!")
@@ -1,10 +1,24 @@
 import requests
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
 from pyspark.sql import functions as F
 from pyspark.sql import types as T
 from pyspark.sql import Row
+from pyspark.accumulators import AccumulatorParam
 
 from py4j.java_gateway import java_import
 
 Logger = spark._jvm.org.apache.log4j.Logger
 logger = Logger.getLogger("DAG")
 spark.sparkContext.setLogLevel('WARN')
+# Convert pandas DataFrames to Spark through Arrow (falls back automatically without pyarrow).
+spark.conf.set("spark.sql.execution.arrow.enabled", "true")
@@ -0,0 +1,8 @@
+# Compact the small files appended by the pulls into right-sized files sorted by (Symbol, Date).
+
+for table_path in [TABLE_SHORT_INTERESTS_NASDAQ, TABLE_SHORT_INTERESTS_NYSE]:
+    if spark_table_exists(DB_HOST, table_path, STORAGE_FORMAT):
+        compact_table(DB_HOST, table_path, STORAGE_FORMAT,
+                      target_file_mb=COMPACT_TARGET_FILE_MB, min_files=COMPACT_MIN_FILES, use_log=TABLE_LOG)
+
+logger.warn("done!")
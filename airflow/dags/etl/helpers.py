@@ -7,6 +7,72 @@ sc._jsc.hadoopConfiguration().set("fs.s3a.access.key", AWS_ACCESS_KEY_ID)
 sc._jsc.hadoopConfiguration().set("fs.s3a.secret.key", AWS_SECRET_ACCESS_KEY)
 
 
+# ----------------
+# Schema registry
+# ----------------
+# Every job reads and writes the tables with these types, so Spark never infers a schema
+# or re-parses strings. Volumes are share counts, kept as 64-bit integers.
+
+# Raw short interests tables, one per exchange.
+SHORT_INTERESTS_SCHEMA = T.StructType([
+    T.StructField('Date', T.DateType(), False),
+    T.StructField('ShortExemptVolume', T.LongType(), True),
+    T.StructField('ShortVolume', T.LongType(), True),
+    T.StructField('SourceURL', T.StringType(), True),
+    T.StructField('Symbol', T.StringType(), False),
+    T.StructField('TotalVolume', T.LongType(), True),
+])
+
+# Combined table exported for Quantopian.
+SHORT_ANALYSIS_SCHEMA = T.StructType([
+    T.StructField('date', T.DateType(), False),
+    T.StructField('symbol', T.StringType(), False),
+    T.StructField('short_exempt_volume', T.LongType(), True),
+    T.StructField('short_volume', T.LongType(), True),
+    T.StructField('total_volume', T.LongType(), True),
+])
+
+# Stock info tables, as downloaded from the NASDAQ screener. Columns are matched by position.
+# Many values are 'n/a', so they stay strings.
+STOCK_INFO_SCHEMA = T.StructType([T.StructField(name, T.StringType(), True) for name in
+                                  ['Symbol', 'Name', 'LastSale', 'MarketCap', 'IPOyear', 'Sector', 'industry',
+                                   'SummaryQuote']])
+
+
+def csv_read_schema(schema):
+    """ Schema to parse the CSV files of a table with.
+
+    CSV files written before the volumes were integers hold values like `1234.0`, which
+    LongType does not parse, so integer columns are parsed as doubles (exact up to 2**53).
+    `conform` casts them back.
+    """
+    return T.StructType([T.StructField(field.name, T.DoubleType(), field.nullable)
+                         if isinstance(field.dataType, T.LongType) else field
+                         for field in schema.fields])
+
+
+def conform(sdf, schema):
+    """ Cast the columns of `schema` to their types, in schema order. Other columns are kept at the end. """
+    names = set(schema.names)
+    return sdf.select([F.col(field.name).cast(field.dataType).alias(field.name) for field in schema.fields] +
+                      [name for name in sdf.columns if name not in names])
+
+
+def read_typed_csv(paths, schema, header=True):
+    """ Read CSV files with the types of `schema`, without inferring anything. """
+    return conform(spark.read.schema(csv_read_schema(schema)).csv(paths, header=header), schema)
+
+
+def parse_date(date):
+    """ 'YYYY-MM-DD' string to a date, for DateType columns. """
+    return datetime.strptime(date, "%Y-%m-%d").date()
+
+
+def to_count(value):
+    """ Quandl volume (a JSON number) to an integer share count. """
+    return None if value is None else int(round(value))
+
+
 def delete_path(spark, host, path):
     sc = spark.sparkContext
     java_import(sc._gateway.jvm, "java.net.URI")
@@ -19,79 +85,180 @@ def delete_path(spark, host, path):
     fs.delete(sc._jvm.org.apache.hadoop.fs.Path(host+path), True)
 
 
-def copyMerge(spark, host, src_dir, dst_file, overwrite=False, deleteSource=False, debug=False):
-    
+def get_fs(spark, host):
     sc = spark.sparkContext
-    
-    hadoop = sc._jvm.org.apache.hadoop
-#     conf = hadoop.conf.Configuration()
-    conf = sc._jsc.hadoopConfiguration()
-#     fs = hadoop.fs.FileSystem.get(conf)
     java_import(sc._gateway.jvm, "java.net.URI")
     uri = sc._gateway.jvm.java.net.URI
-    fs = (sc._jvm.org
-          .apache.hadoop
-          .fs.FileSystem
-          .get(uri(host), sc._jsc.hadoopConfiguration())
-          )
+    return sc._jvm.org.apache.hadoop.fs.FileSystem.get(uri(host), sc._jsc.hadoopConfiguration())
+
+
+def read_text_file(spark, host, path):
+    """ Read a small text file through Hadoop FS. Return None if it does not exist. """
+    sc = spark.sparkContext
+    fs = get_fs(spark, host)
+    hpath = sc._jvm.org.apache.hadoop.fs.Path(host+path)
+    if not fs.exists(hpath):
+        return None
+    in_stream = fs.open(hpath)
+    try:
+        return sc._jvm.org.apache.commons.io.IOUtils.toString(in_stream, 'UTF-8')
+    finally:
+        in_stream.close()
+
+
+def write_text_file(spark, host, path, content):
+    """ Write a small text file through Hadoop FS.
 
-    # check files that will be merged
-    files = []
-    for f in fs.listStatus(hadoop.fs.Path(src_dir)):
-        if f.isFile():
-            files.append(f.getPath())
-    if not files:
-        raise ValueError("Source directory {} is empty".format(src_dir))
-    files.sort(key=lambda f: str(f))
+    The content goes to a temporary file first, then replaces `path`, so readers
+    see either the old or the new content, never a partial file.
+    """
+    sc = spark.sparkContext
+    fs = get_fs(spark, host)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    tmp_path = Path(host+path+'.tmp')
+    out_stream = fs.create(tmp_path, True)
+    try:
+        out_stream.write(bytearray(content.encode('utf-8')))
+    finally:
+        out_stream.close()
+    fs.delete(Path(host+path), False)
+    fs.rename(tmp_path, Path(host+path))
 
-    # dst_permission = hadoop.fs.permission.FsPermission.valueOf(permission)      # , permission='-rw-r-----'
-    out_stream = fs.create(hadoop.fs.Path(dst_file), overwrite)
 
+def merge_files(spark, host, files, dst_file, header=None):
+    """ Concatenate files, in the given order, into `dst_file`, optionally after a header line. """
+    sc = spark.sparkContext
+    hadoop = sc._jvm.org.apache.hadoop
+    conf = sc._jsc.hadoopConfiguration()
+    fs = get_fs(spark, host)
+    out_stream = fs.create(hadoop.fs.Path(dst_file), True)
     try:
-        # loop over files in alphabetical order and append them one by one to the target file
+        if header is not None:
+            out_stream.write(bytearray((header + '\n').encode('utf-8')))
         for file in files:
-            if debug: 
-                print("Appending file {} into {}".format(file, dst_file))
-
-            in_stream = fs.open(file)   # InputStream object
+            in_stream = fs.open(hadoop.fs.Path(file))
             try:
-                hadoop.io.IOUtils.copyBytes(in_stream, out_stream, conf, False)     # False means don't close out_stream
+                hadoop.io.IOUtils.copyBytes(in_stream, out_stream, conf, False)
             finally:
                 in_stream.close()
     finally:
         out_stream.close()
 
-    if deleteSource:
-        fs.delete(hadoop.fs.Path(src_dir), True)    # True=recursive
-        if debug:
-            print("Source directory {} removed.".format(src_dir))
 
+def s3_location(path):
+    """ Split an `s3a://bucket/key` path into (bucket, key). """
+    parsed = urlparse(path)
+    return (parsed.netloc, parsed.path.lstrip('/'))
+
+
+def group_upload_parts(files, part_bytes):
+    """ Group files, in order, into multipart upload parts of at least `part_bytes` (except the last).
 
-def spark_table_exists(host, table_path):
-    URI           = sc._gateway.jvm.java.net.URI
-    Path          = sc._gateway.jvm.org.apache.hadoop.fs.Path
-    FileSystem    = sc._gateway.jvm.org.apache.hadoop.fs.FileSystem
-    # Configuration = sc._gateway.jvm.org.apache.hadoop.conf.Configuration
-    Configuration = sc._jsc.hadoopConfiguration
+    Args:
+        - files(list): (path, size) tuples.
+    Return:
+        list of lists of paths.
+    """
+    parts = []
+    current = []
+    size = 0
+    for path, length in files:
+        current.append(path)
+        size += length
+        if size >= part_bytes:
+            parts.append(current)
+            current = []
+            size = 0
+    if len(current) > 0 or len(parts) == 0:
+        parts.append(current)
+    return parts
+
+
+def make_part_uploader(bucket, key, upload_id, header, access_key, secret_key):
+    """ Build the function that uploads one part (part number, [s3a paths]) from an executor.
+
+    A part made of a single file is copied by S3 itself (UploadPartCopy), so its bytes never
+    leave S3. Other parts are read and concatenated by the executor. The header goes into
+    part 1.
+    """
+    def upload_part(part):
+        import boto3
+        s3 = boto3.client('s3', aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+        part_number, paths = part
+        if part_number > 1 and len(paths) == 1:
+            src_bucket, src_key = s3_location(paths[0])
+            result = s3.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                         CopySource={'Bucket': src_bucket, 'Key': src_key})
+            return (part_number, result['CopyPartResult']['ETag'])
 
+        chunks = []
+        if part_number == 1 and header is not None:
+            chunks.append((header + '\n').encode('utf-8'))
+        for path in paths:
+            src_bucket, src_key = s3_location(path)
+            chunks.append(s3.get_object(Bucket=src_bucket, Key=src_key)['Body'].read())
+        result = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                Body=b''.join(chunks))
+        return (part_number, result['ETag'])
+    return upload_part
 
-    fs = FileSystem.get(URI(host), Configuration())
 
+def upload_concatenated(files, dst_path, header=None, content_type='text/csv', acl=None, part_mb=64):
+    """ Write files, in order, into a single S3 object with a parallel multipart upload.
+
+    The parts are uploaded by the executors, and the content type and ACL are set when the
+    upload is created, so the object is complete as soon as the upload is. S3 needs parts of
+    at least 5 MB, except the last one.
+
+    Args:
+        - files(list): (s3a path, size) tuples.
+        - dst_path(str): s3a path of the object to write.
+    """
+    import boto3
+    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+    bucket, key = s3_location(dst_path)
+    parts = list(enumerate(group_upload_parts(files, max(5, part_mb) * 1024 * 1024), 1))
+
+    extra = {'ACL': acl} if acl is not None else {}
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type, **extra)['UploadId']
     try:
-        status = fs.listStatus(Path(table_path))
-        spark.read.csv(host+table_path, header=True)
+        uploader = make_part_uploader(bucket, key, upload_id, header, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        etags = sc.parallelize(parts, len(parts)).map(uploader).collect()
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                     MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag}
+                                                                for number, etag in sorted(etags)]})
+    except Exception:
+        # Uploaded parts are billed until the upload is aborted.
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    logger.warn("Uploaded {} files into {} in {} parts".format(len(files), dst_path, len(parts)))
+
 
+def spark_table_exists(host, table_path, table_type='csv'):
+    """ Whether a table exists and has data files. Nothing is read, only listed.
+
+    Tables with a transaction log are checked from the log alone.
+    """
+    log = TableLog(host, table_path, table_type)
+    if log.exists():
         return True
-    except Py4JJavaError as e:
-        if 'FileNotFoundException' in str(e):
-            return False
-        else:
-            raise
-    except AnalysisException as e:
-        if 'Unable to infer schema' in str(e):
-            return False
-        else:
-            raise
+    fs = get_fs(spark, host)
+    if not fs.exists(sc._jvm.org.apache.hadoop.fs.Path(host+table_path)):
+        return False
+    return table_file_stats(host, table_path)[0] > 0
+
+
+def table_row_count(host, table_path, storage_format='csv'):
+    """ Number of rows of a raw short interests table.
+
+    Read from the transaction log when it records the counts, counted with a full scan otherwise.
+    """
+    log = TableLog(host, table_path, storage_format)
+    if log.exists():
+        num_rows = log.num_rows()
+        if num_rows is not None:
+            return num_rows
+    return read_short_interests(host, table_path, storage_format).count()
 
 
 def check_basic_quality(logger, host, table_path, table_type='csv'):
@@ -101,20 +268,1502 @@ def check_basic_quality(logger, host, table_path, table_type='csv'):
     
     Args:
         - table_type(str): 'parquet' or 'csv'
+    Return:
+        int, number of rows, or None if the table does not exist.
     """
-    if not spark_table_exists(host, table_path):
+    if not spark_table_exists(host, table_path, table_type):
         logger.warn("(FAIL) Table {} does not exist".format(host+table_path))
         return None
     else:
-        if table_type == 'parquet':
-            sdf = spark.read.parquet(host+table_path)
-            count = sdf.rdd.countApprox(timeout=1000, confidence=0.9)
-        elif table_type == 'csv':
-            sdf = spark.read.csv(host+table_path, header=True)
-            count = sdf.rdd.countApprox(timeout=1000, confidence=0.9)
+        count = table_row_count(host, table_path, table_type)
             
         if count == 0:
             logger.warn("(FAIL) Table {} is empty.".format(host+table_path))
         else:
             logger.warn("(SUCCESS) Table {} has {} rows.".format(host+table_path, count))
-        return sdf
+        return count
+
+
+def read_short_interests(host, table_path, storage_format='csv', months=None):
+    """ Read a raw short interests table stored as `storage_format` ('csv' or 'parquet').
+
+    Tables with a transaction log are read from their latest snapshot.
+    With `months` (list of 'YYYY-MM'), the files of other months of a Parquet table are skipped.
+    The rows are not filtered, so CSV tables still return every month.
+    """
+    log = TableLog(host, table_path, storage_format)
+    if log.exists():
+        files = list(log.snapshot()[1].keys())
+        if months is not None:
+            files = [path for path in files
+                     if 'Month=' not in path or path.split('/')[-2][len('Month='):] in months]
+        return log.read(files)
+    if storage_format == 'parquet':
+        sdf = spark.read.parquet(host+table_path)
+        if months is not None:
+            sdf = sdf.where(F.col('Month').isin(months))
+        return conform(sdf, SHORT_INTERESTS_SCHEMA).drop('Month')
+    else:
+        return read_typed_csv(host+table_path, SHORT_INTERESTS_SCHEMA)
+
+
+def append_short_interests(sdf, host, table_path, storage_format='csv', use_log=True):
+    """ Add newly pulled rows to a raw short interests table.
+
+    With `use_log`, the rows are upserted on (Symbol, Date) through the table's transaction
+    log, so retried or overlapping pulls never duplicate rows. Otherwise they are appended.
+    """
+    if use_log:
+        log = TableLog(host, table_path, storage_format)
+        log.ensure()
+        log.upsert(sdf)
+    else:
+        write_short_interests(sdf, host, table_path, storage_format)
+
+
+def write_short_interests(sdf, host, table_path, storage_format='csv', mode='append'):
+    """ Write rows into a raw short interests table.
+
+    Parquet tables are partitioned by month (`Month=YYYY-MM` directories), so readers that
+    filter on dates only open the matching partitions. Each exchange has its own table.
+    """
+    sdf = conform(sdf, SHORT_INTERESTS_SCHEMA)
+    if storage_format == 'parquet':
+        sdf.withColumn('Month', F.date_format('Date', 'yyyy-MM')) \
+           .write.mode(mode).partitionBy('Month').parquet(host+table_path)
+    else:
+        sdf.write.mode(mode).format('csv').save(host+table_path, header=True)
+
+
+class ConcurrentCommitError(Exception):
+    """ Raised when a commit removes files that another commit has already removed. """
+    pass
+
+
+class TableLog(object):
+    """ Transaction log of a data lake table, stored in `<table_path>/_txn_log`.
+
+    Each commit is a JSON file named after its version (00000000000000000001.json, ...)
+    that lists the data files it adds and removes. The files of the table are those of
+    the latest snapshot, i.e. every file added and not removed since. Data files are
+    written into a new `batch-<uuid>` directory first, so they are invisible to readers
+    until the commit that adds them exists. A commit file is created only if its version
+    does not exist yet, so two writers can not both commit the same version. On S3A the
+    existence check and the write are not one atomic step, so avoid concurrent writers
+    there.
+
+    File entries also hold the row count and the min/max Symbol and Date of the file,
+    which FileIndex uses to skip files that can not match a lookup.
+
+    Every `checkpoint_every` versions, the full list of files is saved in
+    `<version>.checkpoint.json`, so readers do not replay the whole log. Once they are
+    past the retention window, vacuum deletes the commits before the latest checkpoint,
+    so the log does not grow forever.
+    Spark ignores directories starting with `_`, so the log is never read as data.
+    """
+    LOG_DIR = '_txn_log'
+    ROWS_PER_FILE = 1000000
+
+    def __init__(self, host, table_path, storage_format='csv', checkpoint_every=50):
+        self.host = host
+        self.table_path = table_path
+        self.storage_format = storage_format
+        self.checkpoint_every = checkpoint_every
+        self.log_path = table_path + '/' + self.LOG_DIR
+
+    def _hpath(self, path):
+        return sc._jvm.org.apache.hadoop.fs.Path(self.host+path)
+
+    def exists(self):
+        return get_fs(spark, self.host).exists(self._hpath(self.log_path))
+
+    def _log_files(self):
+        fs = get_fs(spark, self.host)
+        if not fs.exists(self._hpath(self.log_path)):
+            return ([], [])
+        names = [f.getPath().getName() for f in fs.listStatus(self._hpath(self.log_path))]
+        versions = sorted(int(name[:-len('.json')]) for name in names
+                          if name.endswith('.json') and not name.endswith('.checkpoint.json'))
+        checkpoints = sorted(int(name[:-len('.checkpoint.json')]) for name in names
+                             if name.endswith('.checkpoint.json'))
+        return (versions, checkpoints)
+
+    def _read_json(self, name):
+        return json.loads(read_text_file(spark, self.host, self.log_path + '/' + name))
+
+    def snapshot(self):
+        """
+        Return:
+            tuple (version, {relative file path: file entry}). version is -1 for an empty log.
+        """
+        versions, checkpoints = self._log_files()
+        files = {}
+        start = 0
+        if len(checkpoints) > 0:
+            checkpoint = self._read_json('{:020d}.checkpoint.json'.format(checkpoints[-1]))
+            files = {entry['path']: entry for entry in checkpoint['files']}
+            start = checkpoints[-1] + 1
+        version = start - 1
+        for version in [v for v in versions if v >= start]:
+            commit = self._read_json('{:020d}.json'.format(version))
+            for path in commit['remove']:
+                files.pop(path, None)
+            for entry in commit['add']:
+                files[entry['path']] = entry
+        return (version, files)
+
+    def commit(self, add, remove=[], operation='append', info=None, max_attempts=10):
+        """ Atomically add and remove data files.
+
+        Args:
+            - add(list): File entries {'path': relative path, ...} to add.
+            - remove(list): Relative paths of the files to remove.
+            - info(dict): Extra details about the change, for the readers of the log.
+        Return:
+            int, committed version.
+        """
+        fs = get_fs(spark, self.host)
+        for attempt in range(max_attempts):
+            version, files = self.snapshot()
+            missing = [path for path in remove if path not in files]
+            if len(missing) > 0:
+                raise ConcurrentCommitError("Files already removed from {}: {}".format(self.table_path, missing[:5]))
+
+            version += 1
+            for path in remove:
+                files.pop(path, None)
+            for entry in add:
+                files[entry['path']] = entry
+            # Row count of the table after this commit, so counting rows only reads the last commit.
+            content = json.dumps({'version': version, 'timestamp': time.time(), 'operation': operation,
+                                  'add': add, 'remove': remove, 'info': info or {},
+                                  'num_rows': self._count_rows(files.values())})
+            try:
+                out_stream = fs.create(self._hpath('{}/{:020d}.json'.format(self.log_path, version)), False)
+            except Py4JJavaError as e:
+                if 'FileAlreadyExistsException' in str(e):
+                    # Another writer committed this version first, retry on top of it.
+                    continue
+                raise
+            try:
+                out_stream.write(bytearray(content.encode('utf-8')))
+            finally:
+                out_stream.close()
+
+            if version > 0 and version % self.checkpoint_every == 0:
+                # The checkpoint keeps the creation time once vacuum deletes version 0.
+                write_text_file(spark, self.host, '{}/{:020d}.checkpoint.json'.format(self.log_path, version),
+                                json.dumps({'version': version, 'created': self.created(),
+                                            'files': list(files.values())}))
+            return version
+        raise ConcurrentCommitError("Could not commit to {} after {} attempts".format(self.table_path, max_attempts))
+
+    @staticmethod
+    def _count_rows(entries):
+        """ Sum of the row counts of file entries, or None if some entries have no count. """
+        entries = list(entries)
+        if any('rows' not in entry for entry in entries):
+            return None
+        return sum(entry['rows'] for entry in entries)
+
+    def num_rows(self):
+        """ Number of rows of the latest snapshot, from the log only. None if it is not recorded. """
+        versions = self._log_files()[0]
+        if len(versions) == 0:
+            return 0
+        num_rows = self._read_json('{:020d}.json'.format(versions[-1])).get('num_rows')
+        if num_rows is None:
+            # Logs started before the row counts: the file entries may still have them.
+            num_rows = self._count_rows(self.snapshot()[1].values())
+        return num_rows
+
+    def version(self):
+        """ Latest version, -1 for an empty log. """
+        versions = self._log_files()[0]
+        return versions[-1] if len(versions) > 0 else -1
+
+    def created(self):
+        """ Timestamp of version 0. It changes when the table is rewritten without the log. """
+        versions, checkpoints = self._log_files()
+        if len(versions) > 0 and versions[0] > 0:
+            # Vacuumed, only the latest checkpoint still knows it.
+            return self._read_json('{:020d}.checkpoint.json'.format(checkpoints[-1]))['created']
+        return self._read_json('{:020d}.json'.format(0))['timestamp']
+
+    def commits(self, since=-1):
+        """ Commits after version `since`, oldest first.
+
+        Commits deleted by vacuum are missing, so the first commit is not `since + 1` when
+        some of them were never read.
+        """
+        return [self._read_json('{:020d}.json'.format(version)) for version in self._log_files()[0]
+                if version > since]
+
+    def ensure(self):
+        """ Start the log of an existing table, with all of its current data files as version 0. """
+        if self.exists():
+            return
+        fs = get_fs(spark, self.host)
+        add = []
+        if fs.exists(self._hpath(self.table_path)):
+            root = fs.makeQualified(self._hpath(self.table_path)).toString() + '/'
+            files = fs.listFiles(self._hpath(self.table_path), True)
+            while files.hasNext():
+                f = files.next()
+                path = f.getPath().toString()[len(root):]
+                if not any(part.startswith('_') or part.startswith('.') for part in path.split('/')):
+                    add.append({'path': path, 'size': f.getLen()})
+        self.commit(self.with_stats(add), operation='create')
+
+    def read(self, files=None):
+        """ Read the rows of the latest snapshot (or of the given relative file paths). """
+        if files is None:
+            files = list(self.snapshot()[1].keys())
+        paths = [self.host + self.table_path + '/' + path for path in files]
+        if len(paths) == 0:
+            return spark.createDataFrame([], SHORT_INTERESTS_SCHEMA)
+        if self.storage_format == 'parquet':
+            sdf = conform(spark.read.parquet(*paths), SHORT_INTERESTS_SCHEMA)
+        else:
+            sdf = read_typed_csv(paths, SHORT_INTERESTS_SCHEMA)
+        return sdf.drop('Month')
+
+    def with_stats(self, entries):
+        """ Add the row count and Symbol and Date ranges of each file to its entry.
+
+        Only the Symbol and Date columns of the given files are read.
+        """
+        if len(entries) == 0:
+            return entries
+        stats = {}
+        for row in self.read([entry['path'] for entry in entries]) \
+                       .select('Symbol', 'Date', F.input_file_name().alias('file')) \
+                       .groupBy('file') \
+                       .agg(F.count('*').alias('rows'),
+                            F.min('Symbol').alias('min_symbol'), F.max('Symbol').alias('max_symbol'),
+                            F.min('Date').alias('min_date'), F.max('Date').alias('max_date')) \
+                       .collect():
+            stats[self._relative(row['file'])] = {'rows': row['rows'],
+                                                  'min_symbol': row['min_symbol'], 'max_symbol': row['max_symbol'],
+                                                  'min_date': str(row['min_date']), 'max_date': str(row['max_date'])}
+        # Files without rows (e.g. CSV files with only a header) do not show up in the aggregation.
+        return [dict(entry, **stats.get(entry['path'], {'rows': 0})) for entry in entries]
+
+    def write_files(self, sdf, num_rows=None):
+        """ Write rows into a new batch directory of the table.
+
+        With `num_rows` (the number of rows of `sdf`), the rows are clustered by (Symbol, Date)
+        into files of about ROWS_PER_FILE rows. Each file then holds a contiguous range of
+        symbols, so the ranges recorded in the file entries stay narrow and point lookups
+        open few files. Without, `sdf` is written as it is partitioned.
+
+        Return:
+            list of file entries of the written files, relative to the table path.
+        """
+        batch = 'batch-{}'.format(uuid.uuid4().hex)
+        if num_rows is not None:
+            num_files = max(1, int(num_rows / self.ROWS_PER_FILE) + 1)
+            sdf = sdf.repartitionByRange(num_files, 'Symbol', 'Date').sortWithinPartitions('Symbol', 'Date')
+        write_short_interests(sdf, self.host, self.table_path + '/' + batch, self.storage_format, mode='overwrite')
+        fs = get_fs(spark, self.host)
+        root = fs.makeQualified(self._hpath(self.table_path)).toString() + '/'
+        entries = []
+        files = fs.listFiles(self._hpath(self.table_path + '/' + batch), True)
+        while files.hasNext():
+            f = files.next()
+            if not f.getPath().getName().startswith('_') and not f.getPath().getName().startswith('.'):
+                entries.append({'path': f.getPath().toString()[len(root):], 'size': f.getLen()})
+        return self.with_stats(entries)
+
+    def _relative(self, file_uri):
+        """ Relative path of a file from input_file_name(). """
+        marker = self.table_path.rstrip('/') + '/'
+        return file_uri.split(marker, 1)[1]
+
+    def upsert(self, sdf):
+        """ Insert rows, replacing the existing rows with the same (Symbol, Date).
+
+        Only the files that hold one of the keys are rewritten. Files whose Symbol and Date
+        ranges do not overlap the new rows are not even opened.
+
+        Return:
+            int, committed version.
+        """
+        sdf = sdf.dropDuplicates(['Symbol', 'Date']).cache()
+        bounds = sdf.agg(F.min('Date'), F.max('Date'), F.min('Symbol'), F.max('Symbol')).first()
+        min_date = bounds[0]
+        if min_date is None:
+            sdf.unpersist()
+            return None
+
+        # Downstream jobs only reprocess the dates listed in the commit.
+        dates = sorted(str(row[0]) for row in sdf.select('Date').distinct().collect())
+        version, files = self.snapshot()
+        candidates = FileIndex(files.values()).files(symbols=(bounds[2], bounds[3]),
+                                                     dates=(str(bounds[0]), str(bounds[1])))
+
+        remove = []
+        add = []
+        if len(candidates) > 0:
+            keys = sdf.select('Symbol', 'Date')
+            # input_file_name() is only known before the join.
+            existing = self.read(candidates).withColumn('file', F.input_file_name()) \
+                           .where(F.col('Date') >= min_date)
+            remove = [self._relative(row['file']) for row in
+                      existing.join(keys, ['Symbol', 'Date'], 'left_semi')
+                              .select('file').distinct().collect()]
+            if len(remove) > 0:
+                kept = self.read(remove).join(keys, ['Symbol', 'Date'], 'left_anti')
+                add += self.write_files(kept.select(SHORT_INTERESTS_SCHEMA.names),
+                                        sum(files[path].get('rows', 0) for path in remove))
+
+        add += self.write_files(sdf.select(SHORT_INTERESTS_SCHEMA.names), sdf.count())
+        sdf.unpersist()
+        return self.commit(add, remove, operation='upsert', info={'dates': dates})
+
+    def vacuum(self, retention_hours=24):
+        """ Delete data files removed by commits older than `retention_hours`.
+
+        The commits before the latest checkpoint are deleted with them, so each call only
+        reads the commits of the retention window and those since the latest checkpoint.
+        """
+        fs = get_fs(spark, self.host)
+        live = self.snapshot()[1]
+        versions, checkpoints = self._log_files()
+        # Checkpoints written before they kept the creation time can not replace version 0.
+        prune_before = -1
+        if len(checkpoints) > 0 and 'created' in self._read_json('{:020d}.checkpoint.json'.format(checkpoints[-1])):
+            prune_before = checkpoints[-1]
+        deleted = 0
+        pruned = []
+        for version in versions:
+            commit = self._read_json('{:020d}.json'.format(version))
+            if time.time() - commit['timestamp'] < retention_hours * 3600:
+                # Later commits are younger.
+                break
+            for path in commit['remove']:
+                if path not in live and fs.delete(self._hpath(self.table_path + '/' + path), False):
+                    deleted += 1
+            # Delete the commit only after its removed files, so a failed vacuum retries them.
+            if version < prune_before:
+                fs.delete(self._hpath('{}/{:020d}.json'.format(self.log_path, version)), False)
+                pruned.append(version)
+        for version in checkpoints:
+            if len(pruned) > 0 and version <= pruned[-1]:
+                fs.delete(self._hpath('{}/{:020d}.checkpoint.json'.format(self.log_path, version)), False)
+        logger.warn("Vacuumed {} removed files and {} commits from {}".format(
+            deleted, len(pruned), self.host+self.table_path))
+
+
+class FileIndex(object):
+    """ Index of the data files of a table by their Symbol and Date ranges.
+
+    Built from the file entries of a transaction log snapshot, which record the row count
+    and the min/max Symbol and Date of every file when it is written. Files written before
+    the entries had ranges always match.
+    """
+    def __init__(self, entries):
+        self.entries = list(entries)
+
+    @staticmethod
+    def _overlaps(low, high, bounds):
+        return bounds is None or (low <= bounds[1] and bounds[0] <= high)
+
+    def files(self, symbols=None, dates=None):
+        """ Relative paths of the files that may hold rows in the given ranges.
+
+        Args:
+            - symbols(tuple): (min symbol, max symbol), or None for all symbols.
+            - dates(tuple): (min date, max date) 'YYYY-MM-DD' strings, or None for all dates.
+        """
+        paths = []
+        for entry in self.entries:
+            if 'rows' not in entry:
+                paths.append(entry['path'])
+            elif entry['rows'] > 0 and \
+                 self._overlaps(entry['min_symbol'], entry['max_symbol'], symbols) and \
+                 self._overlaps(entry['min_date'], entry['max_date'], dates):
+                paths.append(entry['path'])
+        return paths
+
+
+def lookup_short_interests(host, table_path, storage_format='csv', symbol=None, date=None):
+    """ Rows of a symbol and/or a date ('YYYY-MM-DD').
+
+    With a transaction log, only the files whose ranges include them are read.
+    """
+    log = TableLog(host, table_path, storage_format)
+    if log.exists():
+        index = FileIndex(log.snapshot()[1].values())
+        sdf = log.read(index.files(symbols=None if symbol is None else (symbol, symbol),
+                                   dates=None if date is None else (date, date)))
+    else:
+        sdf = read_short_interests(host, table_path, storage_format, months=None if date is None else [date[:7]])
+    if symbol is not None:
+        sdf = sdf.where(F.col('Symbol') == symbol)
+    if date is not None:
+        sdf = sdf.where(F.col('Date') == parse_date(date))
+    return sdf
+
+
+def read_short_interests_symbols(host, table_path, storage_format='csv', symbols=[]):
+    """ Rows of the given symbols. With a transaction log, only the files whose ranges include them are read. """
+    log = TableLog(host, table_path, storage_format)
+    if log.exists():
+        index = FileIndex(log.snapshot()[1].values())
+        files = set()
+        for symbol in symbols:
+            files.update(index.files(symbols=(symbol, symbol)))
+        sdf = log.read(sorted(files))
+    else:
+        sdf = read_short_interests(host, table_path, storage_format)
+    return sdf.where(F.col('Symbol').isin(list(symbols)))
+
+
+def read_short_interests_dates(host, table_path, storage_format='csv', dates=None):
+    """ Rows of the given dates ('YYYY-MM-DD' strings), or of the whole table if None.
+
+    With a transaction log, only the files whose date range overlaps the dates are read.
+    """
+    if dates is None:
+        return read_short_interests(host, table_path, storage_format)
+    log = TableLog(host, table_path, storage_format)
+    if log.exists():
+        sdf = log.read(FileIndex(log.snapshot()[1].values()).files(dates=(min(dates), max(dates))))
+    else:
+        sdf = read_short_interests(host, table_path, storage_format, sorted(set(date[:7] for date in dates)))
+    return sdf.where(F.col('Date').isin([parse_date(date) for date in dates]))
+
+
+def get_new_dates(host, table_paths, storage_format='csv', state=None):
+    """ Dates upserted into raw tables since the log versions in `state`.
+
+    Args:
+        - state(dict): {table_path: {'created': .., 'version': ..}} returned by a previous call.
+    Return:
+        tuple (sorted list of dates, or None when every row must be read again, new state)
+    """
+    new_state = {}
+    dates = set()
+    read_all = False
+    for table_path in table_paths:
+        log = TableLog(host, table_path, storage_format)
+        if not log.exists():
+            logger.warn("{} has no transaction log, its new rows can not be told apart.".format(host+table_path))
+            return (None, new_state)
+        created = log.created()
+        new_state[table_path] = {'created': created, 'version': log.version()}
+
+        table_state = None if state is None else state.get(table_path)
+        if table_state is None or table_state['created'] != created:
+            read_all = True
+            continue
+        commits = log.commits(table_state['version'])
+        if len(commits) > 0 and commits[0]['version'] != table_state['version'] + 1:
+            # Vacuum deleted commits that were not read yet.
+            read_all = True
+            continue
+        for commit in commits:
+            if commit['version'] > new_state[table_path]['version']:
+                # Committed after we listed the log, the next call picks it up.
+                break
+            if commit['operation'] == 'compact':
+                # Same rows, rewritten into other files.
+                continue
+            elif commit['operation'] == 'upsert' and 'dates' in commit.get('info', {}):
+                dates.update(commit['info']['dates'])
+            else:
+                read_all = True
+    if read_all:
+        return (None, new_state)
+    return (sorted(dates), new_state)
+
+
+# Symbols renamed for Quantopian in the combined table.
+QUANTOPIAN_SYMBOLS = {'GECCL': 'GECC_L'}
+
+
+def quantopian_symbol(col):
+    """ Column expression of the Quantopian name of the symbols in `col`. """
+    expr = col
+    for symbol, quantopian_name in QUANTOPIAN_SYMBOLS.items():
+        expr = F.when(col == symbol, quantopian_name).otherwise(expr)
+    return expr
+
+
+class QualityMetrics(object):
+    """ Quality metrics of a table, kept in `<table_path>_quality.json` between runs.
+
+    Each run appends its metrics to the history, along with the log versions of the tables
+    it checked (`sources`), so the next run only checks the rows written since then, and
+    compares its metrics with a baseline from the previous runs.
+    """
+    def __init__(self, host, table_path, max_history=90):
+        self.host = host
+        self.path = table_path + '_quality.json'
+        self.max_history = max_history
+        self.sources = None
+        self.history = []
+
+    def load(self):
+        content = read_text_file(spark, self.host, self.path)
+        if content is not None:
+            saved = json.loads(content)
+            self.sources = saved['sources']
+            self.history = saved['history']
+        return self
+
+    def baseline(self, name, runs=10):
+        """ Median of a metric over the last `runs` runs, or None without history. """
+        values = sorted(run['metrics'][name] for run in self.history[-runs:]
+                        if run['metrics'].get(name) is not None)
+        if len(values) == 0:
+            return None
+        return values[len(values) // 2]
+
+    def add(self, pull_date, metrics, sources):
+        self.history = (self.history + [{'pull_date': pull_date, 'checked_at': time.time(), 'metrics': metrics}]) \
+                       [-self.max_history:]
+        self.sources = sources
+
+    def save(self):
+        write_text_file(spark, self.host, self.path,
+                        json.dumps({'sources': self.sources, 'history': self.history}))
+
+
+def count_if(condition):
+    return F.sum(F.when(condition, 1).otherwise(0))
+
+
+def short_interests_metrics(sdf, group_col):
+    """ Compute every check of raw short interest rows in a single aggregation, per `group_col`.
+
+    Return:
+        dict {group: metrics dict}
+    """
+    volumes = ['ShortExemptVolume', 'ShortVolume', 'TotalVolume']
+    any_null = F.col('Date').isNull() | F.col('Symbol').isNull()
+    any_negative = F.lit(False)
+    for col in volumes:
+        any_null = any_null | F.col(col).isNull()
+        any_negative = any_negative | (F.col(col) < 0)
+
+    metrics = {}
+    for row in sdf.groupBy(group_col) \
+                  .agg(F.count('*').alias('rows'),
+                       F.countDistinct('Date').alias('dates'),
+                       F.approx_count_distinct('Symbol').alias('symbols'),
+                       F.min('Date').alias('min_date'),
+                       F.max('Date').alias('max_date'),
+                       count_if(any_null).alias('nulls'),
+                       count_if(any_negative).alias('negatives'),
+                       count_if(F.col('ShortVolume') > F.col('TotalVolume')).alias('short_above_total')) \
+                  .collect():
+        values = row.asDict()
+        group = values.pop(group_col)
+        values['min_date'] = None if values['min_date'] is None else str(values['min_date'])
+        values['max_date'] = None if values['max_date'] is None else str(values['max_date'])
+        values['rows_per_date'] = int(values['rows'] / values['dates']) if values['dates'] > 0 else 0
+        metrics[group] = values
+    return metrics
+
+
+def evaluate_metrics(logger, name, metrics, store, min_ratio=0.5):
+    """ Log the result of each check of `metrics`, and compare the rows per date with the baseline.
+
+    Return:
+        int, number of failed checks.
+    """
+    failures = 0
+    checks = [('nulls', "rows with missing values"),
+              ('negatives', "rows with negative volumes"),
+              ('short_above_total', "rows with a short volume above the total volume"),
+              ('mismatches', "rows that differ from the sum of the exchanges"),
+              ('missing', "rows missing from one side of the reconciliation")]
+    for key, description in checks:
+        if key not in metrics:
+            continue
+        if metrics[key] == 0:
+            logger.warn("(SUCCESS) {}: no {}.".format(name, description))
+        else:
+            logger.warn("(FAIL) {}: {} {}.".format(name, metrics[key], description))
+            failures += 1
+
+    baseline = store.baseline('rows_per_date')
+    if baseline is None:
+        logger.warn("{}: {} rows per date, no baseline yet.".format(name, metrics['rows_per_date']))
+    elif metrics['rows_per_date'] < baseline * min_ratio:
+        logger.warn("(FAIL) {}: {} rows per date, the usual is {}.".format(name, metrics['rows_per_date'], baseline))
+        failures += 1
+    else:
+        logger.warn("(SUCCESS) {}: {} rows per date (usual: {}).".format(name, metrics['rows_per_date'], baseline))
+    return failures
+
+
+def stratified_sample(sizes, num_symbols, strata=4, seed=None):
+    """ Sample symbols evenly across `strata` groups of similar history length.
+
+    Sampling each group separately keeps symbols with short histories (recent listings,
+    thin trading) in the sample, instead of mostly the long-lived ones.
+
+    Args:
+        - sizes(dict): {symbol: number of rows}
+    Return:
+        sorted list of symbols.
+    """
+    rng = random.Random(seed)
+    ordered = sorted(sizes, key=lambda symbol: (sizes[symbol], symbol))
+    num_symbols = min(num_symbols, len(ordered))
+    strata = max(1, min(strata, num_symbols))
+    sample = []
+    for i in range(strata):
+        group = ordered[i * len(ordered) // strata:(i+1) * len(ordered) // strata]
+        take = num_symbols // strata + (1 if i < num_symbols % strata else 0)
+        sample += rng.sample(group, min(take, len(group)))
+    return sorted(sample)
+
+
+def reconcile_symbol(response_json, lake_rows, first_date, last_date):
+    """ Compare the rows of a symbol in the lake with Quandl's, over [first_date, last_date].
+
+    Args:
+        - lake_rows(list): Rows with Date, ShortExemptVolume, ShortVolume and TotalVolume.
+    Return:
+        dict of counts: quandl_rows, lake_rows, missing (only in Quandl), extra (only in the
+        lake), mismatched (different volumes).
+    """
+    dataset = response_json['dataset']
+    col_idx = {name: i for i, name in enumerate(dataset['column_names'])}
+    volumes = ['ShortExemptVolume', 'ShortVolume', 'TotalVolume']
+    quandl = {datum[col_idx['Date']]: tuple(to_count(datum[col_idx[col]]) for col in volumes)
+              for datum in dataset['data'] if first_date <= datum[col_idx['Date']] <= last_date}
+    lake = {str(row['Date']): tuple(row[col] for col in volumes) for row in lake_rows}
+    return {'quandl_rows': len(quandl),
+            'lake_rows': len(lake),
+            'missing': len(set(quandl) - set(lake)),
+            'extra': len(set(lake) - set(quandl)),
+            'mismatched': sum(1 for date in set(quandl) & set(lake) if quandl[date] != lake[date])}
+
+
+def format_table(header, rows):
+    """ Lines of a plain text table, for the logs. """
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    return ['  '.join(str(value).ljust(width) for value, width in zip(row, widths)) for row in [header] + rows]
+
+
+def table_file_stats(host, table_path):
+    """ Return (number of data files, total bytes) of a table directory. """
+    fs = get_fs(spark, host)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    files = fs.listFiles(Path(host+table_path), True)
+    num_files = 0
+    num_bytes = 0
+    while files.hasNext():
+        f = files.next()
+        name = f.getPath().getName()
+        # Skip _SUCCESS and other metadata files.
+        if not name.startswith('_') and not name.startswith('.'):
+            num_files += 1
+            num_bytes += f.getLen()
+    return (num_files, num_bytes)
+
+
+def compact_table(host, table_path, storage_format='csv', target_file_mb=128, min_files=64, use_log=True):
+    """ Rewrite a raw short interests table into fewer, right-sized files sorted by (Symbol, Date).
+
+    The compacted files replace the old ones in a single commit of the transaction log, which
+    is started first with `use_log`. Tables without a log are not compacted: on S3 a directory
+    rename is a copy then a delete, so swapping the files in would not be atomic.
+    Nothing is done if the table has fewer than `min_files` data files.
+
+    Return:
+        tuple ((files before, bytes before), (files after, bytes after))
+    """
+    log = TableLog(host, table_path, storage_format)
+    if not log.exists():
+        if not use_log:
+            before = table_file_stats(host, table_path)
+            logger.warn("{} has no transaction log, it can not be compacted safely.".format(host+table_path))
+            return (before, before)
+        log.ensure()
+    files = log.snapshot()[1]
+    before = (len(files), sum(entry.get('size', 0) for entry in files.values()))
+    if before[0] < min_files:
+        logger.warn("{} has {} files ({} bytes), no compaction needed.".format(host+table_path, before[0], before[1]))
+        return (before, before)
+
+    num_files = max(1, int(before[1] / (target_file_mb * 1024 * 1024)) + 1)
+    sdf = read_short_interests(host, table_path, storage_format)
+    if storage_format == 'parquet':
+        # Each month is its own directory, so keep the files of a month together.
+        sdf = sdf.withColumn('Month', F.date_format('Date', 'yyyy-MM')) \
+                 .repartitionByRange(num_files, 'Month', 'Symbol') \
+                 .sortWithinPartitions('Month', 'Symbol', 'Date') \
+                 .drop('Month')
+    else:
+        sdf = sdf.repartitionByRange(num_files, 'Symbol', 'Date').sortWithinPartitions('Symbol', 'Date')
+    # One commit replaces every file, so readers see either all old or all new files.
+    # The old files are deleted by a later vacuum, once running readers are done with them.
+    add = log.write_files(sdf)
+    log.commit(add, list(files.keys()), operation='compact')
+    after = (len(add), sum(entry['size'] for entry in add))
+    log.vacuum()
+    logger.warn("Compacted {}: {} files ({} bytes) -> {} files ({} bytes)".format(
+        host+table_path, before[0], before[1], after[0], after[1]))
+    return (before, after)
+
+
+def is_csv_table(host, table_path):
+    """ Whether a table directory holds CSV part files (the layout before Parquet storage). """
+    fs = get_fs(spark, host)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    if not fs.exists(Path(host+table_path)):
+        return False
+    log = TableLog(host, table_path)
+    if log.exists():
+        return any(path.endswith('.csv') for path in log.snapshot()[1])
+    return any(f.getPath().getName().endswith('.csv') for f in fs.listStatus(Path(host+table_path)))
+
+
+def migrate_to_parquet(host, table_path):
+    """ Rewrite a raw short interests table from CSV to Parquet, partitioned by month.
+
+    The Parquet table is written next to the CSV one, then swapped in. The CSV files
+    are kept in `<table_path>-csv-backup` and can be deleted once the migration is checked.
+    """
+    fs = get_fs(spark, host)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    tmp_path = table_path + '-parquet-migration'
+    backup_path = table_path + '-csv-backup'
+
+    sdf = read_short_interests(host, table_path, 'csv')
+    write_short_interests(sdf, host, tmp_path, 'parquet', mode='overwrite')
+
+    fs.rename(Path(host+table_path), Path(host+backup_path))
+    fs.rename(Path(host+tmp_path), Path(host+table_path))
+    logger.warn("Migrated {} to Parquet. The CSV files are kept in {}".format(host+table_path, host+backup_path))
+
+
+def has_current_schema(host, table_path):
+    """ Whether the files of a Parquet table have the types of SHORT_INTERESTS_SCHEMA.
+
+    Only the footer of one data file is read. Tables written before the schema registry
+    have string dates and double volumes.
+    """
+    log = TableLog(host, table_path, 'parquet')
+    if log.exists():
+        files = list(log.snapshot()[1].keys())
+        if len(files) == 0:
+            return True
+        path = host + table_path + '/' + files[0]
+    else:
+        Path = sc._jvm.org.apache.hadoop.fs.Path
+        files = get_fs(spark, host).listFiles(Path(host+table_path), True)
+        path = None
+        while files.hasNext():
+            f = files.next()
+            if f.getPath().getName().endswith('.parquet'):
+                path = f.getPath().toString()
+                break
+        if path is None:
+            return True
+    types = {field.name: field.dataType for field in spark.read.parquet(path).schema.fields}
+    return all(types.get(field.name) == field.dataType for field in SHORT_INTERESTS_SCHEMA.fields)
+
+
+def upgrade_parquet_table(host, table_path, use_log=True):
+    """ Rewrite a Parquet table written before the schema registry with its exact types.
+
+    This is a compaction of every file (see compact_table), so it needs a transaction log.
+    Without one, the table is read with a cast to the exact types instead.
+    """
+    if has_current_schema(host, table_path):
+        return
+    logger.warn("Rewriting {} with the types of SHORT_INTERESTS_SCHEMA".format(host+table_path))
+    compact_table(host, table_path, 'parquet', min_files=0, use_log=use_log)
+
+
+def a_before_b(a, b):
+    date_format = "%Y-%m-%d"
+
+    # create datetime objects from the strings
+    da = datetime.strptime(a, date_format)
+    db = datetime.strptime(b, date_format)
+
+    if da < db:
+        return True
+    else:
+        return False
+    
+
+class ShortInterestsBatch(object):
+    """ Columnar buffer of short interest rows, waiting to be written.
+
+    Values are appended to one list per column, instead of creating a Row per data point,
+    and the batch is handed to Spark with the fixed SHORT_INTERESTS_SCHEMA (through Arrow
+    when pandas and pyarrow are available), so Spark does not infer the schema again.
+    """
+    VOLUME_COLUMNS = ['ShortExemptVolume', 'ShortVolume', 'TotalVolume']
+
+    # Approximate size of the numbers and separators of a row, on top of its strings.
+    ROW_OVERHEAD_BYTES = 48
+
+    def __init__(self):
+        self.columns = {field.name: [] for field in SHORT_INTERESTS_SCHEMA.fields}
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.columns['Date'])
+
+    def add_response(self, response_json, symbol, url, after_date=None):
+        """ Append the data of one Quandl response.
+
+        Args:
+            - after_date(str): Only add rows newer than this date (the symbol's last date in the db).
+        Return:
+            tuple (number of rows added, last date or None)
+        """
+        dataset = response_json['dataset']
+        col_idx = {name: i for i, name in enumerate(dataset['column_names'])}
+        data = dataset['data']
+        if after_date is not None:
+            data = [datum for datum in data if datum[col_idx['Date']] > after_date]
+        if len(data) == 0:
+            return (0, None)
+
+        dates = [datum[col_idx['Date']] for datum in data]
+        self.columns['Date'].extend(dates)
+        for col in self.VOLUME_COLUMNS:
+            i = col_idx[col]
+            self.columns[col].extend(to_count(datum[i]) for datum in data)
+        self.columns['Symbol'].extend([symbol] * len(data))
+        self.columns['SourceURL'].extend([url] * len(data))
+        self.nbytes += len(data) * (len(dates[0]) + len(symbol) + len(url) + self.ROW_OVERHEAD_BYTES)
+        return (len(data), max(dates))
+
+    def to_spark(self, spark):
+        names = [field.name for field in SHORT_INTERESTS_SCHEMA.fields]
+        # Dates are kept as strings while buffering, to compare them with the watermarks.
+        columns = dict(self.columns, Date=[parse_date(date) for date in self.columns['Date']])
+        try:
+            import pandas as pd
+        except ImportError:
+            return spark.createDataFrame(list(zip(*[columns[name] for name in names])), SHORT_INTERESTS_SCHEMA)
+        # Object columns keep the volumes as integers (and missing ones as None) instead of NaN floats.
+        pdf = pd.DataFrame({name: pd.Series(columns[name], dtype=object) for name in names}, columns=names)
+        return spark.createDataFrame(pdf, SHORT_INTERESTS_SCHEMA)
+
+    def clear(self):
+        for values in self.columns.values():
+            del values[:]
+        self.nbytes = 0
+
+
+class FlushPolicy(object):
+    """ Decide when a ShortInterestsBatch should be written to the table.
+
+    A batch is flushed once it holds `max_rows` rows, reaches `max_bytes` (the memory
+    ceiling of the buffer), or has waited `max_seconds` since the last flush, whichever
+    comes first. This keeps memory bounded on a backfill, while a daily run writes one
+    file per exchange instead of one every few symbols.
+    """
+    def __init__(self, max_rows=500000, max_bytes=256*1024*1024, max_seconds=600):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.last_flush = time.time()
+
+    def should_flush(self, batch):
+        return len(batch) >= self.max_rows or \
+               batch.nbytes >= self.max_bytes or \
+               (len(batch) > 0 and time.time() - self.last_flush >= self.max_seconds)
+
+    def flushed(self):
+        self.last_flush = time.time()
+
+
+def make_http_session(pool_size):
+    """ Create a requests Session that keeps `pool_size` connections alive.
+
+    A single session is shared by all fetch threads, so each thread reuses an
+    open TCP/TLS connection to Quandl instead of creating a new one per symbol.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class ThrottledError(Exception):
+    """ Raised when Quandl still throttles (429), fails (5xx) or times out a request after all attempts. """
+    def __init__(self, url, status_code, retry_after):
+        super(ThrottledError, self).__init__("{} returned {}".format(url, status_code))
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateLimiter(object):
+    """ Token bucket with adaptive concurrency, shared by every request to Quandl.
+
+    Requests take one token each. Tokens refill at `rate` per second, which ramps up
+    towards `max_rate` while responses are fast and successful. A 429 or 5xx response
+    halves both the rate and the number of requests allowed in flight, and blocks
+    every caller until the Retry-After period is over.
+
+    Args:
+        - max_rate(float): Maximum number of requests per second.
+        - max_concurrency(int): Maximum number of requests in flight.
+        - target_latency(float): Seconds. Slower responses stop the ramp-up.
+    """
+    def __init__(self, max_rate, max_concurrency, target_latency=5.0):
+        self.max_rate = float(max_rate)
+        self.rate = self.max_rate / 2
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(1, max_concurrency // 2)
+        self.target_latency = target_latency
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.updated_at = time.time()
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if now >= self.blocked_until and self.in_flight < self.concurrency and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.01)
+                self.cond.wait(wait)
+
+    def release(self, latency, throttled=False, retry_after=None):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.rate = max(self.max_rate / 100, self.rate / 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                backoff = retry_after if retry_after is not None else 1.0 / self.rate
+                self.blocked_until = max(self.blocked_until, time.time() + backoff)
+            elif latency < self.target_latency:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.cond.notify_all()
+
+
+def parse_retry_after(value):
+    """ Convert a Retry-After header (seconds or HTTP date) into seconds. """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def limited_get(http, url, limiter, max_attempts=5, timeout=30):
+    """ GET a url through the rate limiter, retrying 429 and 5xx responses and failed requests.
+
+    Args:
+        - timeout(float): Seconds to wait for Quandl to connect and to answer, per attempt.
+    Return:
+        requests.Response of a request that was not throttled.
+    Raise:
+        ThrottledError when all attempts were throttled or failed.
+    """
+    status_code = None
+    retry_after = None
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        started_at = time.time()
+        # Timeouts and connection errors back off like a throttled response.
+        throttled = True
+        retry_after = None
+        try:
+            response = http.get(url, timeout=timeout)
+            status_code = response.status_code
+            throttled = status_code == 429 or status_code >= 500
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        except requests.exceptions.RequestException:
+            continue
+        finally:
+            # Always give the slot back, or the limiter runs out of concurrency.
+            limiter.release(time.time() - started_at, throttled=throttled, retry_after=retry_after)
+        if not throttled:
+            return response
+    raise ThrottledError(url, status_code, retry_after)
+
+
+def quandl_url(exchange, symbol, start_date, end_date):
+    url = 'https://www.quandl.com/api/v3/datasets/FINRA/'+exchange+'_{}?start_date='+start_date+'&end_date='+end_date+'&api_key='+QUANDL_API_KEY
+    return url.format(symbol)
+
+
+class ResponseCache(object):
+    """ Content-addressed cache of Quandl responses, stored locally or on S3.
+
+    Entries are keyed by (exchange, symbol, start_date, end_date) and expire after
+    `ttl_seconds`. Expired entries are deleted when they are read, and by `sweep`. With
+    `replay=True`, cache misses never go to the network, which lets us re-run a pull
+    offline against previously fetched responses.
+
+    Args:
+        - location(str): Local directory, or `s3a://bucket/prefix`.
+        - ttl_seconds(int): Age after which an entry is evicted.
+        - replay(bool): Only serve from the cache.
+    """
+    def __init__(self, location, ttl_seconds, replay=False):
+        self.ttl_seconds = ttl_seconds
+        self.replay = replay
+        parsed = urlparse(location)
+        if parsed.scheme in ['s3', 's3a', 's3n']:
+            import boto3
+            self.s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID,
+                                   aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+            self.bucket = parsed.netloc
+            self.prefix = parsed.path.strip('/')
+        else:
+            self.s3 = None
+            self.prefix = location
+            os.makedirs(location, exist_ok=True)
+
+    @staticmethod
+    def key(exchange, symbol, start_date, end_date):
+        content = '|'.join([exchange, symbol, start_date, end_date])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        # Two-level fan-out keeps directory listings small.
+        return '/'.join([self.prefix, key[:2], key + '.json'])
+
+    def get(self, key):
+        """ Return the cached entry {'status_code': .., 'body': .., 'stored_at': ..} or None. """
+        path = self._path(key)
+        try:
+            if self.s3 is not None:
+                obj = self.s3.get_object(Bucket=self.bucket, Key=path)
+                entry = json.loads(obj['Body'].read().decode('utf-8'))
+            else:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        except Exception as e:
+            if self.s3 is not None and isinstance(e, self.s3.exceptions.NoSuchKey):
+                return None
+            raise
+
+        if not self.replay and time.time() - entry['stored_at'] > self.ttl_seconds:
+            self.delete(key)
+            return None
+        return entry
+
+    def put(self, key, status_code, body):
+        content = json.dumps({'status_code': status_code, 'body': body, 'stored_at': time.time()})
+        path = self._path(key)
+        if self.s3 is not None:
+            self.s3.put_object(Bucket=self.bucket, Key=path, Body=content.encode('utf-8'))
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so readers never see a partial entry.
+            with open(path + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+
+    def delete(self, key):
+        path = self._path(key)
+        if self.s3 is not None:
+            self.s3.delete_object(Bucket=self.bucket, Key=path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def sweep(self):
+        """ Delete the expired entries, including those that are never read again.
+
+        The age of an entry is the one of its file, which is written at `stored_at`, so the
+        entries do not have to be downloaded. Nothing is deleted in replay mode.
+
+        Return:
+            int, the number of deleted entries.
+        """
+        if self.replay:
+            return 0
+        expired_before = time.time() - self.ttl_seconds
+        deleted = 0
+        if self.s3 is not None:
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + '/'):
+                expired = [{'Key': obj['Key']} for obj in page.get('Contents', [])
+                           if obj['LastModified'].timestamp() < expired_before]
+                # A page holds at most 1000 keys, the limit of delete_objects.
+                if len(expired) > 0:
+                    self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': expired, 'Quiet': True})
+                    deleted += len(expired)
+        else:
+            for dirpath, dirnames, filenames in os.walk(self.prefix):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        if os.path.getmtime(path) < expired_before:
+                            os.remove(path)
+                            deleted += 1
+                    except OSError:
+                        # Already deleted by a concurrent pull.
+                        pass
+        return deleted
+
+
+def make_response_cache():
+    """ Build the ResponseCache configured by the QUANDL_CACHE_* args, or None when disabled. """
+    if QUANDL_CACHE_LOCATION is None or QUANDL_CACHE_LOCATION == '':
+        return None
+    return ResponseCache(QUANDL_CACHE_LOCATION, QUANDL_CACHE_TTL_HOURS * 3600,
+                         replay=(QUANDL_CACHE_MODE == 'replay'))
+
+
+def fetch_quandl(http, limiter, cache, exchange, symbol, start_date, end_date):
+    """ Get a Quandl dataset, from the response cache when possible.
+
+    Return:
+        tuple (status_code, response json or None, url). status_code is None when
+        the cache is in replay mode and has no entry. The json is None for a 200 response
+        whose body is not a Quandl dataset (e.g. an HTML error page or a truncated body),
+        which is not cached.
+    """
+    url = quandl_url(exchange, symbol, start_date, end_date)
+    key = None
+    if cache is not None:
+        key = ResponseCache.key(exchange, symbol, start_date, end_date)
+        entry = cache.get(key)
+        if entry is not None:
+            return (entry['status_code'], entry['body'], url)
+        if cache.replay:
+            return (None, None, url)
+
+    response = limited_get(http, url, limiter)
+    body = None
+    if response.status_code in [200, 201]:
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, dict) or 'dataset' not in body:
+            logger.warn("{}: Quandl returned {} without a dataset, skipped.".format(symbol, response.status_code))
+            body = None
+    if cache is not None and (body is not None or response.status_code == 404):
+        cache.put(key, response.status_code, body)
+    return (response.status_code, body, url)
+
+
+def get_symbols(host, info_table_path):
+    """ List the symbols to pull, either from STOCKS or from the stock info table. """
+    if STOCKS is not None and len(STOCKS) > 0:
+        rdd1 = spark.sparkContext.parallelize(STOCKS)
+        row_rdd = rdd1.map(lambda x: Row(x))
+        df = spark.createDataFrame(row_rdd,['Symbol'])
+    else:
+        df = spark.read.schema(STOCK_INFO_SCHEMA).csv(host+info_table_path, header=True)
+        if LIMIT is not None:
+            df = df.limit(LIMIT)
+    return df.select('Symbol').rdd.map(lambda r: r['Symbol']).collect()
+
+
+class WatermarkIndex(object):
+    """ Per-symbol watermarks of a short interests table.
+
+    Stored as a small JSON file next to the table: {'symbols': {symbol: {'last_date': ..,
+    'rows': .., 'status': .., 'misses': .., 'last_probe': ..}}, 'table_created': ..}. `rows`
+    is the number of rows ingested for the symbol, `status` is the result of its last fetch
+    ('ok', 'empty', 'invalid' when the body was not a dataset, or the HTTP status code),
+    `misses` counts the fetches in a row that found nothing ('404' or 'empty'), and
+    `last_probe` is the pull date of the last fetch.
+    `table_created` is the creation time of the table's transaction log when it was saved.
+
+    Symbols with `dormant_after` misses or more are dormant, and are only fetched again after
+    an interval that doubles with every further miss, up to `max_interval_days`.
+
+    The first time, the index is built from the table itself. After that, it is updated
+    after each appended batch so the next run reads it instead of scanning the table.
+
+    With `shard` ((index, count) tuple), the index only holds the symbols of that shard, in a
+    file of its own (see merge_shards). It starts as a slice of the table's index.
+
+    With `read_only`, an index built from the table is kept in memory, and `save` raises.
+    Jobs that only read the watermarks, like the quality checks, never write the file.
+    """
+    def __init__(self, host, table_path, dormant_after=5, max_interval_days=30, storage_format='csv', shard=None,
+                 read_only=False):
+        self.host = host
+        self.storage_format = storage_format
+        self.table_index_path = table_path + '_watermarks.json'
+        self.path = self.table_index_path if shard is None else shard_watermarks_path(table_path, shard)
+        self.shard = shard
+        self.table_path = table_path
+        self.dormant_after = dormant_after
+        self.max_interval_days = max_interval_days
+        self.symbols = {}
+        self.created = None
+        self.read_only = read_only
+
+    def table_created(self):
+        """ Creation time of the table's transaction log, None for a table without a log. """
+        log = TableLog(self.host, self.table_path, self.storage_format)
+        return log.created() if log.exists() else None
+
+    def load(self, table_exists=None):
+        """ Read the index, or build it from the table.
+
+        The index is only read if it was saved for the current table: its `table_created`
+        must be the creation time of the table's log, which changes when the table is
+        rewritten without the index (migrate_to_parquet, a wiped table).
+
+        Args:
+            - table_exists(bool): Whether the table exists, if already known.
+        Return:
+            bool, whether the table exists.
+        """
+        self.created = self.table_created()
+        if self.created is None and table_exists is None:
+            # Without a log, only a listing tells that the table is still there.
+            table_exists = spark_table_exists(self.host, self.table_path, self.storage_format)
+        if self.created is not None or table_exists:
+            paths = [self.path] if self.shard is None else [self.path, self.table_index_path]
+            for path in paths:
+                content = read_text_file(spark, self.host, path)
+                if content is None:
+                    continue
+                index = json.loads(content)
+                if index.get('table_created') != self.created:
+                    logger.warn("Watermark index {} was saved for another version of table {}".format(
+                        self.host+path, self.host+self.table_path))
+                    continue
+                self.symbols = index['symbols']
+                if path != self.path:
+                    self.symbols = {symbol: entry for symbol, entry in self.symbols.items()
+                                    if symbol_shard(symbol, self.shard[1]) == self.shard[0]}
+                return True
+
+        if table_exists is None:
+            table_exists = spark_table_exists(self.host, self.table_path, self.storage_format)
+        if table_exists:
+            logger.warn("Building watermark index {} from table {}".format(self.host+self.path, self.host+self.table_path))
+            short_sdf = read_short_interests(self.host, self.table_path, self.storage_format)
+            if self.shard is not None:
+                # Spark's crc32 of a string is the one of its UTF-8 bytes, like symbol_shard.
+                short_sdf = short_sdf.where((F.crc32(F.col('Symbol')) % self.shard[1]) == self.shard[0])
+            rows = short_sdf.groupBy('Symbol') \
+                            .agg(F.max('Date').alias('last_date'), F.count('*').alias('rows')) \
+                            .collect()
+            self.symbols = {row['Symbol']: {'last_date': str(row['last_date']), 'rows': row['rows'], 'status': 'ok'}
+                            for row in rows}
+            if not self.read_only:
+                self.save()
+        return table_exists
+
+    def last_dates(self):
+        return {symbol: entry['last_date'] for symbol, entry in self.symbols.items()
+                if entry.get('last_date') is not None}
+
+    def update(self, symbol, last_date=None, rows=0, status='ok', probe_date=None):
+        entry = self.symbols.setdefault(symbol, {'last_date': None, 'rows': 0, 'status': None})
+        if last_date is not None and (entry['last_date'] is None or a_before_b(entry['last_date'], last_date)):
+            entry['last_date'] = last_date
+        entry['rows'] += rows
+        entry['status'] = status
+        if status == 'ok':
+            entry['misses'] = 0
+        elif status == '404':
+            # Quandl does not know the symbol at all, so make it dormant right away.
+            entry['misses'] = max(entry.get('misses', 0) + 1, self.dormant_after)
+        elif status == 'empty':
+            entry['misses'] = entry.get('misses', 0) + 1
+        # Auth errors (401/403), server errors and replay cache misses say nothing about the
+        # symbol itself, so they leave `misses` alone and the symbol is fetched again next run.
+        if probe_date is not None:
+            entry['last_probe'] = probe_date
+
+    def next_probe_date(self, symbol):
+        """ Return the date from which a dormant symbol is fetched again, or None if it is not dormant. """
+        entry = self.symbols.get(symbol)
+        if entry is None or entry.get('misses', 0) < self.dormant_after or entry.get('last_probe') is None:
+            return None
+        interval = min(self.max_interval_days, 2 ** (entry['misses'] - self.dormant_after + 1))
+        last_probe = datetime.strptime(entry['last_probe'], "%Y-%m-%d")
+        return (last_probe + timedelta(days=interval)).strftime("%Y-%m-%d")
+
+    def save(self):
+        if self.read_only:
+            raise Exception("Watermark index {} was opened read-only".format(self.host+self.path))
+        if self.created is None and self.shard is None:
+            # The first append may have created the table since load.
+            self.created = self.table_created()
+        write_text_file(spark, self.host, self.path,
+                        json.dumps({'symbols': self.symbols, 'table_created': self.created}))
+
+
+def get_last_dates(host, short_interests_table_path, dormant_after=5, max_interval_days=30, storage_format='csv',
+                   shard=None):
+    """ Get the last date stored for each symbol, from the table's watermark index.
+
+    With `shard`, only the symbols of that shard are in the index (see WatermarkIndex).
+
+    Return:
+        tuple (table_exists, {symbol: last_date} or None, WatermarkIndex)
+    """
+    index = WatermarkIndex(host, short_interests_table_path, dormant_after, max_interval_days, storage_format, shard)
+    table_exists = index.load()
+
+    last_dates = None
+    if table_exists:
+        last_dates = index.last_dates()
+    return (table_exists, last_dates, index)
+
+
+def get_pull_start_date(symbol, table_exists, last_dates, start_date, pull_date):
+    """ Decide the start date of a symbol's request from its last date in the db.
+
+    Return:
+        start date string, or None when the db is already up to date.
+    """
+    if not table_exists or last_dates is None or symbol not in last_dates:
+        logger.warn("{}: pull data from all dates".format(symbol))
+        return start_date
+
+    # Get the last date of a stock. If there is no trading day after it up to pull_date, don't do anything.
+    date = last_dates[symbol]
+    if trading_days_between(date, pull_date) > 0:
+        return next_trading_day(date)
+    else:
+        logger.warn("{}: last date in db ({}) is the last trading day up to pull date ({}), so do nothing.".format(symbol, date, pull_date))
+        return None
+
+
+def get_due_start_dates(symbols, table_exists, last_dates, watermarks, start_date, pull_date):
+    """ Get the start date of every symbol to fetch in this run.
+
+    Symbols that are up to date, and dormant symbols that are not due for a probe, are left out.
+
+    Return:
+        dict {symbol: start_date}
+    """
+    start_dates = {}
+    num_dormant = 0
+    for symbol in symbols:
+        next_probe = watermarks.next_probe_date(symbol)
+        if next_probe is not None and a_before_b(pull_date, next_probe):
+            num_dormant += 1
+            continue
+        symbol_start_date = get_pull_start_date(symbol, table_exists, last_dates, start_date, pull_date)
+        if symbol_start_date is not None:
+            start_dates[symbol] = symbol_start_date
+    logger.warn("{} symbols to fetch, {} dormant symbols skipped until their next probe.".format(len(start_dates), num_dormant))
+    return start_dates
+
+
+# ----------------
+# Symbol shards
+# ----------------
+# The pull of an exchange can be split into tasks that run in parallel, one per shard of the
+# symbols. A shard is an (index, count) tuple, and holds the symbols whose crc32 modulo count
+# is index. The shards do not write into the table: each one appends its rows into its own
+# staging directory and keeps its own watermark index, both in `<table_path>_shards`. Once
+# all shards are done, merge_shards adds them to the table, as its only writer.
+
+def symbol_shard(symbol, num_shards):
+    return zlib.crc32(symbol.encode('utf-8')) % num_shards
+
+
+def shard_symbols(symbols, shard=None):
+    """ The symbols of `shard`, all of them without shard. """
+    if shard is None:
+        return symbols
+    return [symbol for symbol in symbols if symbol_shard(symbol, shard[1]) == shard[0]]
+
+
+def shards_path(table_path):
+    return table_path + '_shards'
+
+
+def shard_stage_path(table_path, shard):
+    return '{}/shard-{}-of-{}'.format(shards_path(table_path), shard[0], shard[1])
+
+
+def shard_watermarks_path(table_path, shard):
+    return '{}/watermarks-shard-{}-of-{}.json'.format(shards_path(table_path), shard[0], shard[1])
+
+
+def store_pulled_rows(sdf, host, table_path, storage_format='csv', use_log=True, shard=None):
+    """ Add newly pulled rows to a raw short interests table, or to the staging directory of `shard`. """
+    if shard is None:
+        append_short_interests(sdf, host, table_path, storage_format, use_log)
+    else:
+        write_short_interests(sdf, host, shard_stage_path(table_path, shard), storage_format)
+
+
+def merge_shards(host, table_path, num_shards, storage_format='csv', use_log=True):
+    """ Add the rows and watermarks pulled by the shards of a table to the table.
+
+    The staged rows are added in one append (see append_short_interests), then the
+    watermark indexes of the `num_shards` shards replace their symbols in the table's
+    index, and `<table_path>_shards` is deleted. If this stops in the middle, running it
+    again appends the same rows again, which only the transaction log (`use_log`) dedupes.
+    """
+    fs = get_fs(spark, host)
+    Path = sc._jvm.org.apache.hadoop.fs.Path
+    if not fs.exists(Path(host+shards_path(table_path))):
+        return
+
+    staged = sorted(f.getPath().getName() for f in fs.listStatus(Path(host+shards_path(table_path))) if f.isDirectory())
+    if len(staged) > 0:
+        if storage_format == 'parquet' and is_csv_table(host, table_path):
+            migrate_to_parquet(host, table_path)
+        if storage_format == 'parquet' and spark_table_exists(host, table_path, storage_format):
+            upgrade_parquet_table(host, table_path, use_log)
+
+    index = WatermarkIndex(host, table_path, storage_format=storage_format)
+    content = read_text_file(spark, host, index.path)
+    index.symbols = {}
+    # An index saved for another version of the table is stale. The shards then rebuilt their
+    # symbols from the table, so the merged index only keeps theirs.
+    if content is not None and json.loads(content).get('table_created') == index.table_created():
+        index.symbols = json.loads(content)['symbols']
+
+    if len(staged) > 0:
+        sdf = None
+        for name in staged:
+            sdf_shard = read_short_interests(host, shards_path(table_path) + '/' + name, storage_format)
+            sdf = sdf_shard if sdf is None else sdf.unionByName(sdf_shard)
+        append_short_interests(sdf, host, table_path, storage_format, use_log)
+        logger.warn("Added the rows of {} shards to {}".format(len(staged), host+table_path))
+
+    num_merged = 0
+    for shard_index in range(num_shards):
+        content = read_text_file(spark, host, shard_watermarks_path(table_path, (shard_index, num_shards)))
+        if content is not None:
+            index.symbols.update(json.loads(content)['symbols'])
+            num_merged += 1
+    if num_merged > 0:
+        index.save()
+    fs.delete(Path(host+shards_path(table_path)), True)
+    logger.warn("Merged the watermarks of {} shards into {}".format(num_merged, host+index.path))
+
+
+class StatusAccumulatorParam(AccumulatorParam):
+    """ Collect {symbol: fetch status} from the executors. """
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, value1, value2):
+        value1.update(value2)
+        return value1
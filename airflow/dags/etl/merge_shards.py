@@ -0,0 +1,7 @@
+# Fan-in of the Pull_short_interest_data tasks: when the pull of an exchange is split into
+# shards, add the rows and watermarks pulled by every shard to the exchange's table.
+
+for table_path in [TABLE_SHORT_INTERESTS_NASDAQ, TABLE_SHORT_INTERESTS_NYSE]:
+    merge_shards(DB_HOST, table_path, PULL_SHARDS, STORAGE_FORMAT, TABLE_LOG)
+
+logger.warn("done!")
@@ -0,0 +1,14 @@
+# One-time migration of the raw short interests tables from CSV to Parquet, and of Parquet
+# tables written before the schema registry to its exact types.
+# The pull jobs also run it by themselves on their first run with STORAGE_FORMAT=parquet.
+# Tables are only rewritten to the exact types with TABLE_LOG (see compact_table).
+
+for table_path in [TABLE_SHORT_INTERESTS_NASDAQ, TABLE_SHORT_INTERESTS_NYSE]:
+    if is_csv_table(DB_HOST, table_path):
+        migrate_to_parquet(DB_HOST, table_path)
+    else:
+        logger.warn("{} is not a CSV table, nothing to migrate.".format(DB_HOST+table_path))
+    if spark_table_exists(DB_HOST, table_path, 'parquet'):
+        upgrade_parquet_table(DB_HOST, table_path, TABLE_LOG)
+
+logger.warn("done!")
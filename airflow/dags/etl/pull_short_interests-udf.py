@@ -1,98 +1,142 @@
-# Use UDF to run requests GET on slave nodes.
+# Distributed fetch mode: run GET requests on executor nodes.
+#
+# Symbols are partitioned across the executors, and each partition reuses one HTTP session.
+# Only rows newer than a symbol's last date in the db are kept, so retrying the task or
+# re-running it for the same PULL_DATE never appends the same (Symbol, Date) twice.
+# Progress flows back to the driver through accumulators after every chunk of symbols.
 
+def make_partition_fetcher(exchange, pull_date, api_key, last_dates_bc, symbols_acc, rows_acc, failed_acc,
+                           statuses_acc, partition_rate, max_rounds=5):
+    """ Build the function that each executor runs over its partition of (symbol, start_date) pairs.
 
-def convert_data(olddata, symbol, url):
-    col_names = olddata['dataset']['column_names']
-    col_names.append('Symbol')
-    col_names.append('SourceURL')
-    col_names_multiplied = [col_names] * len(olddata['dataset']['data'])
-    newdata = []
-    for i, cols in enumerate(col_names_multiplied):
-        datum = olddata['dataset']['data'][i]
-        datum.append(symbol)
-        datum.append(url)
-        newdata.append(dict(zip(cols, datum)))
-    return newdata
+    Everything the function needs is passed in explicitly, so it does not depend on globals
+    that only exist on the driver. Each partition gets its own share (`partition_rate`) of the
+    Quandl rate limit, and symbols throttled by Quandl are retried at the end of the partition.
+    """
+    def fetch_partition(pairs):
+        http = requests.Session()
+        limiter = RateLimiter(partition_rate, 1)
+        seen = set()
+        pending = list(pairs)
+        for round_num in range(max_rounds):
+            throttled = []
+            for symbol, start_date in pending:
+                url = 'https://www.quandl.com/api/v3/datasets/FINRA/{}_{}?start_date={}&end_date={}&api_key={}' \
+                      .format(exchange, symbol, start_date, pull_date, api_key)
+                try:
+                    response = limited_get(http, url, limiter)
+                except ThrottledError:
+                    throttled.append((symbol, start_date))
+                    continue
+                symbols_acc.add(1)
+                if response.status_code not in [200, 201]:
+                    failed_acc.add(1)
+                    statuses_acc.add({symbol: str(response.status_code)})
+                    continue
 
+                try:
+                    dataset = response.json()['dataset']
+                except (ValueError, KeyError, TypeError):
+                    # An HTML error page or a truncated body, only this symbol failed.
+                    failed_acc.add(1)
+                    statuses_acc.add({symbol: 'invalid'})
+                    continue
+                col_idx = {name: i for i, name in enumerate(dataset['column_names'])}
+                last_date = last_dates_bc.value.get(symbol)
+                num_rows = 0
+                for datum in dataset['data']:
+                    date = datum[col_idx['Date']]
+                    # The request starts at the last date in the db, so skip what we already have.
+                    if last_date is not None and date <= last_date:
+                        continue
+                    if (symbol, date) in seen:
+                        continue
+                    seen.add((symbol, date))
+                    rows_acc.add(1)
+                    num_rows += 1
+                    yield (parse_date(date),
+                           to_count(datum[col_idx['ShortExemptVolume']]),
+                           to_count(datum[col_idx['ShortVolume']]),
+                           url,
+                           symbol,
+                           to_count(datum[col_idx['TotalVolume']]))
+                statuses_acc.add({symbol: 'ok' if num_rows > 0 else 'empty'})
+            pending = throttled
+            if len(pending) == 0:
+                break
+        # Still throttled after all rounds. The next run picks them up from their last date.
+        symbols_acc.add(len(pending))
+        failed_acc.add(len(pending))
+        http.close()
+    return fetch_partition
 
-def pull_short_interests(exchange, host, info_table_path, short_interests_table_path):
 
-    create_table = not(spark_table_exists(host, short_interests_table_path))
-        
-    def pull_exchange_short_interests_by_symbol(symbol):
-        """
-        Return:
-            list of dicts [{'colname': value, ...}, ...]
-        """
-        if create_table == True:
-            # If table does not exist, pull all data.
-            url = 'https://www.quandl.com/api/v3/datasets/FINRA/'+exchange+'_{}?start_date='+START_DATE+'&end_date='+YESTERDAY_DATE+'&api_key='+QUANDL_API_KEY
-        else:
-            # If table had existed, pull yesterday's data.
-            url = 'https://www.quandl.com/api/v3/datasets/FINRA/'+exchange+'_{}?start_date='+YESTERDAY_DATE+'&end_date='+YESTERDAY_DATE+'&api_key='+QUANDL_API_KEY
+def pull_short_interests(exchange, host, info_table_path, short_interests_table_path, log_every_n=100, max_rate=20,
+                         shard=None):
+    """
+    Args:
+        - shard(tuple): (index, count) to only pull that shard of the symbols (see merge_shards).
+    """
+    if not is_trading_day(PULL_DATE):
+        logger.warn("{} is not a trading day, nothing to pull from exchange {}.".format(PULL_DATE, exchange))
+        return
 
-        url = url.format(symbol)
-        response = requests.get(url)
-        newdata = []
-        if response.status_code in [200, 201]:
-            newdata = convert_data(response.json(), symbol, url)
-        return newdata
+    sc = spark.sparkContext
+    num_partitions = sc.defaultParallelism
 
-    
-    # [{'colname': value, ...}, ...]
-    schema = T.ArrayType(
-                T.MapType(
-                    T.StringType(), T.StringType()
-                )
-             )
-    udf_pull_exchange_short_interests = F.udf(pull_exchange_short_interests_by_symbol, schema)
-
-    # Prepare list of stocks
-    if STOCKS is not None and len(STOCKS) > 0:
-        rdd1 = spark.sparkContext.parallelize(STOCKS)
-        row_rdd = rdd1.map(lambda x: Row(x))
-        df = spark.createDataFrame(row_rdd,['Symbol'])
+    table_format = STORAGE_FORMAT
+    if shard is not None:
+        # Only Merge_shards changes the table, the migrations included.
+        table_format = 'csv' if is_csv_table(host, short_interests_table_path) else STORAGE_FORMAT
     else:
-        df = spark.read.parquet(host+info_table_path)
-        if LIMIT is not None:
-            df = df.limit(LIMIT)
+        if STORAGE_FORMAT == 'parquet' and is_csv_table(host, short_interests_table_path):
+            migrate_to_parquet(host, short_interests_table_path)
+        if STORAGE_FORMAT == 'parquet' and spark_table_exists(host, short_interests_table_path, STORAGE_FORMAT):
+            upgrade_parquet_table(host, short_interests_table_path, TABLE_LOG)
 
-    df = df.withColumn('short_interests', udf_pull_exchange_short_interests('Symbol'))
+    symbols = shard_symbols(get_symbols(host, info_table_path), shard)
+    table_exists, last_dates, watermarks = get_last_dates(host, short_interests_table_path,
+                                                         DORMANT_AFTER_MISSES, DORMANT_MAX_INTERVAL_DAYS, table_format,
+                                                         shard=shard)
+    if last_dates is None:
+        last_dates = {}
 
-    # Convert [short_interests: [{col: val, ...}, ...]] to
-    # [{col: val, ...}, ...]
-    df = df.select(F.explode(df['short_interests']).alias('col')) \
-         .rdd.map(lambda x: x['col'])
+    pairs = list(get_due_start_dates(symbols, table_exists, last_dates, watermarks, START_DATE, PULL_DATE).items())
 
-    df_schema = T.StructType([T.StructField('Date', T.StringType(), False),
-                              T.StructField('ShortExemptVolume', T.StringType(), True),
-                              T.StructField('ShortVolume', T.StringType(), True),
-                              T.StructField('Symbol', T.StringType(), False),
-                              T.StructField('TotalVolume', T.StringType(), True),
-                              T.StructField('SourceURL', T.StringType(), True),
-                             ])
-    df = spark.createDataFrame(df, df_schema)
-    df = df.withColumn('Date', df['Date'].cast(T.DateType())) \
-         .withColumn('ShortExemptVolume', df['ShortExemptVolume'].cast(T.DoubleType())) \
-         .withColumn('ShortVolume', df['ShortVolume'].cast(T.DoubleType())) \
-         .withColumn('TotalVolume', df['TotalVolume'].cast(T.DoubleType()))
+    symbols_acc = sc.accumulator(0)
+    rows_acc = sc.accumulator(0)
+    failed_acc = sc.accumulator(0)
+    last_dates_bc = sc.broadcast(last_dates)
 
-    if create_table:
-        logger.warn("Creating table {}".format(host+short_interests_table_path))
-        df.write.mode('overwrite').format('csv').save(host+short_interests_table_path, header=True)
-    else:
-        logger.warn("Appending to table {}".format(host+short_interests_table_path))
-        df.write.mode('append').format('csv').save(host+short_interests_table_path, header=True)
-        
-        # Drop duplicates later when we combine the datasets:
-        # 1. We do not want to waste S3 bandwidth.
-        # 2. Raw data are meant to be dirty. We are going to use only the final dataset for analysis.
-        # 3. If we really want to clean the datasets. Create another DAG for that.
-        # code:
-#         spark.read.parquet(host+short_interests_table_path).dropDuplicates(['Date']) \
-#         .write.mode('append').parquet(host+short_interests_table_path)
-        
+    # One Spark job per chunk, so that data are stored and progress is reported as we go.
+    chunk_size = log_every_n * num_partitions
+    for chunk_start in range(0, len(pairs), chunk_size):
+        chunk = pairs[chunk_start:chunk_start+chunk_size]
+        statuses_acc = sc.accumulator({}, StatusAccumulatorParam())
+        fetcher = make_partition_fetcher(exchange, PULL_DATE, QUANDL_API_KEY, last_dates_bc,
+                                         symbols_acc, rows_acc, failed_acc, statuses_acc,
+                                         partition_rate=float(max_rate) / num_partitions)
+        rdd = sc.parallelize(chunk, min(num_partitions, len(chunk))).mapPartitions(fetcher)
+        # Cached so that the watermark aggregation below does not send the requests again.
+        sdf_to_write = spark.createDataFrame(rdd, SHORT_INTERESTS_SCHEMA).cache()
+        store_pulled_rows(sdf_to_write, host, short_interests_table_path, STORAGE_FORMAT, TABLE_LOG, shard)
+
+        stats = {row['Symbol']: row for row in
+                 sdf_to_write.groupBy('Symbol').agg(F.max('Date').alias('last_date'), F.count('*').alias('rows')).collect()}
+        for symbol, status in statuses_acc.value.items():
+            if symbol in stats:
+                watermarks.update(symbol, str(stats[symbol]['last_date']), stats[symbol]['rows'], status, PULL_DATE)
+            else:
+                watermarks.update(symbol, status=status, probe_date=PULL_DATE)
+        watermarks.save()
+        sdf_to_write.unpersist()
+
+        logger.warn("storing data downloaded from exchange {} - {}/{} symbols - total rows: {} - failed requests: {}" \
+                    .format(exchange, symbols_acc.value, len(pairs), rows_acc.value, failed_acc.value))
+
+    last_dates_bc.unpersist()
     logger.warn("done!")
 
-pull_short_interests('FNSQ', DB_HOST, TABLE_STOCK_INFO_NASDAQ, TABLE_SHORT_INTERESTS_NASDAQ)
-pull_short_interests('FNYX', DB_HOST, TABLE_STOCK_INFO_NYSE, TABLE_SHORT_INTERESTS_NYSE)
\ No newline at end of file
+# Each task of the DAG pulls one exchange, or one shard of its symbols.
+pull_short_interests(EXCHANGE, DB_HOST, TABLE_STOCK_INFO, TABLE_SHORT_INTERESTS, max_rate=QUANDL_RATE_LIMIT,
+                     shard=None if PULL_SHARDS == 1 else (PULL_SHARD, PULL_SHARDS))
@@ -1,113 +1,123 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def a_before_b(a, b):
-    date_format = "%Y-%m-%d"
 
-    # create datetime objects from the strings
-    da = datetime.strptime(a, date_format)
-    db = datetime.strptime(b, date_format)
+def pull_short_interests(exchange, host, info_table_path, short_interests_table_path, log_every_n=100, concurrency=16,
+                         max_rate=20, max_rounds=5, flush_policy=None, shard=None):
+    """
+    Args:
+        - log_every_n(int): Log the progress every n symbols.
+        - flush_policy(FlushPolicy): When to write the downloaded data. Defaults to FlushPolicy().
+        - shard(tuple): (index, count) to only pull that shard of the symbols (see merge_shards).
+    """
+    if flush_policy is None:
+        flush_policy = FlushPolicy()
+    if not is_trading_day(PULL_DATE):
+        logger.warn("{} is not a trading day, nothing to pull from exchange {}.".format(PULL_DATE, exchange))
+        return
 
-    if da < db:
-        return True
-    else:
-        return False
-    
-
-def rowlist2dict(rowlist):
-    obj = {}
-    for row in rowlist:
-        obj[row['Symbol']] = row['last_date']
-    return obj
-
-
-def convert_data(olddata, symbol, url):
-    col_names = olddata['dataset']['column_names']
-    col_names.append('Symbol')
-    col_names.append('SourceURL')
-    col_names_multiplied = [col_names] * len(olddata['dataset']['data'])
-    newdata = []
-    for i, cols in enumerate(col_names_multiplied):
-        datum = olddata['dataset']['data'][i]
-        datum.append(symbol)
-        datum.append(url)
-        newdata.append(Row(**dict(zip(cols, datum))))
-    return newdata
+    http = make_http_session(concurrency)
+    limiter = RateLimiter(max_rate, concurrency)
+    # Responses are cached so that a retried task does not download everything again.
+    cache = make_response_cache()
+    if cache is not None:
+        logger.warn("Deleted {} expired responses from the cache.".format(cache.sweep()))
 
-
-def pull_short_interests(exchange, host, info_table_path, short_interests_table_path, log_every_n=100):
-        
     def pull_exchange_short_interests_by_symbol(symbol, start_date, end_date):
         """
         Return:
-            list of dicts [{'colname': value, ...}, ...]
+            tuple (status_code, response json or None, url)
         """
-        url = 'https://www.quandl.com/api/v3/datasets/FINRA/'+exchange+'_{}?start_date='+start_date+'&end_date='+end_date+'&api_key='+QUANDL_API_KEY
-        url = url.format(symbol)
-        response = requests.get(url)
-        newdata = []
-        if response.status_code in [200, 201]:
-            newdata = convert_data(response.json(), symbol, url)
-        return newdata
+        return fetch_quandl(http, limiter, cache, exchange, symbol, start_date, end_date)
 
-    # Prepare list of stocks
-    if STOCKS is not None and len(STOCKS) > 0:
-        rdd1 = spark.sparkContext.parallelize(STOCKS)
-        row_rdd = rdd1.map(lambda x: Row(x))
-        df = spark.createDataFrame(row_rdd,['Symbol'])
+    table_format = STORAGE_FORMAT
+    if shard is not None:
+        # Only Merge_shards changes the table, the migrations included.
+        table_format = 'csv' if is_csv_table(host, short_interests_table_path) else STORAGE_FORMAT
     else:
-        df = spark.read.csv(host+info_table_path, header=True)
-        if LIMIT is not None:
-            df = df.limit(LIMIT)
-    symbols = df.select('Symbol').rdd.map(lambda r: r['Symbol']).collect()
-    
-    table_exists = spark_table_exists(host, short_interests_table_path)
+        if STORAGE_FORMAT == 'parquet' and is_csv_table(host, short_interests_table_path):
+            migrate_to_parquet(host, short_interests_table_path)
+        if STORAGE_FORMAT == 'parquet' and spark_table_exists(host, short_interests_table_path, STORAGE_FORMAT):
+            upgrade_parquet_table(host, short_interests_table_path, TABLE_LOG)
+
+    symbols = shard_symbols(get_symbols(host, info_table_path), shard)
+    table_exists, last_dates, watermarks = get_last_dates(host, short_interests_table_path,
+                                                         DORMANT_AFTER_MISSES, DORMANT_MAX_INTERVAL_DAYS, table_format,
+                                                         shard=shard)
+
+    # Watermark logic runs on the driver thread, the GET requests run in the pool.
+    start_dates = get_due_start_dates(symbols, table_exists, last_dates, watermarks, START_DATE, PULL_DATE)
 
-    last_dates = None
-    if table_exists:
-        short_sdf = spark.read.csv(host+short_interests_table_path, header=True)
-        last_dates = short_sdf.groupBy('Symbol').agg(F.max('Date').alias('last_date')).collect()
-        last_dates = rowlist2dict(last_dates)
-        
     total_rows = 0
-    data_to_write = []
-    for i, symbol in enumerate(symbols):
-        data = []
-        if table_exists:
-            # Get the last date of a stock. If this last date >= PULL_DATE, don't do anything.
-            if last_dates != None:
-                if symbol in last_dates:
-                    date = last_dates[symbol]
-                    if a_before_b(date, PULL_DATE):
-                        data = pull_exchange_short_interests_by_symbol(symbol, date, PULL_DATE)
-                        if len(data)==0:
-                            logger.warn("{}: last date in db ({}) is before pull date ({}) and data exist. Hold the data in memory for storing to db.".format(symbol, date, PULL_DATE))
-                        else:
-                            logger.warn("{}: last date in db ({}) is before pull date ({}) but no data newer than last date is available in Quandl.".format(symbol, date, PULL_DATE))
-                    else:
-                        logger.warn("{}: last date in db ({}) is after pull date ({}), so do nothing.".format(symbol, date, PULL_DATE))
+    data_to_write = ShortInterestsBatch()
+    # Watermark updates of the symbols whose data are held in data_to_write.
+    watermark_updates = []
+    pending = start_dates
+    for round_num in range(max_rounds):
+        # Symbols throttled by Quandl are requeued for the next round instead of being dropped.
+        throttled = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(pull_exchange_short_interests_by_symbol, symbol, start_date, PULL_DATE): symbol
+                       for symbol, start_date in pending.items()}
+            for i, future in enumerate(as_completed(futures)):
+                symbol = futures[future]
+                try:
+                    status_code, body, url = future.result()
+                except ThrottledError as e:
+                    logger.warn("{}: throttled by Quandl or timed out ({}), requeued.".format(symbol, e.status_code))
+                    throttled[symbol] = pending[symbol]
+                    num_rows = 0
                 else:
-                    logger.warn("{}: pull data from all dates".format(symbol))
-                    data = pull_exchange_short_interests_by_symbol(symbol, START_DATE, PULL_DATE)
-            else:
-                logger.warn("{}: pull data from all dates".format(symbol))
-                data = pull_exchange_short_interests_by_symbol(symbol, START_DATE, PULL_DATE)
-        else:
-            data = pull_exchange_short_interests_by_symbol(symbol, START_DATE, PULL_DATE)
-        
-        if len(data) > 0:
-            data_to_write += data
+                    num_rows, last_date = (0, None)
+                    if status_code in [200, 201] and body is not None:
+                        # The request starts at the last date in the db, so skip what we already have.
+                        after_date = last_dates.get(symbol) if last_dates is not None else None
+                        num_rows, last_date = data_to_write.add_response(body, symbol, url, after_date=after_date)
+                    if num_rows > 0:
+                        watermark_updates.append((symbol, last_date, num_rows, 'ok', PULL_DATE))
+                    else:
+                        if status_code in [200, 201]:
+                            # A body that is not a dataset is a failed fetch, not an empty one.
+                            status = 'empty' if body is not None else 'invalid'
+                        else:
+                            status = str(status_code)
+                        watermark_updates.append((symbol, None, 0, status, PULL_DATE))
+
+                    if last_dates is not None and symbol in last_dates:
+                        if num_rows > 0:
+                            logger.warn("{}: last date in db ({}) is before pull date ({}) and data exist. Hold the data in memory for storing to db.".format(symbol, last_dates[symbol], PULL_DATE))
+                        else:
+                            logger.warn("{}: last date in db ({}) is before pull date ({}) but no data newer than last date is available in Quandl.".format(symbol, last_dates[symbol], PULL_DATE))
+
+                total_rows += num_rows
+                is_last = (i+1) == len(futures)
+                if (i%log_every_n == 0 or is_last):
+                    logger.warn("downloaded from exchange {} - {}/{} - total rows: {} - rows in memory: {}".format(exchange, i+1, len(futures), total_rows, len(data_to_write)))
+                if is_last or flush_policy.should_flush(data_to_write):
+                    if len(data_to_write) > 0:
+                        sdf_to_write = data_to_write.to_spark(spark)
+                        store_pulled_rows(sdf_to_write, host, short_interests_table_path, STORAGE_FORMAT, TABLE_LOG, shard)
+                        logger.warn("Written {} rows to {}".format(len(data_to_write), host+short_interests_table_path))
+                        data_to_write.clear()
+                    flush_policy.flushed()
+                    # Only move the watermarks once the batch has been appended.
+                    if len(watermark_updates) > 0:
+                        for update in watermark_updates:
+                            watermarks.update(*update)
+                        watermarks.save()
+                        watermark_updates = []
 
-        total_rows += len(data)
-        if (i%log_every_n == 0 or (i+1) == len(symbols)):
-            logger.warn("storing data downloaded from exchange {} - {}/{} - total rows in this batch: {}".format(exchange, i+1, len(symbols), total_rows))
-            if len(data_to_write) > 0:
-                sdf_to_write = spark.createDataFrame(data_to_write)
-                sdf_to_write.write.mode('append').format('csv').save(host+short_interests_table_path, header=True)
-                logger.warn("Written {} rows to {}".format(len(data_to_write), host+short_interests_table_path))
-                data_to_write = []
+        if len(throttled) == 0:
+            break
+        logger.warn("{} symbols were throttled, retrying them (round {}/{}).".format(len(throttled), round_num+2, max_rounds))
+        pending = throttled
 
+    if len(throttled) > 0:
+        logger.warn("{} symbols are still throttled and will be pulled in the next run: {}".format(len(throttled), list(throttled)))
 
+    http.close()
     logger.warn("done!")
 
-pull_short_interests('FNSQ', DB_HOST, TABLE_STOCK_INFO_NASDAQ, TABLE_SHORT_INTERESTS_NASDAQ)
-pull_short_interests('FNYX', DB_HOST, TABLE_STOCK_INFO_NYSE, TABLE_SHORT_INTERESTS_NYSE)
\ No newline at end of file
+# Each task of the DAG pulls one exchange, or one shard of its symbols.
+pull_short_interests(EXCHANGE, DB_HOST, TABLE_STOCK_INFO, TABLE_SHORT_INTERESTS, concurrency=FETCH_CONCURRENCY, max_rate=QUANDL_RATE_LIMIT,
+                     log_every_n=LOG_EVERY_N, flush_policy=FlushPolicy(FLUSH_MAX_ROWS, FLUSH_MAX_MB*1024*1024, FLUSH_MAX_SECONDS),
+                     shard=None if PULL_SHARDS == 1 else (PULL_SHARD, PULL_SHARDS))
@@ -1,39 +1,128 @@
-# 1. Latest available date in the database should be the same with newest_available_date in Quandl.
-# 2. Short volume for that date should be the same too.
-
-from datetime import datetime
-import numpy as np
-
-nasdaq_sdf = check_basic_quality(logger, DB_HOST, TABLE_SHORT_INTERESTS_NASDAQ)
-nyse_sdf = check_basic_quality(logger, DB_HOST, TABLE_SHORT_INTERESTS_NYSE)
-
-# Get the last date in short interests
-logger.warn("PULL DATE: {}".format(PULL_DATE))
-
-def check_data_quality(sdf, exchange):
-    # row = sdf.agg({"Date": "max"}).first()
-    row = sdf.orderBy([F.col('Date').desc()]).first()
-    logger.warn("row: {}".format(row))
-    lastdate = row['Date']
-    url = row['SourceURL']
-    response_json = requests.get(url).json()
-    newest_available_date = response_json['dataset']['newest_available_date']
-    symbol = row['Symbol']
-
-    logger.warn("{}/{} short interest latest date: {}. Quandl newest_available_date: {}".format(exchange, symbol, lastdate, newest_available_date))
-    if lastdate == newest_available_date:
-        logger.warn("(SUCCESS) Latest date in database equals Quandl's latest available date.")
-    else:
-        logger.warn("(FAIL) Latest date in database does not equal Quandl's latest available date. Make sure data are saved and the PULL_DATE is correct.")
+# 1. Every check of the rows pulled since the last quality check, in one aggregation over both
+#    exchanges: row counts, latest dates, missing values, negative volumes and short volumes above
+#    the total volume. The metrics are kept next to each table and compared with the previous runs.
+# 2. The full history of a stratified sample of the symbols of each exchange (RECONCILE_SAMPLE_FRACTION,
+#    at least RECONCILE_MIN_SYMBOLS) should match Quandl's, date by date.
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import math
+
+logger.warn("PULL DATE: {}. Last trading day up to the pull date: {}".format(PULL_DATE, previous_trading_day(PULL_DATE, inclusive=True)))
+
+
+def check_new_rows(tables):
+    """
+    Args:
+        - tables(dict): {exchange: table path}
+    """
+    stores = {}
+    sources = {}
+    new_rows = None
+    for exchange, table_path in tables.items():
+        # Existence and row count come from the transaction log, without reading the table.
+        if check_basic_quality(logger, DB_HOST, table_path, STORAGE_FORMAT) is None:
+            continue
+        stores[exchange] = QualityMetrics(DB_HOST, table_path).load()
+        dates, sources[exchange] = get_new_dates(DB_HOST, [table_path], STORAGE_FORMAT, stores[exchange].sources)
+        if dates is None:
+            logger.warn("{}: checking every row of {}".format(exchange, DB_HOST+table_path))
+        elif len(dates) == 0:
+            logger.warn("{}: no new rows since the last check.".format(exchange))
+            continue
+        else:
+            logger.warn("{}: checking the rows of {} dates ({} to {})".format(exchange, len(dates), dates[0], dates[-1]))
+        sdf = read_short_interests_dates(DB_HOST, table_path, STORAGE_FORMAT, dates) \
+                  .withColumn('Exchange', F.lit(exchange))
+        new_rows = sdf if new_rows is None else new_rows.unionByName(sdf)
+
+    if new_rows is None:
+        return
+    metrics = short_interests_metrics(new_rows, 'Exchange')
+    for exchange, values in sorted(metrics.items()):
+        logger.warn("{}: {} new rows for {} symbols, from {} to {}.".format(
+            exchange, values['rows'], values['symbols'], values['min_date'], values['max_date']))
+        if a_before_b(PULL_DATE, values['max_date']):
+            logger.warn("(FAIL) {}: rows dated after the pull date ({}).".format(exchange, values['max_date']))
+        evaluate_metrics(logger, exchange, values, stores[exchange])
+        stores[exchange].add(PULL_DATE, values, sources[exchange])
+        stores[exchange].save()
+
+    latest_dates = set(values['max_date'] for values in metrics.values())
+    if len(metrics) > 1 and len(latest_dates) > 1:
+        logger.warn("(FAIL) The exchanges have different latest dates: {}".format(
+            {exchange: values['max_date'] for exchange, values in metrics.items()}))
+
 
-    short_volume_data = float(row['ShortVolume'])
-    short_volume_url = float(response_json['dataset']['data'][0][1])
-    logger.warn("short_volume_data: {}, short_volume_url: {}".format(short_volume_data, short_volume_url))
-    if np.isclose(short_volume_data, short_volume_url):
-        logger.warn("(SUCCESS) Same short interest volume ({})".format(short_volume_data))
+check_new_rows({'NASDAQ': TABLE_SHORT_INTERESTS_NASDAQ, 'NYSE': TABLE_SHORT_INTERESTS_NYSE})
+
+def reconcile_sample(exchange, code, table_path, fraction, min_symbols, concurrency):
+    """ Compare the full history of a stratified sample of symbols with Quandl.
+
+    Args:
+        - code(str): Quandl code of the exchange ('FNSQ' or 'FNYX').
+        - fraction(float): Share of the exchange's symbols to sample.
+        - min_symbols(int): Sample at least this many symbols.
+    """
+    # The pulls own the index, this job must not write or rebuild it.
+    watermarks = WatermarkIndex(DB_HOST, table_path, storage_format=STORAGE_FORMAT, read_only=True)
+    watermarks.load()
+    last_dates = watermarks.last_dates()
+    if len(last_dates) == 0:
+        logger.warn("(FAIL) {}: no symbols to reconcile.".format(exchange))
+        return
+    sizes = {symbol: watermarks.symbols[symbol].get('rows', 0) for symbol in last_dates}
+    num_symbols = max(min_symbols, int(math.ceil(fraction * len(sizes))))
+    sample = stratified_sample(sizes, num_symbols, seed=PULL_DATE+exchange)
+    logger.warn("{}: reconciling {} of {} symbols with Quandl.".format(exchange, len(sample), len(sizes)))
+
+    lake_rows = {symbol: [] for symbol in sample}
+    for row in read_short_interests_symbols(DB_HOST, table_path, STORAGE_FORMAT, sample) \
+                   .select('Symbol', 'Date', 'ShortExemptVolume', 'ShortVolume', 'TotalVolume').collect():
+        lake_rows[row['Symbol']].append(row)
+
+    def reconcile(symbol):
+        status_code, body, url = fetch_quandl(http, limiter, cache, code, symbol, START_DATE, last_dates[symbol])
+        if status_code not in [200, 201]:
+            return (symbol, 'HTTP {}'.format(status_code), None)
+        if body is None:
+            return (symbol, 'HTTP {} without a dataset'.format(status_code), None)
+        return (symbol, None, reconcile_symbol(body, lake_rows[symbol], START_DATE, last_dates[symbol]))
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(reconcile, symbol) for symbol in sample]
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except ThrottledError as e:
+                logger.warn("{}: throttled by Quandl ({}), not reconciled.".format(exchange, e.status_code))
+
+    header = ['symbol', 'last_date', 'quandl_rows', 'lake_rows', 'missing', 'extra', 'mismatched', 'status']
+    rows = []
+    num_failed = 0
+    for symbol, error, counts in sorted(results, key=lambda result: result[0]):
+        if counts is None:
+            rows.append([symbol, last_dates[symbol], '-', len(lake_rows[symbol]), '-', '-', '-', error])
+            continue
+        differs = counts['missing'] + counts['extra'] + counts['mismatched'] > 0
+        num_failed += 1 if differs else 0
+        rows.append([symbol, last_dates[symbol], counts['quandl_rows'], counts['lake_rows'], counts['missing'],
+                     counts['extra'], counts['mismatched'], 'differs' if differs else 'ok'])
+    for line in format_table(header, rows):
+        logger.warn("{}: {}".format(exchange, line))
+
+    if num_failed > 0:
+        logger.warn("(FAIL) {}: {} of {} sampled symbols differ from Quandl.".format(exchange, num_failed, len(results)))
     else:
-        logger.warn("(FAIL) short interest volume in the database: {}, in the url: {}".format(short_volume_data, short_volume_url))
+        logger.warn("(SUCCESS) {}: all {} reconciled symbols match Quandl.".format(exchange, len(results)))
+
 
+http = make_http_session(FETCH_CONCURRENCY)
+limiter = RateLimiter(QUANDL_RATE_LIMIT, FETCH_CONCURRENCY)
+cache = make_response_cache()
 
-check_data_quality(nasdaq_sdf, 'NASDAQ')
-check_data_quality(nyse_sdf, 'NYSE')
+reconcile_sample('NASDAQ', 'FNSQ', TABLE_SHORT_INTERESTS_NASDAQ,
+                 RECONCILE_SAMPLE_FRACTION, RECONCILE_MIN_SYMBOLS, FETCH_CONCURRENCY)
+reconcile_sample('NYSE', 'FNYX', TABLE_SHORT_INTERESTS_NYSE,
+                 RECONCILE_SAMPLE_FRACTION, RECONCILE_MIN_SYMBOLS, FETCH_CONCURRENCY)
+http.close()
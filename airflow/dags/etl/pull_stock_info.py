@@ -12,7 +12,7 @@ def pull_stock_info(url, db_host, table_path):
         logger.warn("Stored data from {} to {}.".format(url, db_host+table_path+'-temp'))
 
         # Some tickers, like "BRK.A", should be changed to "BRK_S" instead.
-        df = spark.read.csv(db_host+table_path+'-temp', header=True)
+        df = spark.read.schema(STOCK_INFO_SCHEMA).csv(db_host+table_path+'-temp', header=True)
         # replace_dots = F.udf(lambda x: x.replace('.', '_'), T.StringType())
         # df = df.withColumn('Symbol', F.when(F.col('Symbol').contains('.'), replace_dots('Symbol')).otherwise(F.col('Symbol')))
         df = df.withColumn('Symbol', F.regexp_replace('Symbol', '\.', '_')) \
@@ -2,6 +2,8 @@ from airflow.configuration import conf as airflow_config
 import configparser
 import json
 import os
+from airflow.models import Variable
+import lib.emrspark_lib as emrs
 
 config = configparser.ConfigParser()
 airflow_dir = os.path.split(airflow_config['core']['dags_folder'])[0]
@@ -10,6 +12,9 @@ config.read('{}/config.cfg'.format(airflow_dir))
 CLUSTER_NAME = config['AWS']['CLUSTER_NAME']
 VPC_ID = config['AWS']['VPC_ID']
 SUBNET_ID = config['AWS']['SUBNET_ID']
+EMR_IDLE_TIMEOUT_MINUTES = config['AWS'].getint('EMR_IDLE_TIMEOUT_MINUTES', fallback=0)
+LIVY_POOL_SIZE = config['AWS'].getint('LIVY_POOL_SIZE', fallback=1)
+LIVY_SESSION_MAX_JOBS = config['AWS'].getint('LIVY_SESSION_MAX_JOBS', fallback=20)
 
 if config['App']['STOCKS'] == '':
     STOCKS = []
@@ -20,3 +25,36 @@ if config['App']['STOCK_LIMITS'] == '':
     LIMIT = None
 else:
     LIMIT = int(config['App']['STOCK_LIMITS'])
+
+FETCH_CONCURRENCY = config['App'].getint('FETCH_CONCURRENCY', fallback=16)
+FETCH_MODE = config['App'].get('FETCH_MODE', fallback='driver')
+PULL_SHARDS = config['App'].getint('PULL_SHARDS', fallback=1)
+LOG_EVERY_N = config['App'].getint('LOG_EVERY_N', fallback=100)
+FLUSH_MAX_ROWS = config['App'].getint('FLUSH_MAX_ROWS', fallback=500000)
+FLUSH_MAX_MB = config['App'].getint('FLUSH_MAX_MB', fallback=256)
+FLUSH_MAX_SECONDS = config['App'].getint('FLUSH_MAX_SECONDS', fallback=600)
+DORMANT_AFTER_MISSES = config['App'].getint('DORMANT_AFTER_MISSES', fallback=5)
+DORMANT_MAX_INTERVAL_DAYS = config['App'].getint('DORMANT_MAX_INTERVAL_DAYS', fallback=30)
+QUANDL_RATE_LIMIT = config['Quandl'].getfloat('RATE_LIMIT', fallback=20)
+QUANDL_CACHE_LOCATION = config['Quandl'].get('CACHE_LOCATION', fallback='')
+QUANDL_CACHE_TTL_HOURS = config['Quandl'].getfloat('CACHE_TTL_HOURS', fallback=24)
+QUANDL_CACHE_MODE = config['Quandl'].get('CACHE_MODE', fallback='readwrite')
+STORAGE_FORMAT = config['App'].get('STORAGE_FORMAT', fallback='csv')
+TABLE_LOG = config['App'].getboolean('TABLE_LOG', fallback=True)
+COMPACT_MIN_FILES = config['App'].getint('COMPACT_MIN_FILES', fallback=64)
+COMPACT_TARGET_FILE_MB = config['App'].getint('COMPACT_TARGET_FILE_MB', fallback=128)
+COMBINE_MODE = config['App'].get('COMBINE_MODE', fallback='incremental')
+EXPORT_PART_MB = config['App'].getint('EXPORT_PART_MB', fallback=64)
+RECONCILE_SAMPLE_FRACTION = config['App'].getfloat('RECONCILE_SAMPLE_FRACTION', fallback=0.01)
+RECONCILE_MIN_SYMBOLS = config['App'].getint('RECONCILE_MIN_SYMBOLS', fallback=5)
+SENSOR_POKE_SECONDS = config['App'].getint('SENSOR_POKE_SECONDS', fallback=15)
+
+
+def get_livy_session_pool(master_dns):
+    """ Pool of the Livy sessions of a cluster, kept in the `livy_sessions` Variable. """
+    return emrs.LivySessionPool(
+        master_dns,
+        load_state=lambda: Variable.get('livy_sessions', default_var=None, deserialize_json=True),
+        save_state=lambda state: Variable.set('livy_sessions', state, serialize_json=True),
+        size=LIVY_POOL_SIZE,
+        max_jobs=LIVY_SESSION_MAX_JOBS)
@@ -2,10 +2,12 @@ import boto3
 from botocore.exceptions import ClientError
 import subprocess
 import json
+import hashlib
 from pprint import pprint, pformat
 import requests
 import configparser
 import time
+import uuid
 
 import logging
 
@@ -220,23 +222,67 @@ def is_cluster_terminated(emr_client, cluster_id):
     return 'TERMINATED' in cluster['Cluster']['Status']['State']
 
 
+def find_active_cluster(emr_client, cluster_name):
+    """Id of a cluster named `cluster_name` that is starting or running, None if there is none."""
+    clusters = emr_client.list_clusters(ClusterStates=['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING'])
+    active_clusters = [i for i in clusters['Clusters'] if i['Name'] == cluster_name]
+    if len(active_clusters) > 0:
+        return active_clusters[0]['Id']
+    return None
+
+
+def wait_for_cluster(emr_client, cluster_id, sleep_seconds=10):
+    """Wait until the cluster can run jobs, raise if it terminates."""
+    while True:
+        cluster_state = get_cluster_status(emr_client, cluster_id)
+        if cluster_state in ['WAITING', 'RUNNING']:
+            return
+        elif 'TERMINAT' in cluster_state:
+            raise Exception("Cluser terminated:\n{}".format(emr_client.describe_cluster(ClusterId=cluster_id)))
+        else:
+            logging.info("Cluster is {}. Waiting for completion...".format(cluster_state))
+            time.sleep(sleep_seconds)
+
+
+def set_cluster_idle_timeout(emr_client, cluster_id, idle_timeout_seconds):
+    """Have EMR terminate the cluster once it has been idle for `idle_timeout_seconds`.
+
+    A cluster is idle when no YARN application, e.g. a spark session, is running.
+    Needs release emr-5.30.0 or later.
+    """
+    emr_client.put_auto_termination_policy(ClusterId=cluster_id,
+                                           AutoTerminationPolicy={'IdleTimeout': idle_timeout_seconds})
+
+
 def create_emr_cluster(emr_client, cluster_name, master_sg, slave_sg, keypair_name, subnet_id, job_flow_role='EMR_EC2_DefaultRole', service_role='EMR_DefaultRole', release_label='emr-5.9.0',
-                   master_instance_type='m3.xlarge', num_core_nodes=3, core_node_instance_type='m3.xlarge'):
-    """ Create an EMR cluster
+                   master_instance_type='m3.xlarge', num_core_nodes=3, core_node_instance_type='m3.xlarge',
+                   idle_timeout_seconds=None, sleep_seconds=10):
+    """ Create an EMR cluster, or adopt the active cluster named `cluster_name`.
     Args:
         - subnet_id (string): If empty, use first available VPC (VPC is inferred from Security Groups)
+        - idle_timeout_seconds (int): If set, EMR terminates the cluster after being idle that
+          long (see set_cluster_idle_timeout), so that it can stay up between runs.
+    Return:
+        string: Id of the cluster, once it is ready.
     """
     # Avoid recreating cluster
-    clusters = emr_client.list_clusters(ClusterStates=['STARTING', 'RUNNING', 'WAITING', 'BOOTSTRAPPING'])
-    active_clusters = [i for i in clusters['Clusters'] if i['Name'] == cluster_name]
-    if len(active_clusters) > 0:
-        return active_clusters[0]['Id']
+    cluster_id = find_active_cluster(emr_client, cluster_name)
+    if cluster_id is not None:
+        logging.info("Reusing cluster {} ({})".format(cluster_id, get_cluster_status(emr_client, cluster_id)))
+        # It may still be starting, and it may have been created without the current timeout.
+        wait_for_cluster(emr_client, cluster_id, sleep_seconds=sleep_seconds)
+        if idle_timeout_seconds:
+            set_cluster_idle_timeout(emr_client, cluster_id, idle_timeout_seconds)
+        return cluster_id
     else:
         # Create cluster
 
         # To avoid error:
         #    botocore.exceptions.ClientError: An error occurred (ValidationException) when calling the RunJobFlow operation: Invalid InstanceProfile: EMR_EC2_DefaultRole.
         # We use do while in here
+        options = {}
+        if idle_timeout_seconds:
+            options['AutoTerminationPolicy'] = {'IdleTimeout': idle_timeout_seconds}
         ok = False
         while ok == False:
             try:
@@ -277,7 +323,8 @@ def create_emr_cluster(emr_client, cluster_name, master_sg, slave_sg, keypair_na
                         { 'Name': 'zeppelin' }
                     ],
                     # To fix Invalid status code '400': "requirement failed: Session isn't active."
-                    Configurations=[{'Classification': 'livy-conf','Properties': {'livy.server.session.timeout':'100h'}}]
+                    Configurations=[{'Classification': 'livy-conf','Properties': {'livy.server.session.timeout':'100h'}}],
+                    **options
                 )
                 ok = True
             except ClientError as e:
@@ -288,17 +335,7 @@ def create_emr_cluster(emr_client, cluster_name, master_sg, slave_sg, keypair_na
             reason = emr_client.describe_cluster(ClusterId=cluster_id)['Cluster']['Status']['StateChangeReason']
             raise Exception("Cluster error: {} - {}".format(reason['Code'], reason['Message']))
             
-        exit_loop = False
-        while exit_loop == False:
-            cluster_state = get_cluster_status(emr_client, cluster_id)
-            if cluster_state == 'WAITING':
-                exit_loop = True
-            elif 'TERMINATED' in cluster_state:
-                exit_loop = True
-                raise Exception("Cluser terminated:\n{}".format(emr_client.describe_cluster(ClusterId=cluster_id)))
-            else:
-                logging.info("Cluster is {}. Waiting for completion...".format(cluster_state))
-                time.sleep(10)
+        wait_for_cluster(emr_client, cluster_id, sleep_seconds=sleep_seconds)
         logging.info("Cluser created:\n{}".format(emr_client.describe_cluster(ClusterId=cluster_id)))
         return cluster_id
 # ------------
@@ -389,16 +426,180 @@ def wait_for_spark(master_dns, session_headers, port=8998):
 # ------------
 
 
+# Livy Session Pool
+# ------------
+# States of a Livy session that will not run statements anymore.
+SPARK_SESSION_DEAD_STATES = ['shutting_down', 'error', 'dead', 'killed', 'success']
+
+
+def get_spark_session_state(master_dns, session_id, port=8998):
+    """State of a spark session, None when the session does not exist."""
+    response = requests.get(spark_url(master_dns, location='/sessions/{}'.format(session_id), port=port))
+    if response.status_code == 404:
+        return None
+    return response.json()['state']
+
+
+class LivySessionPool:
+    """Warm spark sessions of a cluster, leased to one job at a time.
+
+    The sessions are kept between jobs, so that only the first job pays for the session
+    startup. Their ids, the number of jobs each one ran and the versions of the shared code
+    it loaded (see submit_spark_job_from_file) go through `load_state` and `save_state`
+    (e.g. an Airflow Variable) to be shared by the tasks of the DAGs.
+
+    A session is health-checked when it is leased, and recycled (killed and replaced) when
+    it is not alive anymore, after `max_jobs` jobs, or when it is released as unhealthy
+    (e.g. the job failed). When all `size` sessions are leased, `lease` waits for one.
+    Leases older than `lease_timeout_seconds` on an idle session are taken over, in case
+    the task that held it was killed.
+
+    The state is not locked. A task writes its lease then reads the state back, and moves
+    on to another session if its lease was overwritten. A task that read the state before
+    that write, but only overwrites the lease after the read back, still leases the same
+    session. Livy runs the statements of a session one at a time, so their jobs then run
+    one after the other. Put the tasks in a single-slot Airflow pool if they must never
+    share a session.
+
+    Usage:
+
+        pool = LivySessionPool(master_dns, load_state, save_state)
+        session_headers = pool.lease()
+        ...submit and track a job with session_headers...
+        pool.release(session_headers, healthy=True)
+
+    `close` kills all the sessions of the pool, when the cluster is torn down.
+    """
+
+    def __init__(self, master_dns, load_state, save_state, size=1, max_jobs=20, port=8998, sleep_seconds=10,
+                 lease_timeout_seconds=3600):
+        self.master_dns = master_dns
+        self.load_state = load_state
+        self.save_state = save_state
+        self.size = size
+        self.max_jobs = max_jobs
+        self.port = port
+        self.sleep_seconds = sleep_seconds
+        self.lease_timeout_seconds = lease_timeout_seconds
+
+    def _load(self):
+        """{session id: {'jobs': number of jobs, 'code': loaded code versions, 'lease': None or
+        {'token', 'time'}}}, empty when the state is from another cluster."""
+        state = self.load_state()
+        if state is None or state.get('master_dns') != self.master_dns:
+            return {}
+        return state['sessions']
+
+    def _save(self, sessions):
+        self.save_state({'master_dns': self.master_dns, 'sessions': sessions})
+
+    def _headers(self, session_id, lease):
+        return {'Location': '/sessions/{}'.format(session_id), 'Lease': lease['token']}
+
+    def _is_leased(self, session):
+        lease = session.get('lease')
+        return lease is not None and time.time() - lease['time'] < self.lease_timeout_seconds
+
+    def _session_id(self, session_headers):
+        return session_headers['Location'].rsplit('/', 1)[1]
+
+    def _recycle(self, sessions, session_id, reason):
+        logging.info("Recycling spark session id {} ({})".format(session_id, reason))
+        kill_spark_session_by_id(self.master_dns, session_id, port=self.port)
+        sessions.pop(session_id, None)
+        self._save(sessions)
+
+    def _new_lease(self):
+        return {'token': uuid.uuid4().hex, 'time': time.time()}
+
+    def _take(self, sessions, session_id):
+        """Lease a session, None if another task took it first."""
+        lease = self._new_lease()
+        sessions[session_id]['lease'] = lease
+        sessions[session_id]['jobs'] += 1
+        self._save(sessions)
+        # The state is not locked, so check that no other task overwrote the lease meanwhile.
+        if self._load().get(session_id, {}).get('lease') != lease:
+            return None
+        logging.info("Leased spark session id {} (job {})".format(session_id, sessions[session_id]['jobs']))
+        return self._headers(session_id, lease)
+
+    def lease(self):
+        """Headers of an idle session (see create_spark_session), created if needed."""
+        while True:
+            sessions = self._load()
+            for session_id, session in list(sessions.items()):
+                if self._is_leased(session):
+                    continue
+                state = get_spark_session_state(self.master_dns, session_id, port=self.port)
+                if state is None or state in SPARK_SESSION_DEAD_STATES:
+                    self._recycle(sessions, session_id, state)
+                elif state == 'idle' and session['jobs'] >= self.max_jobs:
+                    self._recycle(sessions, session_id, "ran {} jobs".format(session['jobs']))
+                elif state == 'idle':
+                    session_headers = self._take(sessions, session_id)
+                    if session_headers is not None:
+                        return session_headers
+                    sessions = self._load()
+
+            if len(sessions) < self.size:
+                session_headers = create_spark_session(self.master_dns, port=self.port)
+                session_id = self._session_id(session_headers)
+                lease = self._new_lease()
+                sessions[session_id] = {'jobs': 1, 'code': [], 'lease': lease}
+                self._save(sessions)
+                try:
+                    wait_for_spark(self.master_dns, session_headers, port=self.port)
+                except Exception:
+                    self._recycle(self._load(), session_id, 'failed to start')
+                    raise
+                logging.info("Leased new spark session id {}".format(session_id))
+                return self._headers(session_id, lease)
+
+            logging.info("All {} spark sessions are leased. Waiting...".format(len(sessions)))
+            time.sleep(self.sleep_seconds)
+
+    def release(self, session_headers, healthy=True):
+        """Give a session back, or recycle it now if it is not `healthy`."""
+        session_id = self._session_id(session_headers)
+        sessions = self._load()
+        session = sessions.get(session_id)
+        if session is None:
+            return
+        if not healthy:
+            self._recycle(sessions, session_id, 'released as unhealthy')
+        elif session.get('lease') is not None and session['lease']['token'] == session_headers.get('Lease'):
+            session['lease'] = None
+            self._save(sessions)
+
+    def loaded_code(self, session_headers):
+        """Versions of the shared code already loaded in a session."""
+        session = self._load().get(self._session_id(session_headers))
+        return [] if session is None else session['code']
+
+    def add_loaded_code(self, session_headers, versions):
+        sessions = self._load()
+        session = sessions.get(self._session_id(session_headers))
+        if session is not None:
+            session['code'] = sorted(set(session['code']) | set(versions))
+            self._save(sessions)
+
+    def close(self):
+        """Kill all the sessions of the pool."""
+        sessions = self._load()
+        for session_id in list(sessions.keys()):
+            self._recycle(sessions, session_id, 'pool closed')
+# ------------
+
+
 # Send Spark Jobs
 # ------------
 def push_args_into_code(code, args):
     # Include arguments into the code (at the top of the file)
+    # As Python literals, so that the values keep their types (and quotes are escaped).
     args_str = ""
     for key, value in args.items():
-        if isinstance(value, str):
-            args_str += "{}='{}'\n".format(key, value.replace("'", "\'"))
-        else:
-            args_str += "{}={}\n".format(key, value)
+        args_str += "{}={!r}\n".format(key, value)
     code = args_str + code
     return code
 
@@ -429,20 +630,61 @@ def submit_spark_job(master_dns, session_headers, code, args={}, port=8998):
 
 # Send Spark Jobs from File
 # ------------
-def submit_spark_job_from_file(master_dns, session_headers, filepath, args={}, helperspath=None, commonpath=None, port=8998):
+def code_version(code):
+    """Short hash of some code, to tell its versions apart."""
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()[:12]
+
+
+def load_shared_code(master_dns, session_headers, modules, args={}, port=8998):
+    """Run shared code in a session, so that the next statements can use it.
+
+    Args:
+        - modules (list): (version, code) tuples, run in this order in one statement. Their
+          versions are added to `_ETL_CODE_VERSIONS` in the session.
+    """
+    versions = [version for version, code in modules]
+    code = "\n".join([code for version, code in modules])
+    code += "\n_ETL_CODE_VERSIONS = globals().get('_ETL_CODE_VERSIONS', set()) | set({!r})\n".format(versions)
+    logging.info("Loading shared code {} into the spark session".format(versions))
+    log_tail = SparkLogTail(master_dns, session_headers['Location'], port=port, start=None)
+    job_response_headers = submit_spark_job(master_dns, session_headers, push_args_into_code(code, args), port=port)
+    track_spark_job(master_dns, job_response_headers, port=port, sleep_seconds=5, log_tail=log_tail)
+
+
+def submit_spark_job_from_file(master_dns, session_headers, filepath, args={}, helperspath=None, commonpath=None, libpaths=None, port=8998, pool=None):
+    """
+    The common code, libs and helpers are run before the job file, in this order.
+
+    Args:
+        - libpaths (list): Dependency-free modules (e.g. lib/trading_calendar.py) to
+          include between the common code and the helpers.
+        - pool (LivySessionPool): Pool that leased the session. The common code, libs and
+          helpers are then sent only once per session and version, in a statement of their
+          own, and the job statement only has the args and the job file. Without a pool,
+          everything is sent in the job statement.
+    """
     with open(filepath, 'r') as f:
         code = f.read()
-    helpers_code = ''
-    if helperspath is not None:
-        with open(helperspath, 'r') as f:
-            helpers_code = f.read()
-    common_code = ''
-    if commonpath is not None:
-        with open(commonpath, 'r') as f:
-            common_code = f.read()
-
-    code = push_into_code(code, helpers_code)
-    code = push_into_code(code, common_code)
+    modules = []
+    for path in [commonpath] + list(libpaths or []) + [helperspath]:
+        if path is not None:
+            with open(path, 'r') as f:
+                module_code = f.read()
+            modules.append((code_version(module_code), module_code))
+
+    if pool is None:
+        for version, module_code in reversed(modules):
+            code = push_into_code(code, module_code)
+    else:
+        loaded = pool.loaded_code(session_headers)
+        missing = [(version, module_code) for version, module_code in modules if version not in loaded]
+        if len(missing) > 0:
+            load_shared_code(master_dns, session_headers, missing, args=args, port=port)
+            pool.add_loaded_code(session_headers, [version for version, module_code in missing])
+        # Stop right away if the session somehow lost the shared code.
+        versions = [version for version, module_code in modules]
+        code = push_into_code(code, "assert set({!r}) <= globals().get('_ETL_CODE_VERSIONS', set()), " \
+                                    "'The shared code is not loaded in this session'".format(versions))
     code = push_args_into_code(code, args)
 
     return submit_spark_job(master_dns, session_headers, code, args=args, port=port)
@@ -460,19 +702,102 @@ def get_logstr_with_content(log_lines, content):
             important += (line) + "\n"
     return important
 
+class SparkLogTail:
+    """Follows the log of a spark session, downloading only the lines added since the last read.
+
+    Livy only keeps the last lines of a session log (`livy.cache-log.size`). Once that buffer
+    is full, the offsets stop growing, and the new lines are found after the last line read.
+
+    Args:
+        - start (int): Offset of the first line to read. None to start at the end of the log,
+          e.g. to skip the lines of the previous jobs of a warm session.
+    """
+
+    def __init__(self, master_dns, session_location, port=8998, start=0, page_size=200):
+        self.log_url = spark_url(master_dns, location=session_location + '/log', port=port)
+        self.page_size = page_size
+        self.last_line = None
+        if start is None:
+            page = self._get(size=1)
+            self.offset = page['total']
+            self.last_line = page['log'][-1] if len(page['log']) > 0 else None
+        else:
+            self.offset = start
+
+    def _get(self, **params):
+        return requests.get(self.log_url, params=params, headers={'Content-Type': 'application/json'}).json()
+
+    def read(self):
+        """New lines of the log."""
+        if self.offset == 0 or self.last_line is None:
+            page = self._get(**{'from': self.offset, 'size': self.page_size})
+            lines = page['log']
+        else:
+            # Read from the last line already read, to check that the lines did not move.
+            page = self._get(**{'from': self.offset - 1, 'size': self.page_size + 1})
+            if page['total'] >= self.offset and len(page['log']) > 0 and page['log'][0] == self.last_line:
+                lines = page['log'][1:]
+            else:
+                # The buffer is full and its oldest lines were dropped (or the log was reset),
+                # look for the last line read in the whole buffer.
+                page = self._get(size=max(self.page_size, page['total']))
+                tail = page['log']
+                if self.last_line in tail:
+                    lines = tail[len(tail) - tail[::-1].index(self.last_line):]
+                else:
+                    logging.info("Some lines of the log were lost, they were dropped by Livy "
+                                 "before they could be read.")
+                    lines = tail
+                self.offset = page['total'] - len(lines)
+        self.offset += len(lines)
+        while len(lines) > 0 and self.offset < page['total']:
+            page = self._get(**{'from': self.offset, 'size': self.page_size})
+            if len(page['log']) == 0:
+                break
+            lines += page['log']
+            self.offset += len(page['log'])
+        if len(lines) > 0:
+            self.last_line = lines[-1]
+        return lines
+
+
+def estimate_remaining_seconds(first, last):
+    """Seconds left from two (time, progress) points, None when unknown."""
+    if first is None or last is None or last[1] <= first[1] or last[0] <= first[0]:
+        return None
+    rate = (last[1] - first[1]) / (last[0] - first[0])
+    return (1 - last[1]) / rate
+
+
 # Track Spark Job Status
 # ------------
-def track_spark_job(master_dns, job_response_headers, port=8998, sleep_seconds=600):
+def track_spark_job(master_dns, job_response_headers, port=8998, sleep_seconds=600, min_sleep_seconds=2, backoff=1.5, log_tail=None):
+    """Wait for a job to complete, and return (final status, its log lines).
+
+    The status is polled every `min_sleep_seconds` at first, and less and less often for long
+    jobs, up to every `sleep_seconds`. When Spark reports some progress, the polls do not
+    wait much longer than the estimated time left.
+
+    Args:
+        - log_tail (SparkLogTail): Where to read the log of the job from. By default the
+          whole log of the session is read.
+    """
     job_status = ''
-    session_url = spark_url(master_dns, location=job_response_headers['Location'].split('/statements', 1)[0], port=port)
+    session_location = job_response_headers['Location'].split('/statements', 1)[0]
     statement_url = spark_url(master_dns, location=job_response_headers['Location'], port=port)
-    log_lines = ""
-        
+    if log_tail is None:
+        log_tail = SparkLogTail(master_dns, session_location, port=port)
+    log_lines = []
+    interval = min_sleep_seconds
+    first_progress = None
+    started = time.time()
+
     while job_status not in ['available']:
         # If a statement takes longer than a few milliseconds to execute, Livy returns early and provides
         # a statement URL that can be pooled until it is complete:
         statement_response = requests.get(statement_url, headers={'Content-Type': 'application/json'})
         response_json = statement_response.json()
+        remaining = None
         if isinstance(response_json, str):
             logging.info("response is a string:")
             logging.info(statement_response)
@@ -487,30 +812,40 @@ def track_spark_job(master_dns, job_response_headers, port=8998, sleep_seconds=6
             job_status = response_json['state']
             del(response_json['code'])
 
-            logging.info('Spark Job status: ' + job_status)
             if 'progress' in response_json:
-                progress = str(response_json['progress'])
-                logging.info('Progress: {}'.format(progress))
+                progress = (time.time(), float(response_json['progress']))
+                if first_progress is None:
+                    first_progress = progress
+                remaining = estimate_remaining_seconds(first_progress, progress)
+                logging.info('Spark Job status: {} - progress: {:.0%} - {}'.format(
+                    job_status, progress[1],
+                    'time left unknown' if remaining is None else 'about {:.0f}s left'.format(remaining)))
+            else:
+                logging.info('Spark Job status: ' + job_status)
 
-        logging.info("Response: {}".format(pformat(response_json)))
         if statement_response.status_code == 400:
+            logging.info("Response: {}".format(pformat(response_json)))
             raise SystemError("Spark cluster is inactive")
         else:
-            # Get the logs
-            log_lines = requests.get(session_url + '/log', 
-                                     headers={'Content-Type': 'application/json'}).json()['log']
-
-            logging.info("Log from the cluster:\n{}".format(get_logstr_with_content(log_lines, 'WARN')))
-            logging.info('Final job Status: ' + job_status)
-
+            new_lines = log_tail.read()
+            log_lines += new_lines
+            important = get_logstr_with_content(new_lines, 'WARN')
+            if important != '':
+                logging.info("Log from the cluster:\n{}".format(important))
 
         if job_status == 'idle':
             raise ValueError("track_spark_job error. Looks like you have passed spark session headers for the second parameter. "+
                              "Pass in spark job response headers instead.")
 
+        if job_status in ['cancelling', 'cancelled']:
+            raise ValueError('Stopped because the job was cancelled.')
+
         if job_status != 'available':
-            time.sleep(sleep_seconds)
-            
+            wait = interval if remaining is None else min(interval, max(min_sleep_seconds, remaining / 2))
+            time.sleep(wait)
+            interval = min(interval * backoff, sleep_seconds)
+
+    logging.info('Final job Status: {} after {:.0f}s'.format(job_status, time.time() - started))
     final_job_status = response_json['output']['status']
 
 
@@ -0,0 +1,122 @@
+""" NYSE/NASDAQ trading calendar
+
+Works offline: the holidays are precomputed into a table from the exchange rules when
+this module is loaded. This file has no dependencies, so it is imported by the DAGs and
+also sent along with the ETL code to the Spark session.
+
+Dates are strings in "%Y-%m-%d" format, like everywhere else in the ETL.
+
+Holidays are only known from CALENDAR_FIRST_YEAR to CALENDAR_LAST_YEAR. Outside of these
+years, every weekday is a trading day.
+"""
+from datetime import date as _date, datetime as _datetime, timedelta as _timedelta
+
+CALENDAR_FIRST_YEAR = 2012
+CALENDAR_LAST_YEAR = 2040
+
+# Closures that do not follow the holiday rules.
+SPECIAL_CLOSURES = [
+    '2012-10-29',  # Hurricane Sandy
+    '2012-10-30',  # Hurricane Sandy
+    '2018-12-05',  # National Day of Mourning for George H.W. Bush
+    '2025-01-09',  # National Day of Mourning for Jimmy Carter
+]
+
+
+def _nth_weekday(year, month, weekday, n):
+    """ n-th given weekday (0=Monday) of a month. n=-1 is the last one. """
+    if n > 0:
+        day = _date(year, month, 1)
+        day += _timedelta(days=(weekday - day.weekday()) % 7)
+        return day + _timedelta(weeks=n-1)
+    else:
+        day = _date(year, month+1, 1) - _timedelta(days=1)
+        return day - _timedelta(days=(day.weekday() - weekday) % 7)
+
+
+def _easter(year):
+    """ Easter Sunday (Anonymous Gregorian algorithm). """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19*a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2*e + 2*i - h - k) % 7
+    m = (a + 11*h + 22*l) // 451
+    month, day = divmod(h + l - 7*m + 114, 31)
+    return _date(year, month, day + 1)
+
+
+def _observed(day):
+    """ Saturday holidays are observed on Friday, Sunday holidays on Monday. """
+    if day.weekday() == 5:
+        return day - _timedelta(days=1)
+    elif day.weekday() == 6:
+        return day + _timedelta(days=1)
+    return day
+
+
+def _holidays(year):
+    days = []
+    new_year = _date(year, 1, 1)
+    # New Year's Day on a Saturday is not observed on the previous Friday.
+    if new_year.weekday() != 5:
+        days.append(_observed(new_year))
+    days.append(_nth_weekday(year, 1, 0, 3))                   # Martin Luther King, Jr. Day
+    days.append(_nth_weekday(year, 2, 0, 3))                   # Washington's Birthday
+    days.append(_easter(year) - _timedelta(days=2))            # Good Friday
+    days.append(_nth_weekday(year, 5, 0, -1))                  # Memorial Day
+    if year >= 2022:
+        days.append(_observed(_date(year, 6, 19)))             # Juneteenth
+    days.append(_observed(_date(year, 7, 4)))                  # Independence Day
+    days.append(_nth_weekday(year, 9, 0, 1))                   # Labor Day
+    days.append(_nth_weekday(year, 11, 3, 4))                  # Thanksgiving Day
+    days.append(_observed(_date(year, 12, 25)))                # Christmas Day
+    return [day.strftime("%Y-%m-%d") for day in days]
+
+
+HOLIDAYS = frozenset([day for year in range(CALENDAR_FIRST_YEAR, CALENDAR_LAST_YEAR+1)
+                          for day in _holidays(year)] + SPECIAL_CLOSURES)
+
+
+def _to_date(day):
+    return _datetime.strptime(day, "%Y-%m-%d").date()
+
+
+def is_trading_day(day):
+    d = _to_date(day)
+    return d.weekday() < 5 and day not in HOLIDAYS
+
+
+def next_trading_day(day):
+    """ First trading day after `day`. """
+    d = _to_date(day)
+    while True:
+        d += _timedelta(days=1)
+        if is_trading_day(d.strftime("%Y-%m-%d")):
+            return d.strftime("%Y-%m-%d")
+
+
+def previous_trading_day(day, inclusive=False):
+    """ Last trading day before `day` (or on `day` when inclusive). """
+    if inclusive and is_trading_day(day):
+        return day
+    d = _to_date(day)
+    while True:
+        d -= _timedelta(days=1)
+        if is_trading_day(d.strftime("%Y-%m-%d")):
+            return d.strftime("%Y-%m-%d")
+
+
+def trading_days_between(a, b):
+    """ Number of trading days after `a`, up to and including `b`. """
+    count = 0
+    d = _to_date(a)
+    end = _to_date(b)
+    while d < end:
+        d += _timedelta(days=1)
+        if is_trading_day(d.strftime("%Y-%m-%d")):
+            count += 1
+    return count
@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 import os
 from airflow import DAG
-from airflow.operators.python_operator import PythonOperator
+from airflow.operators.python_operator import PythonOperator, ShortCircuitOperator
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators.custom_operators import VariableExistenceSensor
 from airflow.models import Variable
@@ -15,35 +15,15 @@ from airflow.utils import timezone
 start_date = timezone.utcnow() - timedelta(days=2)
 
 from lib.common import *
-import boto3
+from lib.trading_calendar import is_trading_day
 
 def on_failure(context):
     Variable.set('short_interests_dag_state', 'ERROR')
 
 
 def on_complete():
+    # The content type and ACL of the exported CSV are set by the combine job when it uploads it.
     Variable.set('short_interests_dag_state', 'COMPLETED')
-    if 's3a://' in config['App']['DB_HOST'] or 's3://' in config['App']['DB_HOST']:
-        bucket = config['App']['DB_HOST'].split('/')[-1]
-        
-        key = config['App']['TABLE_SHORT_ANALYSIS_QUANTOPIAN'][1:]+'.csv'
-        (boto3
-         .session
-         .Session(region_name='us-east-1')
-         .resource('s3')
-         .Object(bucket, key)
-         .copy_from(CopySource={'Bucket': bucket,
-                                'Key': key},
-                    MetadataDirective="REPLACE",
-                    ContentType="text/csv")
-        )
-        (boto3
-         .session
-         .Session(region_name='us-east-1')
-         .resource('s3')
-         .Object(bucket, key)
-         .Acl()
-         .put(ACL='public-read'))
 
 
 default_args = {
@@ -61,6 +41,18 @@ default_args = {
     'on_failure_callback': on_failure
 }
 
+# Job file used by the Pull_short_interest_data tasks, for each FETCH_MODE.
+PULL_SHORT_INTERESTS_FILES = {
+    'driver': 'pull_short_interests.py',
+    'executors': 'pull_short_interests-udf.py'
+}
+
+# Quandl code, stock info table and short interests table of each exchange.
+EXCHANGES = [
+    ('FNSQ', config['App']['TABLE_STOCK_INFO_NASDAQ'], config['App']['TABLE_SHORT_INTERESTS_NASDAQ']),
+    ('FNYX', config['App']['TABLE_STOCK_INFO_NYSE'], config['App']['TABLE_SHORT_INTERESTS_NYSE']),
+]
+
 dag = DAG('short_interests_dag',
           default_args=default_args,
           description="Pull short sale volume data from Quandl",
@@ -81,23 +73,33 @@ def submit_spark_job_from_file(**kwargs):
         raise AirflowException("Error in prices_dag. Redo all DAGs.")
 
     cluster_dns = emrs.get_cluster_dns(emr, Variable.get('cluster_id'))
-    emrs.kill_all_spark_sessions(cluster_dns)
-    session_headers = emrs.create_spark_session(cluster_dns)
+    # The session stays warm for the next tasks, the cluster DAG kills it at teardown.
+    pool = get_livy_session_pool(cluster_dns)
+    session_headers = pool.lease()
     helperspath = None
     if 'helperspath' in kwargs:
         helperspath = kwargs['helperspath']
     commonpath = None
     if 'commonpath' in kwargs:
         commonpath = kwargs['commonpath']
-    emrs.wait_for_spark(cluster_dns, session_headers)
-    job_response_headers = emrs.submit_spark_job_from_file(
-        cluster_dns, session_headers, kwargs['filepath'],
-        args=kwargs['args'],
-        commonpath=commonpath,
-        helperspath=helperspath)
-
-    final_status, logs = emrs.track_spark_job(cluster_dns, job_response_headers, sleep_seconds=300)
-    emrs.kill_spark_session(cluster_dns, session_headers)
+    try:
+        # Only the log lines of this job, not of the previous ones in the session.
+        log_tail = emrs.SparkLogTail(cluster_dns, session_headers['Location'], start=None)
+        job_response_headers = emrs.submit_spark_job_from_file(
+            cluster_dns, session_headers, kwargs['filepath'],
+            args=kwargs['args'],
+            commonpath=commonpath,
+            helperspath=helperspath,
+            libpaths=kwargs.get('libpaths'),
+            pool=pool)
+
+        final_status, logs = emrs.track_spark_job(cluster_dns, job_response_headers, sleep_seconds=120,
+                                                    log_tail=log_tail)
+    except Exception:
+        # A failed job may leave the session in a bad state, start the next one afresh.
+        pool.release(session_headers, healthy=False)
+        raise
+    pool.release(session_headers)
     for line in logs:
         logging.info(line)
         if '(FAIL)' in str(line):
@@ -109,10 +111,18 @@ def submit_spark_job_from_file(**kwargs):
         kwargs['on_complete']()
 
 
+# FINRA publishes no short sale volume on weekends and market holidays, so skip those runs.
+check_trading_day_task = ShortCircuitOperator(
+    task_id='Check_trading_day',
+    python_callable=lambda ds, **kwargs: is_trading_day(ds),
+    provide_context=True,
+    dag=dag
+)
+
 # This is so that we don't end up re-running this DAG before everything else completes.
 wait_for_fresh_run_task = VariableExistenceSensor(
     task_id='Wait_for_fresh_run',
-    poke_interval=120,
+    poke_interval=SENSOR_POKE_SECONDS,
     varnames=['short_interests_dag_state'],
     reverse=True,
     mode='reschedule',
@@ -121,7 +131,7 @@ wait_for_fresh_run_task = VariableExistenceSensor(
 
 wait_for_cluster_task = VariableExistenceSensor(
     task_id='Wait_for_cluster',
-    poke_interval=120,
+    poke_interval=SENSOR_POKE_SECONDS,
     varnames=['cluster_id'],
     mode='reschedule',
     dag=dag
@@ -148,26 +158,91 @@ pull_stock_symbols_task = PythonOperator(
     dag=dag
 )
 
-pull_short_interest_data_task = PythonOperator(
-    task_id='Pull_short_interest_data',
+# The pull runs as one task per exchange and shard of its symbols, in parallel when the executor
+# and LIVY_POOL_SIZE allow. They share the Quandl rate limit.
+num_pull_tasks = len(EXCHANGES) * PULL_SHARDS
+pull_short_interest_data_tasks = []
+for exchange, info_table, short_interests_table in EXCHANGES:
+    for shard in range(PULL_SHARDS):
+        pull_short_interest_data_tasks.append(PythonOperator(
+            task_id='Pull_short_interest_data_{}'.format(exchange) + ('_{}'.format(shard) if PULL_SHARDS > 1 else ''),
+            python_callable=submit_spark_job_from_file,
+            op_kwargs={
+                'commonpath': '{}/dags/etl/common.py'.format(airflow_dir),
+                'helperspath': '{}/dags/etl/helpers.py'.format(airflow_dir),
+                'filepath': '{}/dags/etl/{}'.format(airflow_dir, PULL_SHORT_INTERESTS_FILES[FETCH_MODE]),
+                'libpaths': ['{}/dags/lib/trading_calendar.py'.format(airflow_dir)],
+                'args': {
+                    'EXCHANGE': exchange,
+                    'PULL_SHARD': shard,
+                    'PULL_SHARDS': PULL_SHARDS,
+                    'START_DATE': config['App']['START_DATE'],
+                    'QUANDL_API_KEY': config['Quandl']['API_KEY'],
+                    'PULL_DATE': '{{ds}}',
+                    'LIMIT': LIMIT,
+                    'STOCKS': STOCKS,
+                    'FETCH_CONCURRENCY': FETCH_CONCURRENCY,
+                    'LOG_EVERY_N': LOG_EVERY_N,
+                    'FLUSH_MAX_ROWS': FLUSH_MAX_ROWS,
+                    'FLUSH_MAX_MB': FLUSH_MAX_MB,
+                    'FLUSH_MAX_SECONDS': FLUSH_MAX_SECONDS,
+                    'DORMANT_AFTER_MISSES': DORMANT_AFTER_MISSES,
+                    'DORMANT_MAX_INTERVAL_DAYS': DORMANT_MAX_INTERVAL_DAYS,
+                    'TABLE_LOG': TABLE_LOG,
+                    'QUANDL_RATE_LIMIT': QUANDL_RATE_LIMIT / min(num_pull_tasks, LIVY_POOL_SIZE),
+                    'QUANDL_CACHE_LOCATION': QUANDL_CACHE_LOCATION,
+                    'QUANDL_CACHE_TTL_HOURS': QUANDL_CACHE_TTL_HOURS,
+                    'QUANDL_CACHE_MODE': QUANDL_CACHE_MODE,
+                    'AWS_ACCESS_KEY_ID': config['AWS']['AWS_ACCESS_KEY_ID'],
+                    'AWS_SECRET_ACCESS_KEY': config['AWS']['AWS_SECRET_ACCESS_KEY'],
+                    'DB_HOST': config['App']['DB_HOST'],
+                    'TABLE_STOCK_INFO': info_table,
+                    'TABLE_SHORT_INTERESTS': short_interests_table,
+                    'STORAGE_FORMAT': STORAGE_FORMAT,
+                }
+            },
+            dag=dag
+        ))
+
+# Waits for all the pull tasks, and adds what the shards pulled to the tables.
+merge_shards_task = PythonOperator(
+    task_id='Merge_shards',
     python_callable=submit_spark_job_from_file,
     op_kwargs={
         'commonpath': '{}/dags/etl/common.py'.format(airflow_dir),
         'helperspath': '{}/dags/etl/helpers.py'.format(airflow_dir),
-        'filepath': '{}/dags/etl/pull_short_interests.py'.format(airflow_dir), 
+        'filepath': '{}/dags/etl/merge_shards.py'.format(airflow_dir),
         'args': {
-            'START_DATE': config['App']['START_DATE'],
-            'QUANDL_API_KEY': config['Quandl']['API_KEY'],
-            'PULL_DATE': '{{ds}}',
-            'LIMIT': LIMIT,
-            'STOCKS': STOCKS,
             'AWS_ACCESS_KEY_ID': config['AWS']['AWS_ACCESS_KEY_ID'],
             'AWS_SECRET_ACCESS_KEY': config['AWS']['AWS_SECRET_ACCESS_KEY'],
             'DB_HOST': config['App']['DB_HOST'],
-            'TABLE_STOCK_INFO_NASDAQ': config['App']['TABLE_STOCK_INFO_NASDAQ'],
-            'TABLE_STOCK_INFO_NYSE': config['App']['TABLE_STOCK_INFO_NYSE'],
             'TABLE_SHORT_INTERESTS_NASDAQ': config['App']['TABLE_SHORT_INTERESTS_NASDAQ'],
             'TABLE_SHORT_INTERESTS_NYSE': config['App']['TABLE_SHORT_INTERESTS_NYSE'],
+            'STORAGE_FORMAT': STORAGE_FORMAT,
+            'TABLE_LOG': TABLE_LOG,
+            'PULL_SHARDS': PULL_SHARDS,
+        }
+    },
+    dag=dag
+)
+
+compact_tables_task = PythonOperator(
+    task_id='Compact_tables',
+    python_callable=submit_spark_job_from_file,
+    op_kwargs={
+        'commonpath': '{}/dags/etl/common.py'.format(airflow_dir),
+        'helperspath': '{}/dags/etl/helpers.py'.format(airflow_dir),
+        'filepath': '{}/dags/etl/compact_tables.py'.format(airflow_dir), 
+        'args': {
+            'AWS_ACCESS_KEY_ID': config['AWS']['AWS_ACCESS_KEY_ID'],
+            'AWS_SECRET_ACCESS_KEY': config['AWS']['AWS_SECRET_ACCESS_KEY'],
+            'DB_HOST': config['App']['DB_HOST'],
+            'TABLE_SHORT_INTERESTS_NASDAQ': config['App']['TABLE_SHORT_INTERESTS_NASDAQ'],
+            'TABLE_SHORT_INTERESTS_NYSE': config['App']['TABLE_SHORT_INTERESTS_NYSE'],
+            'STORAGE_FORMAT': STORAGE_FORMAT,
+            'COMPACT_MIN_FILES': COMPACT_MIN_FILES,
+            'COMPACT_TARGET_FILE_MB': COMPACT_TARGET_FILE_MB,
+            'TABLE_LOG': TABLE_LOG,
         }
     },
     dag=dag
@@ -180,7 +255,17 @@ quality_check_task = PythonOperator(
         'commonpath': '{}/dags/etl/common.py'.format(airflow_dir),
         'helperspath': '{}/dags/etl/helpers.py'.format(airflow_dir),
         'filepath': '{}/dags/etl/pull_short_interests_quality.py'.format(airflow_dir), 
+        'libpaths': ['{}/dags/lib/trading_calendar.py'.format(airflow_dir)],
         'args': {
+            'START_DATE': config['App']['START_DATE'],
+            'FETCH_CONCURRENCY': FETCH_CONCURRENCY,
+            'RECONCILE_SAMPLE_FRACTION': RECONCILE_SAMPLE_FRACTION,
+            'RECONCILE_MIN_SYMBOLS': RECONCILE_MIN_SYMBOLS,
+            'QUANDL_API_KEY': config['Quandl']['API_KEY'],
+            'QUANDL_RATE_LIMIT': QUANDL_RATE_LIMIT,
+            'QUANDL_CACHE_LOCATION': QUANDL_CACHE_LOCATION,
+            'QUANDL_CACHE_TTL_HOURS': QUANDL_CACHE_TTL_HOURS,
+            'QUANDL_CACHE_MODE': QUANDL_CACHE_MODE,
             'AWS_ACCESS_KEY_ID': config['AWS']['AWS_ACCESS_KEY_ID'],
             'AWS_SECRET_ACCESS_KEY': config['AWS']['AWS_SECRET_ACCESS_KEY'],
             'PULL_DATE': '{{ds}}',
@@ -190,6 +275,7 @@ quality_check_task = PythonOperator(
             'TABLE_STOCK_INFO_NYSE': config['App']['TABLE_STOCK_INFO_NYSE'],
             'TABLE_SHORT_INTERESTS_NASDAQ': config['App']['TABLE_SHORT_INTERESTS_NASDAQ'],
             'TABLE_SHORT_INTERESTS_NYSE': config['App']['TABLE_SHORT_INTERESTS_NYSE'],
+            'STORAGE_FORMAT': STORAGE_FORMAT,
         }
     },
     dag=dag
@@ -209,7 +295,10 @@ combine_datasets_task = PythonOperator(
             'DB_HOST': config['App']['DB_HOST'],
             'TABLE_SHORT_INTERESTS_NASDAQ': config['App']['TABLE_SHORT_INTERESTS_NASDAQ'],
             'TABLE_SHORT_INTERESTS_NYSE': config['App']['TABLE_SHORT_INTERESTS_NYSE'],
+            'STORAGE_FORMAT': STORAGE_FORMAT,
             'TABLE_SHORT_ANALYSIS': config['App']['TABLE_SHORT_ANALYSIS_QUANTOPIAN'],
+            'COMBINE_MODE': COMBINE_MODE,
+            'EXPORT_PART_MB': EXPORT_PART_MB,
         }
     },
     dag=dag
@@ -231,6 +320,7 @@ combine_quality_check_task = PythonOperator(
             'DB_HOST': config['App']['DB_HOST'],
             'TABLE_SHORT_INTERESTS_NASDAQ': config['App']['TABLE_SHORT_INTERESTS_NASDAQ'],
             'TABLE_SHORT_INTERESTS_NYSE': config['App']['TABLE_SHORT_INTERESTS_NYSE'],
+            'STORAGE_FORMAT': STORAGE_FORMAT,
             'TABLE_SHORT_ANALYSIS': config['App']['TABLE_SHORT_ANALYSIS_QUANTOPIAN'],
         },
         'on_complete': on_complete
@@ -239,6 +329,6 @@ combine_quality_check_task = PythonOperator(
 )
 
 
-wait_for_fresh_run_task >> wait_for_cluster_task >> \
-pull_stock_symbols_task >> pull_short_interest_data_task >> \
-quality_check_task >> combine_datasets_task >> combine_quality_check_task
\ No newline at end of file
+check_trading_day_task >> wait_for_fresh_run_task >> wait_for_cluster_task >> \
+pull_stock_symbols_task >> pull_short_interest_data_tasks >> merge_shards_task >> \
+compact_tables_task >> quality_check_task >> combine_datasets_task >> combine_quality_check_task
\ No newline at end of file
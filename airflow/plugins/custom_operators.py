@@ -1,10 +1,19 @@
+import os
 from airflow.plugins_manager import AirflowPlugin
 from airflow.operators.sensors import BaseSensorOperator
+from airflow.utils.db import provide_session
 from airflow.utils.decorators import apply_defaults
 from airflow.models import Variable
 
 
 class VariableExistenceSensor(BaseSensorOperator):
+    """Wait until the Variables `varnames` exist (all of them with operation='AND', any with
+    'OR'), or do not exist with `reverse`.
+
+    Each poke checks all the varnames in one query of the metadata database, so a short
+    `poke_interval` is cheap. With mode='reschedule', the worker slot is released between
+    pokes.
+    """
     @apply_defaults
     def __init__(self, varnames, reverse=False, operation='AND', *args, **kwargs):
         super(VariableExistenceSensor, self).__init__(*args, **kwargs)
@@ -12,30 +21,21 @@ class VariableExistenceSensor(BaseSensorOperator):
         self.reverse = reverse
         self.operation = operation
 
-    def poke(self, context):
-        bool_true = True
-        bool_false = False
-        if self.reverse:
-            bool_true = False
-            bool_false = True
+    @provide_session
+    def get_existing_varnames(self, session=None):
+        existing = set(key for key, in session.query(Variable.key).filter(Variable.key.in_(self.varnames)))
+        # Like Variable.get, also look at the AIRFLOW_VAR_<NAME> environment variables.
+        existing.update(varname for varname in self.varnames if 'AIRFLOW_VAR_' + varname.upper() in os.environ)
+        return existing
 
+    def poke(self, context):
+        existing = self.get_existing_varnames()
+        statuses = [(varname in existing) != self.reverse for varname in self.varnames]
+        self.log.info("Existing variables: {}".format(sorted(existing)))
         if self.operation == 'AND':
-            status = True
-            for varname in self.varnames:
-                var = Variable.get(varname, default_var=None)
-                if var != None:
-                    status = status and bool_true
-                else:
-                    status = status and bool_false
+            return all(statuses)
         elif self.operation == 'OR':
-            status = False
-            for varname in self.varnames:
-                var = Variable.get(varname, default_var=None)
-                if var != None:
-                    status = status or bool_true
-                else:
-                    status = status or bool_false
-        return status
+            return any(statuses)
 
 
 class CustomOperators(AirflowPlugin):
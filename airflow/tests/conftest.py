@@ -0,0 +1,57 @@
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+DAGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags')
+
+# The DAG modules import `lib.*` relative to the dags folder, like Airflow does.
+sys.path.insert(0, DAGS_DIR)
+
+# Args that the ETL code reads when it is loaded.
+ETL_ARGS = {
+    'AWS_ACCESS_KEY_ID': '',
+    'AWS_SECRET_ACCESS_KEY': '',
+    'QUANDL_API_KEY': 'key',
+}
+
+
+def load_etl(args=None):
+    """ Run the shared ETL code in one namespace, in the order of submit_spark_job_from_file.
+
+    `spark` stands in for the session that Livy provides, so only the code that does not
+    touch Spark can be tested.
+    """
+    etl = types.ModuleType('etl')
+    etl.spark = mock.MagicMock()
+    etl.__dict__.update(ETL_ARGS if args is None else args)
+    for path in ['etl/common.py', 'lib/trading_calendar.py', 'etl/helpers.py']:
+        path = os.path.join(DAGS_DIR, path)
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), etl.__dict__)
+    return etl
+
+
+@pytest.fixture
+def etl():
+    return load_etl()
+
+
+class FakeClock(object):
+    """ Stands in for the `time` module of the ETL code. `sleep` only moves the clock. """
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(etl):
+    etl.time = FakeClock()
+    return etl.time
@@ -0,0 +1,379 @@
+""" Tests of the EMR helpers (against moto) and of the Livy helpers (against a stubbed Livy API). """
+import json
+import os
+import time
+from unittest import mock
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import lib.emrspark_lib as emrs
+
+REGION = 'us-west-2'
+CLUSTER_NAME = 'ShortInterestsCluster'
+
+
+@pytest.fixture
+def aws():
+    with mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                                      'AWS_DEFAULT_REGION': REGION}):
+        with mock_aws():
+            yield emrs.get_boto_clients(REGION)
+
+
+def run_cluster(emr, name=CLUSTER_NAME):
+    response = emr.run_job_flow(
+        Name=name,
+        ReleaseLabel='emr-5.30.1',
+        Instances={'MasterInstanceType': 'm3.xlarge', 'SlaveInstanceType': 'm3.xlarge', 'InstanceCount': 2,
+                   'KeepJobFlowAliveWhenNoSteps': True},
+        JobFlowRole='EMR_EC2_DefaultRole',
+        ServiceRole='EMR_DefaultRole'
+    )
+    return response['JobFlowId']
+
+
+def test_find_active_cluster_without_clusters(aws):
+    ec2, emr, iam = aws
+    assert emrs.find_active_cluster(emr, CLUSTER_NAME) is None
+
+
+def test_find_active_cluster_matches_the_name(aws):
+    ec2, emr, iam = aws
+    run_cluster(emr, name='OtherCluster')
+    cluster_id = run_cluster(emr)
+    assert emrs.find_active_cluster(emr, CLUSTER_NAME) == cluster_id
+
+
+def test_find_active_cluster_skips_terminated_clusters(aws):
+    ec2, emr, iam = aws
+    cluster_id = run_cluster(emr)
+    emr.terminate_job_flows(JobFlowIds=[cluster_id])
+    assert emrs.is_cluster_terminated(emr, cluster_id)
+    assert emrs.find_active_cluster(emr, CLUSTER_NAME) is None
+
+
+def test_set_cluster_idle_timeout(aws):
+    ec2, emr, iam = aws
+    cluster_id = run_cluster(emr)
+    # moto does not implement the auto-termination policy calls.
+    with mock.patch.object(emr, 'put_auto_termination_policy') as put_policy:
+        emrs.set_cluster_idle_timeout(emr, cluster_id, 1800)
+    put_policy.assert_called_once_with(ClusterId=cluster_id, AutoTerminationPolicy={'IdleTimeout': 1800})
+
+
+def test_create_emr_cluster_reuses_the_active_cluster(aws):
+    ec2, emr, iam = aws
+    cluster_id = run_cluster(emr)
+    with mock.patch.object(emr, 'run_job_flow') as run_job_flow, \
+         mock.patch.object(emr, 'put_auto_termination_policy') as put_policy:
+        reused_id = emrs.create_emr_cluster(emr, CLUSTER_NAME, 'sg-master', 'sg-slave', 'key', '',
+                                            idle_timeout_seconds=1800, sleep_seconds=0)
+    assert reused_id == cluster_id
+    run_job_flow.assert_not_called()
+    # The reused cluster may have been created with another timeout.
+    put_policy.assert_called_once_with(ClusterId=cluster_id, AutoTerminationPolicy={'IdleTimeout': 1800})
+
+
+def test_create_emr_cluster_reuse_without_idle_timeout(aws):
+    ec2, emr, iam = aws
+    cluster_id = run_cluster(emr)
+    with mock.patch.object(emr, 'put_auto_termination_policy') as put_policy:
+        assert emrs.create_emr_cluster(emr, CLUSTER_NAME, 'sg-master', 'sg-slave', 'key', '',
+                                       sleep_seconds=0) == cluster_id
+    put_policy.assert_not_called()
+
+
+def test_security_group_and_key_pair_are_reused_by_name(aws):
+    ec2, emr, iam = aws
+    vpc_id = emrs.get_first_available_vpc(ec2)
+    sg_id = emrs.create_security_group(ec2, '{}SG'.format(CLUSTER_NAME), 'Master SG', vpc_id)
+    assert emrs.create_security_group(ec2, '{}SG'.format(CLUSTER_NAME), 'Master SG', vpc_id) == sg_id
+
+    keypair = emrs.create_key_pair(ec2, '{}_pem'.format(CLUSTER_NAME))
+    assert emrs.create_key_pair(ec2, '{}_pem'.format(CLUSTER_NAME))['KeyPairId'] == keypair['KeyPairId']
+    assert len(ec2.describe_key_pairs()['KeyPairs']) == 1
+
+
+def test_resources_of_a_terminated_cluster_can_be_deleted(aws):
+    ec2, emr, iam = aws
+    vpc_id = emrs.get_first_available_vpc(ec2)
+    sg_id = emrs.create_security_group(ec2, '{}SG'.format(CLUSTER_NAME), 'Master SG', vpc_id)
+    cluster_id = run_cluster(emr)
+    emrs.delete_cluster(emr, cluster_id)
+
+    assert emrs.is_cluster_terminated(emr, cluster_id)
+    emrs.delete_security_group(ec2, sg_id)
+    groups = ec2.describe_security_groups(Filters=[{'Name': 'group-name', 'Values': ['{}SG'.format(CLUSTER_NAME)]}])
+    assert groups['SecurityGroups'] == []
+
+
+class FakeLivyLog(object):
+    """ Log of a Livy session that only keeps its last `cache_size` lines, like `livy.cache-log.size`. """
+    def __init__(self, cache_size=100):
+        self.cache_size = cache_size
+        self.buffer = []
+        self.num_lines = 0
+        self.requests = []
+
+    def write(self, count):
+        for i in range(count):
+            self.num_lines += 1
+            self.buffer.append('line {}'.format(self.num_lines))
+        self.buffer = self.buffer[-self.cache_size:]
+
+    def reset(self, count):
+        """ The log starts over, e.g. the session was recreated. """
+        self.buffer = []
+        self.write(count)
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append(params)
+        size = params.get('size', 100)
+        start = params.get('from', max(0, len(self.buffer) - size))
+        response = mock.Mock()
+        response.json.return_value = {'from': start, 'total': len(self.buffer),
+                                      'log': self.buffer[start:start+size]}
+        return response
+
+
+@pytest.fixture
+def livy_log():
+    log = FakeLivyLog(cache_size=20)
+    with mock.patch.object(emrs.requests, 'get', log.get):
+        yield log
+
+
+def test_log_tail_reads_each_line_once(livy_log):
+    tail = emrs.SparkLogTail('master', '/sessions/0', page_size=4)
+    assert tail.read() == []
+    livy_log.write(3)
+    assert tail.read() == ['line 1', 'line 2', 'line 3']
+    assert tail.read() == []
+    # More new lines than a page.
+    livy_log.write(9)
+    assert tail.read() == ['line {}'.format(i) for i in range(4, 13)]
+    livy_log.write(1)
+    assert tail.read() == ['line 13']
+
+
+def test_log_tail_follows_the_log_once_the_buffer_is_full(livy_log):
+    tail = emrs.SparkLogTail('master', '/sessions/0', page_size=8)
+    read = []
+    for count in [15, 4, 6, 20, 1]:
+        livy_log.write(count)
+        read += tail.read()
+    assert read == ['line {}'.format(i) for i in range(1, 47)]
+
+
+def test_log_tail_skips_the_lines_dropped_before_they_were_read(livy_log):
+    tail = emrs.SparkLogTail('master', '/sessions/0', page_size=8)
+    livy_log.write(5)
+    assert len(tail.read()) == 5
+    livy_log.write(30)
+    # Lines 6 to 15 were dropped by Livy, the tail carries on with what is left.
+    assert tail.read() == ['line {}'.format(i) for i in range(16, 36)]
+    livy_log.write(2)
+    assert tail.read() == ['line 36', 'line 37']
+
+
+def test_log_tail_after_the_log_was_reset(livy_log):
+    tail = emrs.SparkLogTail('master', '/sessions/0', page_size=8)
+    livy_log.write(10)
+    assert len(tail.read()) == 10
+    livy_log.reset(3)
+    assert tail.read() == ['line 11', 'line 12', 'line 13']
+    livy_log.write(1)
+    assert tail.read() == ['line 14']
+
+
+def test_log_tail_can_start_at_the_end_of_the_log(livy_log):
+    livy_log.write(25)
+    tail = emrs.SparkLogTail('master', '/sessions/0', start=None, page_size=8)
+    assert tail.read() == []
+    livy_log.write(2)
+    assert tail.read() == ['line 26', 'line 27']
+
+
+def test_log_tail_only_downloads_new_lines(livy_log):
+    tail = emrs.SparkLogTail('master', '/sessions/0', page_size=8)
+    livy_log.write(5)
+    tail.read()
+    livy_log.requests = []
+    livy_log.write(2)
+    tail.read()
+    # The last line read, to check that the lines did not move, then the new ones.
+    assert livy_log.requests == [{'from': 4, 'size': 9}]
+
+
+def test_estimate_remaining_seconds():
+    assert emrs.estimate_remaining_seconds((100, 0.1), (110, 0.3)) == pytest.approx(35)
+    assert emrs.estimate_remaining_seconds(None, (110, 0.3)) is None
+    # No progress, or no time between the points.
+    assert emrs.estimate_remaining_seconds((100, 0.3), (110, 0.3)) is None
+    assert emrs.estimate_remaining_seconds((110, 0.1), (110, 0.3)) is None
+
+
+class FakeVariable(object):
+    """ The `livy_sessions` Airflow Variable, stored as JSON like Variable.set(serialize_json=True).
+
+    `after_set` runs after a given number of writes, to let another task in between.
+    """
+    def __init__(self):
+        self.value = None
+        self.writes = 0
+        self.after_set = {}
+
+    def get(self):
+        return None if self.value is None else json.loads(self.value)
+
+    def set(self, state):
+        self.value = json.dumps(state)
+        self.writes += 1
+        hook = self.after_set.pop(self.writes, None)
+        if hook is not None:
+            hook()
+
+
+class FakeLivy(object):
+    """ Sessions of a Livy server: {session id: state}. """
+    def __init__(self):
+        self.states = {}
+        self.killed = []
+
+    def create_spark_session(self, master_dns, port=8998):
+        session_id = str(len(self.states) + len(self.killed))
+        self.states[session_id] = 'idle'
+        return {'Location': '/sessions/{}'.format(session_id)}
+
+    def get_spark_session_state(self, master_dns, session_id, port=8998):
+        return self.states.get(session_id)
+
+    def kill_spark_session_by_id(self, master_dns, session_id, port=8998):
+        self.states.pop(session_id, None)
+        self.killed.append(session_id)
+
+
+@pytest.fixture
+def livy():
+    livy = FakeLivy()
+    with mock.patch.object(emrs, 'create_spark_session', livy.create_spark_session), \
+         mock.patch.object(emrs, 'get_spark_session_state', livy.get_spark_session_state), \
+         mock.patch.object(emrs, 'kill_spark_session_by_id', livy.kill_spark_session_by_id), \
+         mock.patch.object(emrs, 'wait_for_spark'):
+        yield livy
+
+
+@pytest.fixture
+def variable():
+    return FakeVariable()
+
+
+def make_pool(variable, size=2, **kwargs):
+    return emrs.LivySessionPool('master', variable.get, variable.set, size=size, **kwargs)
+
+
+def session_id(headers):
+    return headers['Location'].rsplit('/', 1)[1]
+
+
+def test_pool_reuses_a_released_session(livy, variable):
+    pool = make_pool(variable)
+    first = pool.lease()
+    pool.release(first)
+    second = pool.lease()
+    assert session_id(second) == session_id(first)
+    assert second['Lease'] != first['Lease']
+    assert variable.get()['sessions'][session_id(second)]['jobs'] == 2
+
+
+def test_pool_leases_each_session_to_one_task(livy, variable):
+    first = make_pool(variable).lease()
+    second = make_pool(variable).lease()
+    assert session_id(first) != session_id(second)
+
+
+def test_pool_waits_when_all_sessions_are_leased(livy, variable):
+    make_pool(variable, size=1).lease()
+    with mock.patch.object(emrs.time, 'sleep', side_effect=StopIteration) as sleep:
+        with pytest.raises(StopIteration):
+            make_pool(variable, size=1).lease()
+    sleep.assert_called_once()
+    assert len(livy.states) == 1
+
+
+def test_pool_concurrent_leases_of_the_same_session(livy, variable):
+    pool = make_pool(variable)
+    pool.release(pool.lease())
+    # Both tasks read the state while the session is idle. Task B writes its lease over the
+    # one of task A, before task A reads the state back.
+    before = variable.get()
+    reads = [before]
+    task_b = emrs.LivySessionPool('master', lambda: reads.pop() if len(reads) > 0 else variable.get(),
+                                  variable.set, size=2)
+    leases = {}
+    variable.after_set[variable.writes + 1] = lambda: leases.setdefault('B', task_b.lease())
+    leases['A'] = make_pool(variable).lease()
+
+    assert session_id(leases['B']) == '0'
+    # Task A sees that its lease was overwritten, and takes another session.
+    assert session_id(leases['A']) == '1'
+    sessions = variable.get()['sessions']
+    assert sessions['0']['lease']['token'] == leases['B']['Lease']
+    assert sessions['1']['lease']['token'] == leases['A']['Lease']
+
+
+def test_pool_release_with_a_stale_token_keeps_the_new_lease(livy, variable):
+    pool = make_pool(variable, size=1, lease_timeout_seconds=60)
+    first = pool.lease()
+    with mock.patch.object(emrs.time, 'time', return_value=time.time() + 120):
+        # The task that held the session was killed, its lease timed out and is taken over.
+        second = pool.lease()
+    assert session_id(second) == session_id(first)
+    pool.release(first)
+    assert variable.get()['sessions'][session_id(second)]['lease']['token'] == second['Lease']
+
+
+def test_pool_recycles_a_session_released_as_unhealthy(livy, variable):
+    pool = make_pool(variable)
+    headers = pool.lease()
+    pool.release(headers, healthy=False)
+    assert livy.killed == [session_id(headers)]
+    assert variable.get()['sessions'] == {}
+
+
+def test_pool_release_of_a_dead_session(livy, variable):
+    pool = make_pool(variable)
+    headers = pool.lease()
+    livy.states[session_id(headers)] = 'dead'
+    pool.release(headers)
+    # The next lease replaces it.
+    new_headers = pool.lease()
+    assert session_id(new_headers) != session_id(headers)
+    assert session_id(headers) in livy.killed
+    assert list(variable.get()['sessions']) == [session_id(new_headers)]
+
+
+def test_pool_release_of_a_session_already_recycled(livy, variable):
+    pool = make_pool(variable)
+    headers = pool.lease()
+    pool.close()
+    pool.release(headers)
+    assert variable.get()['sessions'] == {}
+
+
+def test_pool_recycles_sessions_after_max_jobs(livy, variable):
+    pool = make_pool(variable, max_jobs=2)
+    first = pool.lease()
+    pool.release(first)
+    pool.release(pool.lease())
+    third = pool.lease()
+    assert session_id(third) != session_id(first)
+    assert livy.killed == [session_id(first)]
+
+
+def test_pool_ignores_the_state_of_another_cluster(livy, variable):
+    variable.set({'master_dns': 'old-master', 'sessions': {'7': {'jobs': 1, 'code': [], 'lease': None}}})
+    headers = make_pool(variable).lease()
+    assert list(variable.get()['sessions']) == [session_id(headers)]
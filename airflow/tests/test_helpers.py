@@ -0,0 +1,519 @@
+""" Tests of the pure Python parts of the shared ETL helpers (etl/helpers.py). """
+from datetime import datetime, timezone
+
+import pytest
+import requests
+
+
+class FakeCondition(object):
+    """ Condition of a RateLimiter whose waits move the fake clock instead of blocking. """
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def wait(self, seconds):
+        self.clock.sleep(seconds)
+
+    def notify_all(self):
+        pass
+
+
+class StubResponse(object):
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def json(self):
+        if isinstance(self.body, Exception):
+            raise self.body
+        return self.body
+
+
+class StubSession(object):
+    """ HTTP session that answers with the given responses, or raises the given exceptions, in order. """
+    def __init__(self, clock, answers, latency=0.1):
+        self.clock = clock
+        self.answers = list(answers)
+        self.latency = latency
+        self.calls = []
+
+    def get(self, url, timeout=None):
+        self.calls.append((url, timeout))
+        self.clock.sleep(self.latency)
+        answer = self.answers.pop(0)
+        if isinstance(answer, BaseException):
+            raise answer
+        return answer
+
+
+@pytest.fixture
+def limiter(etl, clock):
+    limiter = etl.RateLimiter(max_rate=10, max_concurrency=4)
+    limiter.cond = FakeCondition(clock)
+    return limiter
+
+
+# RateLimiter
+# ------------
+def test_rate_limiter_starts_at_half_speed(limiter):
+    assert limiter.rate == 5
+    assert limiter.concurrency == 2
+
+
+def test_rate_limiter_refills_tokens_with_time(limiter, clock):
+    limiter.acquire()
+    limiter.acquire()
+    tokens = limiter.tokens
+    assert tokens < 1
+    clock.sleep(0.5)
+    limiter._refill(clock.time())
+    assert limiter.tokens - tokens == pytest.approx(0.5 * limiter.rate)
+
+
+def test_rate_limiter_caps_the_tokens(limiter, clock):
+    clock.sleep(3600)
+    limiter._refill(clock.time())
+    assert limiter.tokens == limiter.rate
+
+
+def test_rate_limiter_waits_for_a_token(limiter, clock):
+    started_at = clock.time()
+    limiter.acquire()
+    limiter.release(0.1)
+    limiter.acquire()
+    # The first token is there from the start, the second one takes 1/rate seconds.
+    assert clock.time() - started_at == pytest.approx(1.0 / 5, abs=0.02)
+
+
+def test_rate_limiter_speeds_up_on_fast_responses(limiter):
+    limiter.acquire()
+    limiter.release(0.1)
+    assert limiter.rate == 5.5
+    assert limiter.concurrency == 3
+    assert limiter.in_flight == 0
+
+
+def test_rate_limiter_backs_off_when_throttled(limiter, clock):
+    limiter.acquire()
+    limiter.release(0.1, throttled=True, retry_after=30)
+    assert limiter.rate == 2.5
+    assert limiter.concurrency == 1
+    assert limiter.blocked_until == clock.time() + 30
+
+    limiter.acquire()
+    assert clock.time() >= limiter.blocked_until
+
+
+def test_rate_limiter_does_not_speed_up_on_slow_responses(limiter):
+    limiter.acquire()
+    limiter.release(limiter.target_latency + 1)
+    assert limiter.rate == 5
+    assert limiter.concurrency == 2
+
+
+# parse_retry_after
+# ------------
+def test_parse_retry_after_seconds(etl):
+    assert etl.parse_retry_after('120') == 120.0
+    assert etl.parse_retry_after('1.5') == 1.5
+    assert etl.parse_retry_after('-3') == 0.0
+
+
+def test_parse_retry_after_http_date(etl, clock):
+    clock.now = datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert etl.parse_retry_after('Wed, 01 Jan 2020 00:00:30 GMT') == 30.0
+    # Dates in the past do not wait.
+    assert etl.parse_retry_after('Tue, 31 Dec 2019 23:59:00 GMT') == 0.0
+
+
+def test_parse_retry_after_missing_or_invalid(etl):
+    assert etl.parse_retry_after(None) is None
+    assert etl.parse_retry_after('soon') is None
+
+
+# limited_get
+# ------------
+def test_limited_get_passes_a_timeout(etl, clock, limiter):
+    http = StubSession(clock, [StubResponse(200)])
+    assert etl.limited_get(http, 'url', limiter, timeout=12).status_code == 200
+    assert http.calls == [('url', 12)]
+    assert limiter.in_flight == 0
+
+
+def test_limited_get_retries_throttled_responses(etl, clock, limiter):
+    http = StubSession(clock, [StubResponse(429, {'Retry-After': '10'}), StubResponse(503), StubResponse(200)])
+    started_at = clock.time()
+    assert etl.limited_get(http, 'url', limiter).status_code == 200
+    assert len(http.calls) == 3
+    assert clock.time() - started_at >= 10
+    assert limiter.in_flight == 0
+
+
+def test_limited_get_does_not_retry_client_errors(etl, clock, limiter):
+    http = StubSession(clock, [StubResponse(404)])
+    assert etl.limited_get(http, 'url', limiter).status_code == 404
+    assert len(http.calls) == 1
+
+
+def test_limited_get_retries_timeouts(etl, clock, limiter):
+    http = StubSession(clock, [requests.exceptions.Timeout(), requests.exceptions.ConnectionError(),
+                               StubResponse(200)])
+    assert etl.limited_get(http, 'url', limiter).status_code == 200
+    assert len(http.calls) == 3
+    assert limiter.in_flight == 0
+
+
+def test_limited_get_raises_throttled_error_after_all_attempts(etl, clock, limiter):
+    http = StubSession(clock, [requests.exceptions.Timeout()] * 2 + [StubResponse(429)] * 2 +
+                              [requests.exceptions.Timeout()])
+    with pytest.raises(etl.ThrottledError) as e:
+        etl.limited_get(http, 'url', limiter, max_attempts=5)
+    assert e.value.status_code == 429
+    assert len(http.calls) == 5
+    assert limiter.in_flight == 0
+
+
+def test_limited_get_releases_the_limiter_on_unexpected_errors(etl, clock, limiter):
+    http = StubSession(clock, [KeyError('boom')])
+    with pytest.raises(KeyError):
+        etl.limited_get(http, 'url', limiter)
+    assert limiter.in_flight == 0
+
+
+# WatermarkIndex dormancy
+# ------------
+@pytest.fixture
+def watermarks(etl):
+    return etl.WatermarkIndex('s3a://bucket', '/short_interests_nasdaq', dormant_after=3, max_interval_days=30)
+
+
+def test_watermarks_empty_fetches_make_a_symbol_dormant(watermarks):
+    watermarks.update('AAA', last_date='2020-01-02', rows=10, status='ok', probe_date='2020-01-02')
+    for probe_date in ['2020-01-03', '2020-01-06']:
+        watermarks.update('AAA', status='empty', probe_date=probe_date)
+        assert watermarks.next_probe_date('AAA') is None
+    watermarks.update('AAA', status='empty', probe_date='2020-01-07')
+    assert watermarks.symbols['AAA']['misses'] == 3
+    assert watermarks.next_probe_date('AAA') == '2020-01-09'
+    assert watermarks.symbols['AAA']['last_date'] == '2020-01-02'
+
+
+def test_watermarks_404_makes_a_symbol_dormant_right_away(watermarks):
+    watermarks.update('GONE', status='404', probe_date='2020-01-02')
+    assert watermarks.symbols['GONE']['misses'] == 3
+    assert watermarks.next_probe_date('GONE') == '2020-01-04'
+
+
+@pytest.mark.parametrize('status', ['401', '403', '500', 'None', 'invalid'])
+def test_watermarks_errors_are_not_misses(watermarks, status):
+    watermarks.update('AAA', status='empty', probe_date='2020-01-02')
+    watermarks.update('AAA', status=status, probe_date='2020-01-03')
+    assert watermarks.symbols['AAA']['misses'] == 1
+    assert watermarks.symbols['AAA']['status'] == status
+
+
+def test_watermarks_probe_interval_doubles_up_to_the_cap(watermarks):
+    intervals = []
+    for i in range(8):
+        watermarks.update('AAA', status='404', probe_date='2020-01-01')
+        next_probe = datetime.strptime(watermarks.next_probe_date('AAA'), "%Y-%m-%d")
+        intervals.append((next_probe - datetime(2020, 1, 1)).days)
+    assert intervals == [2, 4, 8, 16, 30, 30, 30, 30]
+
+
+def test_watermarks_hit_resets_the_misses(watermarks):
+    for i in range(5):
+        watermarks.update('AAA', status='empty', probe_date='2020-01-02')
+    assert watermarks.next_probe_date('AAA') is not None
+    watermarks.update('AAA', last_date='2020-02-03', rows=1, status='ok', probe_date='2020-02-03')
+    assert watermarks.symbols['AAA']['misses'] == 0
+    assert watermarks.next_probe_date('AAA') is None
+
+
+def test_watermarks_unknown_or_never_probed_symbols_are_not_dormant(watermarks):
+    assert watermarks.next_probe_date('NEW') is None
+    for i in range(5):
+        watermarks.update('AAA', status='empty')
+    assert watermarks.next_probe_date('AAA') is None
+
+
+def test_due_start_dates_skip_dormant_symbols_until_their_probe(etl, watermarks):
+    watermarks.update('GONE', status='404', probe_date='2020-01-02')
+    last_dates = {'AAA': '2020-01-02'}
+    due = etl.get_due_start_dates(['AAA', 'GONE'], True, last_dates, watermarks, '2013-04-01', '2020-01-03')
+    assert due == {'AAA': '2020-01-03'}
+    due = etl.get_due_start_dates(['AAA', 'GONE'], True, last_dates, watermarks, '2013-04-01', '2020-01-06')
+    assert due == {'AAA': '2020-01-03', 'GONE': '2013-04-01'}
+
+
+# group_upload_parts
+# ------------
+MB = 1024 * 1024
+
+
+def part_sizes(parts, sizes):
+    return [sum(sizes[path] for path in part) for part in parts]
+
+
+def test_upload_parts_group_small_files(etl):
+    files = [('f{}'.format(i), 2 * MB) for i in range(6)]
+    parts = etl.group_upload_parts(files, 5 * MB)
+    assert parts == [['f0', 'f1', 'f2'], ['f3', 'f4', 'f5']]
+
+
+def test_upload_parts_keep_large_files_alone(etl):
+    files = [('big1', 12 * MB), ('big2', 5 * MB), ('big3', 7 * MB)]
+    assert etl.group_upload_parts(files, 5 * MB) == [['big1'], ['big2'], ['big3']]
+
+
+def test_upload_parts_only_the_last_part_is_undersized(etl):
+    files = [('a', 3 * MB), ('b', 8 * MB), ('c', 1 * MB), ('d', 1 * MB), ('e', 4 * MB), ('f', 2 * MB)]
+    sizes = dict(files)
+    parts = etl.group_upload_parts(files, 5 * MB)
+    assert parts == [['a', 'b'], ['c', 'd', 'e'], ['f']]
+    assert all(size >= 5 * MB for size in part_sizes(parts, sizes)[:-1])
+    assert part_sizes(parts, sizes)[-1] == 2 * MB
+    # The files stay in order, so the object is their concatenation.
+    assert [path for part in parts for path in part] == [path for path, size in files]
+
+
+def test_upload_parts_of_small_files_only(etl):
+    assert etl.group_upload_parts([('a', 10), ('b', 20)], 5 * MB) == [['a', 'b']]
+
+
+def test_upload_parts_without_files(etl):
+    # One empty part, which only holds the header.
+    assert etl.group_upload_parts([], 5 * MB) == [[]]
+
+
+# Reconciliation with Quandl
+# ------------
+@pytest.fixture
+def sizes():
+    # 100 symbols with 1 to 100 rows: S001 has the shortest history, S100 the longest.
+    return {'S{:03d}'.format(i): i for i in range(1, 101)}
+
+
+def strata_counts(sample, sizes, strata=4):
+    return [sum(1 for symbol in sample if (sizes[symbol] - 1) * strata // len(sizes) == i) for i in range(strata)]
+
+
+def test_stratified_sample_splits_evenly_across_strata(etl, sizes):
+    sample = etl.stratified_sample(sizes, 8, seed='2020-01-02NASDAQ')
+    assert len(sample) == 8
+    assert sample == sorted(sample)
+    assert strata_counts(sample, sizes) == [2, 2, 2, 2]
+
+
+def test_stratified_sample_gives_the_remainder_to_the_first_strata(etl, sizes):
+    sample = etl.stratified_sample(sizes, 6, seed=1)
+    assert strata_counts(sample, sizes) == [2, 2, 1, 1]
+
+
+def test_stratified_sample_with_fewer_symbols_than_strata(etl):
+    sample = etl.stratified_sample({'A': 1, 'B': 50, 'C': 900}, 2, seed=1)
+    assert len(sample) == 2
+    assert etl.stratified_sample({'A': 1, 'B': 50}, 10, seed=1) == ['A', 'B']
+
+
+def test_stratified_sample_is_reproducible(etl, sizes):
+    first = etl.stratified_sample(sizes, 10, seed='2020-01-02NYSE')
+    assert etl.stratified_sample(dict(reversed(list(sizes.items()))), 10, seed='2020-01-02NYSE') == first
+    assert etl.stratified_sample(sizes, 10, seed='2020-01-03NYSE') != first
+
+
+def quandl_response(data):
+    return {'dataset': {'column_names': ['Date', 'ShortVolume', 'ShortExemptVolume', 'TotalVolume'],
+                        'data': [[date, short, exempt, total] for date, short, exempt, total in data]}}
+
+
+def lake_row(date, short, exempt, total):
+    return {'Date': datetime.strptime(date, "%Y-%m-%d").date(), 'ShortVolume': short,
+            'ShortExemptVolume': exempt, 'TotalVolume': total}
+
+
+def test_reconcile_symbol_matching_rows(etl):
+    response = quandl_response([('2020-01-03', 100.0, 0.0, 250.0), ('2020-01-02', 90.0, 1.0, 200.0)])
+    lake = [lake_row('2020-01-02', 90, 1, 200), lake_row('2020-01-03', 100, 0, 250)]
+    assert etl.reconcile_symbol(response, lake, '2020-01-01', '2020-01-03') == \
+        {'quandl_rows': 2, 'lake_rows': 2, 'missing': 0, 'extra': 0, 'mismatched': 0}
+
+
+def test_reconcile_symbol_finds_missing_extra_and_mismatched_rows(etl):
+    response = quandl_response([('2020-01-06', 10.0, 0.0, 20.0),
+                                ('2020-01-03', 100.0, 0.0, 250.0),
+                                ('2020-01-02', 90.0, 1.0, 200.0)])
+    lake = [lake_row('2020-01-02', 90, 1, 201),   # value diff
+            lake_row('2020-01-06', 10, 0, 20),
+            lake_row('2020-01-07', 5, 0, 9)]      # extra date
+    # 2020-01-03 is missing from the lake.
+    assert etl.reconcile_symbol(response, lake, '2020-01-01', '2020-01-07') == \
+        {'quandl_rows': 3, 'lake_rows': 3, 'missing': 1, 'extra': 1, 'mismatched': 1}
+
+
+def test_reconcile_symbol_ignores_quandl_rows_out_of_range(etl):
+    response = quandl_response([('2020-01-08', 1.0, 0.0, 2.0), ('2020-01-03', 100.0, 0.0, 250.0),
+                                ('2012-12-31', 1.0, 0.0, 2.0)])
+    lake = [lake_row('2020-01-03', 100, 0, 250)]
+    assert etl.reconcile_symbol(response, lake, '2013-04-01', '2020-01-07') == \
+        {'quandl_rows': 1, 'lake_rows': 1, 'missing': 0, 'extra': 0, 'mismatched': 0}
+
+
+def test_format_table(etl):
+    assert etl.format_table(['Symbol', 'Missing'], [['AAPL', 0], ['A', 12]]) == [
+        'Symbol  Missing',
+        'AAPL    0      ',
+        'A       12     ',
+    ]
+
+
+# fetch_quandl
+# ------------
+class DictCache(object):
+    """ ResponseCache kept in memory. """
+    replay = False
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, status_code, body):
+        self.entries[key] = {'status_code': status_code, 'body': body}
+
+
+def test_fetch_quandl_caches_datasets(etl, clock, limiter):
+    body = {'dataset': {'column_names': ['Date'], 'data': [['2020-01-02']]}}
+    cache = DictCache()
+    http = StubSession(clock, [StubResponse(200, body=body)])
+    assert etl.fetch_quandl(http, limiter, cache, 'FNSQ', 'AAPL', '2020-01-01', '2020-01-02')[:2] == (200, body)
+    # The second fetch is served by the cache.
+    assert etl.fetch_quandl(http, limiter, cache, 'FNSQ', 'AAPL', '2020-01-01', '2020-01-02')[:2] == (200, body)
+    assert len(http.calls) == 1
+
+
+@pytest.mark.parametrize('body', [ValueError('Expecting value'), ['not', 'a', 'dataset'], {'quandl_error': {}}])
+def test_fetch_quandl_skips_bodies_that_are_not_datasets(etl, clock, limiter, body):
+    cache = DictCache()
+    http = StubSession(clock, [StubResponse(200, body=body)])
+    status_code, result, url = etl.fetch_quandl(http, limiter, cache, 'FNSQ', 'AAPL', '2020-01-01', '2020-01-02')
+    assert (status_code, result) == (200, None)
+    assert cache.entries == {}
+
+
+def test_fetch_quandl_caches_unknown_symbols(etl, clock, limiter):
+    cache = DictCache()
+    http = StubSession(clock, [StubResponse(404)])
+    assert etl.fetch_quandl(http, limiter, cache, 'FNSQ', 'GONE', '2020-01-01', '2020-01-02')[:2] == (404, None)
+    assert len(cache.entries) == 1
+
+
+# TableLog vacuum
+# ------------
+class MemoryFs(object):
+    """ Hadoop FileSystem kept in memory, `paths` are the names passed to `delete`. """
+    def __init__(self, paths):
+        self.paths = set(paths)
+
+    def delete(self, path, recursive):
+        if path not in self.paths:
+            return False
+        self.paths.remove(path)
+        return True
+
+
+def memory_table_log(etl, fs, documents):
+    """ TableLog whose `_txn_log` documents and data files live in `documents` and `fs`. """
+    class MemoryTableLog(etl.TableLog):
+        def _hpath(self, path):
+            return path
+
+        def exists(self):
+            return len(documents) > 0
+
+        def _log_files(self):
+            names = [path.rsplit('/', 1)[1] for path in fs.paths if path.startswith(self.log_path + '/')]
+            versions = sorted(int(name[:-len('.json')]) for name in names
+                              if name.endswith('.json') and not name.endswith('.checkpoint.json'))
+            checkpoints = sorted(int(name[:-len('.checkpoint.json')]) for name in names
+                                 if name.endswith('.checkpoint.json'))
+            return (versions, checkpoints)
+
+        def _read_json(self, name):
+            return documents[self.log_path + '/' + name]
+    return MemoryTableLog('s3a://bucket', '/table', checkpoint_every=2)
+
+
+@pytest.fixture
+def table(etl, clock):
+    """ Log of 5 commits an hour apart, each replacing the file of the previous one. """
+    documents = {}
+    fs = MemoryFs([])
+    start = clock.now - 4 * 3600
+    for version in range(5):
+        path = '/table/_txn_log/{:020d}.json'.format(version)
+        documents[path] = {'version': version, 'timestamp': start + version * 3600, 'operation': 'append',
+                           'add': [{'path': 'part-{}'.format(version)}],
+                           'remove': [] if version == 0 else ['part-{}'.format(version - 1)], 'info': {}}
+        fs.paths.update([path, '/table/part-{}'.format(version)])
+        if version > 0 and version % 2 == 0:
+            path = '/table/_txn_log/{:020d}.checkpoint.json'.format(version)
+            documents[path] = {'version': version, 'created': start, 'files': [{'path': 'part-{}'.format(version)}]}
+            fs.paths.add(path)
+    etl.get_fs = lambda spark, host: fs
+    log = memory_table_log(etl, fs, documents)
+    etl.TableLog = lambda host, table_path, storage_format: log
+    return (log, fs, documents)
+
+
+def test_vacuum_deletes_the_commits_before_the_latest_checkpoint(table, clock):
+    log, fs, documents = table
+    created = log.created()
+    log.vacuum(retention_hours=1.5)
+    # Version 3 is younger than the retention window.
+    assert log._log_files() == ([3, 4], [4])
+    assert sorted(path for path in fs.paths if not path.startswith(log.log_path)) == \
+        ['/table/part-2', '/table/part-3', '/table/part-4']
+    # The checkpoint replaces the deleted commits.
+    assert log.snapshot() == (4, {'part-4': {'path': 'part-4'}})
+    assert log.version() == 4
+    assert log.created() == created
+
+
+def test_vacuum_keeps_the_commits_of_the_retention_window(table):
+    log, fs, documents = table
+    log.vacuum(retention_hours=2.5)
+    # Versions 2 and later are not old enough, so neither is the checkpoint of version 2.
+    assert log._log_files() == ([2, 3, 4], [2, 4])
+    assert '/table/part-1' in fs.paths and '/table/part-0' not in fs.paths
+
+
+def test_vacuum_keeps_the_commits_without_a_checkpoint_that_knows_the_creation_time(table):
+    log, fs, documents = table
+    del documents['/table/_txn_log/{:020d}.checkpoint.json'.format(4)]['created']
+    log.vacuum(retention_hours=0)
+    assert log._log_files() == ([0, 1, 2, 3, 4], [2, 4])
+    assert sorted(path for path in fs.paths if not path.startswith(log.log_path)) == ['/table/part-4']
+
+
+def test_get_new_dates_reads_everything_after_vacuumed_commits(etl, table):
+    log, fs, documents = table
+    for version in range(5):
+        documents[log.log_path + '/{:020d}.json'.format(version)]['operation'] = 'compact'
+    new_state = {'/table': {'created': log.created(), 'version': 4}}
+    assert etl.get_new_dates('s3a://bucket', ['/table'], state=new_state) == ([], new_state)
+    old_state = {'/table': {'created': log.created(), 'version': 1}}
+    assert etl.get_new_dates('s3a://bucket', ['/table'], state=old_state) == ([], new_state)
+    log.vacuum(retention_hours=0)
+    assert log._log_files() == ([4], [4])
+    # The commits after version 1 are gone, so its new rows are unknown.
+    assert etl.get_new_dates('s3a://bucket', ['/table'], state=old_state) == (None, new_state)
+    state = {'/table': {'created': log.created(), 'version': 3}}
+    assert etl.get_new_dates('s3a://bucket', ['/table'], state=state) == ([], new_state)
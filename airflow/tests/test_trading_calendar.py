@@ -0,0 +1,72 @@
+""" Tests of the offline NYSE/NASDAQ trading calendar. """
+from datetime import date
+
+import pytest
+
+import lib.trading_calendar as tc
+
+
+@pytest.mark.parametrize('day, observed', [
+    (date(2021, 12, 25), date(2021, 12, 24)),  # Saturday, observed on Friday
+    (date(2015, 7, 4), date(2015, 7, 3)),      # Saturday, observed on Friday
+    (date(2022, 12, 25), date(2022, 12, 26)),  # Sunday, observed on Monday
+    (date(2019, 7, 4), date(2019, 7, 4)),      # Thursday
+])
+def test_observed(day, observed):
+    assert tc._observed(day) == observed
+
+
+@pytest.mark.parametrize('day', ['2021-12-24', '2015-07-03', '2022-12-26'])
+def test_weekend_holidays_are_observed_on_weekdays(day):
+    assert not tc.is_trading_day(day)
+
+
+def test_new_year_on_a_saturday_is_not_observed():
+    assert tc.is_trading_day('2021-12-31')
+
+
+@pytest.mark.parametrize('day', ['2016-03-25', '2020-04-10', '2024-03-29'])
+def test_good_friday(day):
+    assert not tc.is_trading_day(day)
+
+
+def test_juneteenth_from_2022_only():
+    assert tc.is_trading_day('2021-06-18')
+    assert not tc.is_trading_day('2022-06-20')
+    assert not tc.is_trading_day('2023-06-19')
+
+
+@pytest.mark.parametrize('day', ['2012-10-29', '2012-10-30', '2018-12-05', '2025-01-09'])
+def test_special_closures(day):
+    assert not tc.is_trading_day(day)
+
+
+def test_weekends():
+    assert not tc.is_trading_day('2020-02-08')
+    assert not tc.is_trading_day('2020-02-09')
+    assert tc.is_trading_day('2020-02-10')
+
+
+def test_trading_days_between():
+    # Christmas observed on Friday the 24th, then a weekend.
+    assert tc.trading_days_between('2021-12-23', '2021-12-28') == 2
+    assert tc.trading_days_between('2021-12-23', '2021-12-23') == 0
+    assert tc.trading_days_between('2021-12-28', '2021-12-23') == 0
+    # Hurricane Sandy closed the markets for two days.
+    assert tc.trading_days_between('2012-10-26', '2012-10-31') == 1
+
+
+def test_next_and_previous_trading_day():
+    assert tc.next_trading_day('2021-12-23') == '2021-12-27'
+    assert tc.previous_trading_day('2021-12-27') == '2021-12-23'
+    assert tc.previous_trading_day('2021-12-27', inclusive=True) == '2021-12-27'
+    assert tc.previous_trading_day('2021-12-26', inclusive=True) == '2021-12-23'
+
+
+def test_every_weekday_is_a_trading_day_outside_the_calendar_years():
+    # Christmas 2011 (observed on Monday the 26th) and New Year 2041 are not known.
+    assert tc.CALENDAR_FIRST_YEAR == 2012 and tc.CALENDAR_LAST_YEAR == 2040
+    assert tc.is_trading_day('2011-12-26')
+    assert tc.is_trading_day('2041-01-01')
+    assert not tc.is_trading_day('2041-01-05')
+    assert not any(day.startswith('2011') or day.startswith('2041') for day in tc.HOLIDAYS)
@@ -57,6 +57,10 @@ cluster_dns = emrs.get_cluster_dns(emr, cluster_id)
 args_si = {
     'START_DATE': config['App']['START_DATE'],
     'QUANDL_API_KEY': config['Quandl']['API_KEY'],
+    'QUANDL_RATE_LIMIT': config['Quandl'].getfloat('RATE_LIMIT', fallback=20),
+    'QUANDL_CACHE_LOCATION': config['Quandl'].get('CACHE_LOCATION', fallback=''),
+    'QUANDL_CACHE_TTL_HOURS': config['Quandl'].getfloat('CACHE_TTL_HOURS', fallback=24),
+    'QUANDL_CACHE_MODE': config['Quandl'].get('CACHE_MODE', fallback='readwrite'),
     'YESTERDAY_DATE': '2020-12-10',
 #     'LIMIT': config['App']['STOCK_LIMITS'],
 #     'STOCKS': STOCKS,
@@ -69,6 +73,8 @@ args_si = {
     'TABLE_STOCK_INFO_NYSE': config['App']['TABLE_STOCK_INFO_NYSE'],
     'TABLE_SHORT_INTERESTS_NASDAQ': config['App']['TABLE_SHORT_INTERESTS_NASDAQ'],
     'TABLE_SHORT_INTERESTS_NYSE': config['App']['TABLE_SHORT_INTERESTS_NYSE'],
+    'STORAGE_FORMAT': config['App'].get('STORAGE_FORMAT', fallback='csv'),
+    'TABLE_LOG': config['App'].getboolean('TABLE_LOG', fallback=True),
 }
 
 emrs.kill_all_inactive_spark_sessions(cluster_dns)
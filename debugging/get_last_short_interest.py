@@ -1,8 +1,6 @@
-short_sdf = spark.read \
-    .csv('s3a://short-interest-effect/data/raw/short_interests_nasdaq', header=True)
+# Only the files whose symbol range includes the symbol are read.
+short_sdf = lookup_short_interests('s3a://short-interest-effect', '/data/raw/short_interests_nasdaq', symbol='TXG')
 
-symbol = 'TXG'
-dates = short_sdf.select('Date').where(short_sdf.Symbol == F.lit(symbol)) \
-    .orderBy(F.desc('Date')).take(1)
+dates = short_sdf.select('Date').orderBy(F.desc('Date')).take(1)
     
 print(dates)
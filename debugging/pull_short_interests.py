@@ -36,17 +36,19 @@ def convert_data(olddata, symbol, url):
 
 def pull_short_interests(exchange, host, info_table_path, short_interests_table_path, log_every_n=100):
         
+    http = make_http_session(1)
+    limiter = RateLimiter(QUANDL_RATE_LIMIT, 1)
+    cache = make_response_cache()
+
     def pull_exchange_short_interests_by_symbol(symbol, start_date, end_date):
         """
         Return:
             list of dicts [{'colname': value, ...}, ...]
         """
-        url = 'https://www.quandl.com/api/v3/datasets/FINRA/'+exchange+'_{}?start_date='+start_date+'&end_date='+end_date+'&api_key='+QUANDL_API_KEY
-        url = url.format(symbol)
-        response = requests.get(url)
+        status_code, body, url = fetch_quandl(http, limiter, cache, exchange, symbol, start_date, end_date)
         newdata = []
-        if response.status_code in [200, 201]:
-            newdata = convert_data(response.json(), symbol, url)
+        if status_code in [200, 201]:
+            newdata = convert_data(body, symbol, url)
         return newdata
 
     # Prepare list of stocks